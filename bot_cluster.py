@@ -0,0 +1,444 @@
+# bot_cluster.py - Telegram бот из нескольких процессов: обновления делятся между процессами по водителю
+
+import hmac
+import time
+import zlib
+import asyncio
+import logging
+import secrets
+import multiprocessing
+import concurrent.futures
+from typing import Dict, Any, List, Optional
+
+import aiohttp
+import uvicorn
+from fastapi import FastAPI, Request, HTTPException
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from fast_json import FastJSONResponse
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Заголовок с внутренним секретом, которым диспетчер подписывает запросы к процессам бота
+CLUSTER_SECRET_HEADER = 'X-Bot-Cluster-Secret'
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """Пользователь, от которого пришло обновление (message.from, callback_query.from и т.п.)"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = value.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+def shard_for_user(user_id: int, shards: int) -> int:
+    """Процесс бота, который обслуживает пользователя.
+
+    Номер считается по crc32, а не user_id % shards: внутри процесса
+    OrderedUpdateMiddleware делит водителей по user_id % workers, и при
+    общем делителе часть его воркеров простаивала бы.
+    """
+    return zlib.crc32(str(user_id).encode()) % shards
+
+def shard_for_update(update: Dict[str, Any], shards: int) -> int:
+    """Процесс бота для обновления: все обновления водителя - в один процесс"""
+    user_id = update_user_id(update)
+    return shard_for_user(user_id if user_id is not None else update.get('update_id', 0), shards)
+
+# ===== ПРОЦЕСС БОТА =====
+
+def create_worker_app(bot, channel, secret: str) -> FastAPI:
+    """HTTP-интерфейс процесса бота для диспетчера (слушает только 127.0.0.1)"""
+    from driver_cache import driver_cache
+    from login_throttle import login_throttle
+
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+    def check_secret(request: Request):
+        if not hmac.compare_digest(request.headers.get(CLUSTER_SECRET_HEADER, '').encode(), secret.encode()):
+            raise HTTPException(status_code=401, detail="Неверный секрет")
+
+    @app.get('/health')
+    async def health(request: Request):
+        check_secret(request)
+        return FastJSONResponse({
+            'ready': bot.webhook_ready,
+            'update_types': bot.dp.resolve_used_update_types()
+        })
+
+    @app.post('/update')
+    async def receive_update(request: Request):
+        check_secret(request)
+        if not bot.webhook_ready:
+            raise HTTPException(status_code=503, detail="Бот не принимает обновления")
+        # Ответ после приема в обработку: при перегрузке процесса диспетчер ждет
+        await bot.admit_update(await request.json())
+        return FastJSONResponse({'ok': True})
+
+    @app.post('/broadcast')
+    async def broadcast(request: Request):
+        check_secret(request)
+        data = await request.json()
+        if not bot.schedule_broadcast(data['text'], data['telegram_ids']):
+            raise HTTPException(status_code=503, detail="Бот не запущен")
+        return FastJSONResponse({'ok': True})
+
+    @app.get('/stats')
+    async def stats(request: Request):
+        check_secret(request)
+        return FastJSONResponse({
+            'outbox': bot.get_outbox_stats(),
+            'updates': bot.get_update_stats(),
+            'cache_sync': channel.get_stats(),
+            'driver_cache': driver_cache.get_stats(),
+            'logins': login_throttle.get_stats()
+        })
+
+    return app
+
+async def _serve_worker(index: int, workers: int, port: int, token: str, db_path: str,
+                        api_url: Optional[str], secret: str):
+    from database import DatabaseManager
+    from telegram_bot import ExpeditionBot
+    from cache_sync import CacheInvalidationChannel
+
+    db = DatabaseManager(db_path)
+    channel = CacheInvalidationChannel(db)
+    channel.attach()
+    # Лимит Telegram на бота общий - каждому процессу его доля
+    bot = ExpeditionBot(token, db, api_url=api_url, rate_share=1.0 / workers)
+    if bot.live_status:
+        # События рейсов приходят во все процессы - статус правит только процесс водителя
+        bot.live_status.owns = lambda chat_id: shard_for_user(chat_id, workers) == index
+    bot_task = asyncio.create_task(bot.serve_updates())
+
+    server = uvicorn.Server(uvicorn.Config(
+        create_worker_app(bot, channel, secret), host='127.0.0.1', port=port,
+        log_level='warning', access_log=False
+    ))
+    logger.info(f"🤖 Процесс бота {index + 1}/{workers} запущен на порту {port}")
+    try:
+        # SIGTERM/SIGINT останавливают сервер; после него - бот (дожидается обновлений в работе)
+        await server.serve()
+    finally:
+        bot.stop_webhook()
+        await bot_task
+        channel.close()
+        logger.info(f"📴 Процесс бота {index + 1}/{workers} остановлен")
+
+def run_bot_worker(index: int, workers: int, port: int, token: str, db_path: str,
+                   api_url: Optional[str], secret: str):
+    """Точка входа процесса бота (multiprocessing, метод spawn)"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - bot{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_serve_worker(index, workers, port, token, db_path, api_url, secret))
+
+# ===== ДИСПЕТЧЕР =====
+
+class BotCluster:
+    """Диспетчер бота из нескольких процессов.
+
+    Запускает workers процессов бота (у каждого свой ExpeditionBot, цикл
+    событий и HTTP-порт base_port + номер на 127.0.0.1) и пересылает им
+    обновления Telegram, полученные через getUpdates или webhook веб-
+    приложения. Процесс выбирается по пользователю (shard_for_update), так
+    что все обновления водителя обрабатывает один процесс: его состояние
+    диалога (SQLiteStorage) и ответы не расходятся между процессами. В
+    каждый процесс обновления пересылаются строго по одному и по порядку.
+    Кэши водителей и справочников процессов согласуются через
+    cache_sync.CacheInvalidationChannel. Упавший процесс перезапускается.
+
+    Для веб-приложения диспетчер выглядит как ExpeditionBot: webhook_ready,
+    webhook_secret, dispatch_webhook_update, schedule_broadcast и статистика.
+    """
+
+    def __init__(self, token: str, db_path: str, workers: int, base_port: int = 8100,
+                 api_url: Optional[str] = None, forward_timeout: float = 30.0, monitor_interval: float = 2.0):
+        self.token = token
+        self.db_path = db_path
+        self.workers = max(1, workers)
+        self.base_port = base_port
+        self.api_url = api_url
+        self.forward_timeout = forward_timeout
+        self.monitor_interval = monitor_interval
+        self.secret = secrets.token_urlsafe(32)
+        self.webhook_secret: Optional[str] = None
+        self.update_types: Optional[List[str]] = None
+        self.stats = {'forwarded': 0, 'failed': 0, 'restarts': 0}
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * self.workers
+        self._worker_stats: List[Dict[str, Any]] = [{} for _ in range(self.workers)]
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+
+    # ===== ПРОЦЕССЫ =====
+
+    def _worker_url(self, index: int) -> str:
+        return f'http://127.0.0.1:{self.base_port + index}'
+
+    def _start_worker(self, index: int):
+        process = self._context.Process(
+            target=run_bot_worker,
+            args=(index, self.workers, self.base_port + index, self.token, self.db_path, self.api_url, self.secret),
+            name=f'bot-worker-{index}'
+        )
+        process.start()
+        self._processes[index] = process
+
+    async def _request(self, method: str, index: int, path: str, **kwargs) -> Any:
+        headers = {CLUSTER_SECRET_HEADER: self.secret}
+        async with self._session.request(method, self._worker_url(index) + path, headers=headers, **kwargs) as response:
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+            return await response.json()
+
+    async def start(self, timeout: float = 60.0) -> bool:
+        """Запуск процессов бота; False - не все процессы готовы за timeout"""
+        self._loop = asyncio.get_running_loop()
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.forward_timeout))
+        self._stopped = asyncio.Event()
+        for index in range(self.workers):
+            self._start_worker(index)
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._sender(index)) for index in range(self.workers)]
+
+        deadline = time.monotonic() + timeout
+        ready = set()
+        while len(ready) < self.workers and time.monotonic() < deadline:
+            for index in range(self.workers):
+                if index in ready:
+                    continue
+                try:
+                    health = await self._request('GET', index, '/health')
+                except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError):
+                    continue
+                if health['ready']:
+                    ready.add(index)
+                    self.update_types = health['update_types']
+            await asyncio.sleep(0.2)
+
+        self._tasks.append(asyncio.create_task(self._monitor()))
+        if len(ready) < self.workers:
+            logger.error(f"❌ Готово процессов бота: {len(ready)} из {self.workers}")
+            return False
+        logger.info(f"✅ Запущено процессов бота: {self.workers}")
+        return True
+
+    async def _monitor(self):
+        """Перезапуск упавших процессов и сбор их статистики"""
+        while not self._stopped.is_set():
+            await asyncio.sleep(self.monitor_interval)
+            for index, process in enumerate(self._processes):
+                if self._stopped.is_set():
+                    return
+                if process is not None and not process.is_alive():
+                    logger.error(f"❌ Процесс бота {index} завершился (код {process.exitcode}), перезапуск")
+                    self.stats['restarts'] += 1
+                    self._start_worker(index)
+                    continue
+                try:
+                    self._worker_stats[index] = await self._request('GET', index, '/stats')
+                except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError):
+                    pass
+
+    # ===== ПЕРЕСЫЛКА ОБНОВЛЕНИЙ =====
+
+    @property
+    def webhook_ready(self) -> bool:
+        """Диспетчер запущен и принимает обновления"""
+        return self._stopped is not None and not self._stopped.is_set()
+
+    def dispatch_webhook_update(self, update: Dict[str, Any]) -> concurrent.futures.Future:
+        """Пересылка обновления из webhook (из любого потока); future - прием процессом бота"""
+        if not self.webhook_ready:
+            raise RuntimeError("Бот не принимает обновления")
+        return asyncio.run_coroutine_threadsafe(self.forward(update), self._loop)
+
+    async def forward(self, update: Dict[str, Any]):
+        """Пересылка обновления процессу водителя; завершается, когда процесс принял его"""
+        future = asyncio.get_running_loop().create_future()
+        # Постановка синхронная - порядок в очереди совпадает с порядком поступления
+        self._queues[shard_for_update(update, self.workers)].put_nowait((update, future))
+        await future
+
+    async def _sender(self, index: int):
+        queue = self._queues[index]
+        while True:
+            update, future = await queue.get()
+            try:
+                if future.done():
+                    continue  # Отправитель обновления уже не ждет (webhook ответил 503)
+                await self._post_update(index, update)
+                self.stats['forwarded'] += 1
+                if not future.done():
+                    future.set_result(None)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"❌ Обновление {update.get('update_id')} не передано процессу бота {index}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def _post_update(self, index: int, update: Dict[str, Any]):
+        # Пока процесс перезапускается, повторяем (не дольше forward_timeout)
+        deadline = time.monotonic() + self.forward_timeout
+        while True:
+            try:
+                await self._request('POST', index, '/update', json=update)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                if time.monotonic() >= deadline or self._stopped.is_set():
+                    raise RuntimeError(f"процесс недоступен: {e}")
+            await asyncio.sleep(0.5)
+
+    def _api_bot(self) -> Bot:
+        if self.api_url:
+            return Bot(token=self.token, session=AiohttpSession(api=TelegramAPIServer.from_base(self.api_url.rstrip('/'))))
+        return Bot(token=self.token)
+
+    async def run_polling(self, timeout: int = 30):
+        """Получение обновлений через getUpdates и пересылка процессам до stop()"""
+        bot = self._api_bot()
+        offset = None
+        stopped = asyncio.create_task(self._stopped.wait())
+        try:
+            await bot.delete_webhook(drop_pending_updates=False)
+            logger.info("🤖 Диспетчер бота получает обновления через long polling")
+            while not self._stopped.is_set():
+                # Долгий getUpdates прерывается остановкой (request_stop), а не дожидается timeout
+                request = asyncio.create_task(
+                    bot.get_updates(offset=offset, timeout=timeout, allowed_updates=self.update_types)
+                )
+                await asyncio.wait({request, stopped}, return_when=asyncio.FIRST_COMPLETED)
+                if not request.done():
+                    request.cancel()
+                    await asyncio.gather(request, return_exceptions=True)
+                    break
+                try:
+                    updates = request.result()
+                except Exception as e:
+                    logger.error(f"❌ Ошибка получения обновлений: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not updates:
+                    continue
+                # Следующий запрос - после приема пачки процессами (backpressure)
+                await asyncio.gather(*(
+                    self.forward(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+                    for update in updates
+                ), return_exceptions=True)
+                offset = updates[-1].update_id + 1
+        finally:
+            stopped.cancel()
+            await bot.session.close()
+
+    async def run_webhook(self, url: str, secret_token: str) -> bool:
+        """Регистрация webhook и ожидание stop(); False - Telegram не принял webhook"""
+        bot = self._api_bot()
+        try:
+            await bot.set_webhook(url, secret_token=secret_token, allowed_updates=self.update_types,
+                                  drop_pending_updates=False)
+        except Exception as e:
+            logger.error(f"❌ Не удалось установить webhook {url}: {e}")
+            return False
+        finally:
+            await bot.session.close()
+        self.webhook_secret = secret_token
+        logger.info(f"🌐 Диспетчер бота принимает обновления через webhook: {url}")
+        await self._stopped.wait()
+        return True
+
+    async def request_stop(self):
+        """Прекращение приема обновлений: run_polling и run_webhook завершаются, затем вызывается stop()"""
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def stop(self, timeout: float = 15.0):
+        """Остановка: пересылка очередей, затем процессы (каждый дорабатывает принятые обновления)"""
+        if self._stopped is None:
+            return
+        self._stopped.set()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ При остановке диспетчера не переслана часть обновлений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"⚠️ Процесс бота {process.name} не остановился, принудительное завершение")
+                process.kill()
+        await self._session.close()
+        self._loop = None
+        logger.info("📴 Процессы бота остановлены")
+
+    # ===== РАССЫЛКА И СТАТИСТИКА =====
+
+    def schedule_broadcast(self, text: str, telegram_ids: List[int]) -> bool:
+        """Рассылка из другого потока: каждый процесс отправляет своим водителям; False - не запущен"""
+        loop = self._loop
+        if loop is None or not loop.is_running() or not self.webhook_ready:
+            return False
+        asyncio.run_coroutine_threadsafe(self._broadcast(text, telegram_ids), loop)
+        return True
+
+    async def _broadcast(self, text: str, telegram_ids: List[int]):
+        shards: Dict[int, List[int]] = {}
+        for chat_id in telegram_ids:
+            shards.setdefault(shard_for_user(chat_id, self.workers), []).append(chat_id)
+        for index, chat_ids in shards.items():
+            try:
+                await self._request('POST', index, '/broadcast', json={'text': text, 'telegram_ids': chat_ids})
+            except Exception as e:
+                logger.error(f"❌ Рассылка не передана процессу бота {index}: {e}")
+
+    @staticmethod
+    def _combine(parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Сумма числовых показателей процессов (max_* - максимум) и показатели каждого"""
+        total: Dict[str, Any] = {}
+        for part in parts:
+            for key, value in part.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if key.startswith('max_'):
+                    total[key] = max(total.get(key, value), value)
+                else:
+                    total[key] = total.get(key, 0) + value
+        return {**total, 'per_worker': parts}
+
+    def get_outbox_stats(self) -> Dict[str, Any]:
+        return self._combine([stats.get('outbox', {}) for stats in self._worker_stats])
+
+    def get_login_stats(self) -> Dict[str, Any]:
+        """Ограничение входов в процессах бота (у каждого процесса - свои окна неудач)"""
+        return self._combine([stats.get('logins', {}) for stats in self._worker_stats])
+
+    def get_update_stats(self) -> Dict[str, Any]:
+        return {
+            **self._combine([stats.get('updates', {}) for stats in self._worker_stats]),
+            'cluster': {**self.stats, 'processes': self.workers,
+                        'queue_depth': sum(queue.qsize() for queue in self._queues)}
+        }
@@ -0,0 +1,159 @@
+# bot_latency_benchmark.py - Замер задержки «обновление -> ответ» бота в режимах polling и webhook
+
+import os
+import time
+import asyncio
+import secrets
+import logging
+import argparse
+import tempfile
+import threading
+import statistics
+from typing import Dict, Any, List
+
+import uvicorn
+
+from fake_telegram_api import FakeTelegramBackend, create_fake_telegram_app
+
+# Настройка логирования
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Токен в формате Bot API (заглушка его не проверяет)
+FAKE_TOKEN = '123456:BENCHMARK-fake-token'
+
+def start_server(app, port: int) -> uvicorn.Server:
+    """Запуск uvicorn в отдельном потоке (как веб-приложение в main.py)"""
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='error', access_log=False))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+def percentile(sorted_values: List[float], q: float):
+    """Квантиль по отсортированному списку (None для пустого)"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(mode: str, latencies: List[float], elapsed: float, lost: int) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    quantile = lambda q: percentile(latencies, q)
+    return {
+        'mode': mode,
+        'messages': len(latencies) + lost,
+        'lost': lost,
+        'mean_ms': statistics.mean(latencies) if latencies else None,
+        'p50_ms': quantile(0.50),
+        'p95_ms': quantile(0.95),
+        'p99_ms': quantile(0.99),
+        'max_ms': latencies[-1] if latencies else None,
+        'throughput': (len(latencies) / elapsed) if elapsed else None
+    }
+
+async def start_bot(mode: str, db, api_url: str, web_url: str):
+    """Запуск бота в режиме polling или webhook (webhook принимает веб-приложение): (бот, задача)"""
+    from telegram_bot import ExpeditionBot
+    from web_app import register_telegram_webhook, TELEGRAM_WEBHOOK_PATH
+
+    bot = ExpeditionBot(FAKE_TOKEN, db, api_url=api_url)
+    if mode == 'webhook':
+        register_telegram_webhook(bot)
+        task = asyncio.create_task(bot.start_webhook(web_url + TELEGRAM_WEBHOOK_PATH, secrets.token_urlsafe(32)))
+        while not bot.webhook_ready:
+            await asyncio.sleep(0.01)
+    else:
+        task = asyncio.create_task(bot.start_polling())
+        await asyncio.sleep(0.5)
+    return bot, task
+
+async def stop_bot(mode: str, bot, task: asyncio.Task):
+    from web_app import register_telegram_webhook
+
+    if mode == 'webhook':
+        bot.stop_webhook()
+        await task
+        register_telegram_webhook(None)
+    else:
+        await bot.dp.stop_polling()
+        await task
+
+async def run_mode(mode: str, backend: FakeTelegramBackend, api_loop: asyncio.AbstractEventLoop,
+                   api_url: str, web_url: str, db, messages: int, concurrency: int, text: str) -> Dict[str, Any]:
+    """Один прогон: бот в заданном режиме, водители шлют сообщения и ждут ответа"""
+    bot, task = await start_bot(mode, db, api_url, web_url)
+
+    async def send(chat_id: int) -> Dict[str, Any]:
+        # Сообщение создается в цикле заглушки - как будто его прислал Telegram
+        future = asyncio.run_coroutine_threadsafe(backend.send_message(chat_id, text), api_loop)
+        return await asyncio.wrap_future(future)
+
+    # Прогрев: соединения и первые вызовы обработчиков
+    await asyncio.gather(*(send(1000 + i) for i in range(concurrency)))
+
+    latencies, lost = [], 0
+    started = time.perf_counter()
+    for batch_start in range(0, messages, concurrency):
+        chats = range(batch_start, min(batch_start + concurrency, messages))
+        for result in await asyncio.gather(*(send(1000 + chat % concurrency) for chat in chats)):
+            if result['latency_ms'] is None:
+                lost += 1
+            else:
+                latencies.append(result['latency_ms'])
+    elapsed = time.perf_counter() - started
+
+    await stop_bot(mode, bot, task)
+    return summarize(mode, latencies, elapsed, lost)
+
+async def benchmark(args):
+    from database import DatabaseManager
+
+    backend = FakeTelegramBackend(latency=args.api_latency)
+    api_server = start_server(create_fake_telegram_app(backend), args.api_port)
+    api_loop = await asyncio.to_thread(lambda: _server_loop(api_server))
+
+    from web_app import app
+    start_server(app, args.web_port)
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    db = DatabaseManager(db_path)
+
+    api_url = f'http://127.0.0.1:{args.api_port}'
+    web_url = f'http://127.0.0.1:{args.web_port}'
+
+    results = []
+    for mode in args.modes:
+        results.append(await run_mode(mode, backend, api_loop, api_url, web_url, db,
+                                      args.messages, args.concurrency, args.text))
+
+    print(f"\n📊 Задержка обновление -> ответ ({args.messages} сообщений '{args.text}', "
+          f"параллельно {args.concurrency}, задержка API {args.api_latency * 1000:.0f} мс)")
+    print(f"{'режим':<10}{'среднее':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'макс':>10}{'сообщ/с':>10}{'потеряно':>10}")
+    for r in results:
+        if r['mean_ms'] is None:
+            print(f"{r['mode']:<10}{'нет ответов':>70}")
+            continue
+        print(f"{r['mode']:<10}{r['mean_ms']:>10.1f}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}"
+              f"{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}{r['throughput']:>10.0f}{r['lost']:>10}")
+    print(f"\nЗаглушка Bot API: {backend.stats()['calls']}")
+    return results
+
+def _server_loop(server: uvicorn.Server) -> asyncio.AbstractEventLoop:
+    """Цикл событий потока uvicorn (для передачи сообщений в заглушку)"""
+    while not server.servers:
+        time.sleep(0.01)
+    return server.servers[0].get_loop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение задержки бота в режимах polling и webhook")
+    parser.add_argument('--messages', type=int, default=200, help="Сообщений на режим")
+    parser.add_argument('--concurrency', type=int, default=1, help="Водителей, пишущих одновременно")
+    parser.add_argument('--text', default='/help', help="Текст сообщения водителя")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Задержка ответа Bot API, с")
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--web-port', type=int, default=8082)
+    parser.add_argument('--modes', nargs='+', default=['polling', 'webhook'], choices=['polling', 'webhook'])
+    asyncio.run(benchmark(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
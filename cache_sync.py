@@ -0,0 +1,148 @@
+# cache_sync.py - Передача сбросов кэшей и событий рейсов между процессами через SQLite
+
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+from database import DatabaseManager
+from driver_cache import driver_cache
+from reference_cache import reference_cache
+from trip_events import trip_events
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class CacheInvalidationChannel:
+    """Канал сбросов кэшей процесса для бота, запущенного несколькими процессами.
+
+    Кэши водителей и справочников, а также шина событий рейсов - общие на
+    процесс. Когда бот работает в нескольких процессах (bot_cluster), канал
+    подключается к ним как publisher: каждый сброс (и событие рейса)
+    записывается в таблицу cache_invalidations, а фоновый поток раз в
+    poll_interval читает записи других процессов и применяет их у себя без
+    повторной публикации. События рейсов из процессов бота повторяются в
+    шине веб-сервера, чтобы SSE показывал действия водителей. Запись идет из
+    того же фонового потока: сброс может происходить внутри открытой
+    транзакции DatabaseManager, и писать в базу сразу нельзя.
+    """
+
+    def __init__(self, db: DatabaseManager, poll_interval: float = 0.5,
+                 retention_seconds: int = 3600, purge_interval: float = 600.0):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.purge_interval = purge_interval
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._pending: List[Tuple[str, Optional[str]]] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_id = 0
+        self._last_purge = time.monotonic()
+        self.stats = {'published': 0, 'applied': 0, 'errors': 0}
+
+    # ===== ПОДКЛЮЧЕНИЕ =====
+
+    def attach(self):
+        """Подключение к кэшам процесса и запуск фонового потока"""
+        self._last_id = self.db.get_last_cache_invalidation_id()
+        driver_cache.publisher = self.publish
+        reference_cache.publisher = self.publish
+        trip_events.forwarder = self.publish_trip_event
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="CacheInvalidationChannel")
+        self._thread.start()
+        logger.info(f"🔄 Канал сбросов кэшей подключен (процесс {self.origin})")
+
+    def close(self):
+        """Отключение от кэшей, запись оставшихся сбросов и остановка потока"""
+        driver_cache.publisher = None
+        reference_cache.publisher = None
+        trip_events.forwarder = None
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._flush()
+
+    # ===== ПУБЛИКАЦИЯ =====
+
+    def publish(self, scope: str, key: Optional[str] = None):
+        """Сброс для других процессов (вызывается кэшами из любого потока)"""
+        with self._lock:
+            self._pending.append((scope, key))
+        self._wakeup.set()
+
+    def publish_trip_event(self, event_type: str, trip_id: int):
+        self.publish('trip_event', f"{event_type}:{trip_id}")
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self.db.publish_cache_invalidations(self.origin, pending)
+            self.stats['published'] += len(pending)
+        except Exception as e:
+            # Вернем в очередь: база могла быть занята - запишем при следующем проходе
+            self.stats['errors'] += 1
+            logger.error(f"❌ Ошибка записи сбросов кэшей: {e}")
+            with self._lock:
+                self._pending[:0] = pending
+
+    # ===== ПРИМЕНЕНИЕ =====
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            self._flush()
+            try:
+                self.poll()
+                if time.monotonic() - self._last_purge > self.purge_interval:
+                    self._last_purge = time.monotonic()
+                    self.db.purge_cache_invalidations(self.retention_seconds)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"❌ Ошибка чтения сбросов кэшей: {e}")
+
+    def poll(self) -> int:
+        """Применение новых сбросов других процессов; возвращает их число"""
+        applied = 0
+        while True:
+            rows = self.db.get_cache_invalidations(self._last_id)
+            if not rows:
+                return applied
+            for row in rows:
+                self._last_id = row['id']
+                if row['origin'] != self.origin:
+                    self.apply(row['scope'], row['key'])
+                    self.stats['applied'] += 1
+                    applied += 1
+
+    def apply(self, scope: str, key: Optional[str]):
+        if driver_cache.apply(scope, key) or reference_cache.apply(scope, key):
+            return
+        if scope == 'trip_event':
+            # Рейс перечитываем только если событие кому-то нужно (SSE веб-интерфейса)
+            if not trip_events.subscribers_count:
+                return
+            event_type, trip_id = key.split(':', 1)
+            trip = self.db.get_trip_for_report(int(trip_id))
+            trip_events.publish(event_type, int(trip_id), trip, forward=False)
+            return
+        logger.warning(f"⚠️ Неизвестный сброс кэша: {scope}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'origin': self.origin,
+            'last_id': self._last_id,
+            'pending': len(self._pending)
+        }
@@ -0,0 +1,301 @@
+# calendar_outbox.py - Фоновая отправка изменений в Google Calendar из очереди calendar_outbox
+
+import asyncio
+import logging
+import random
+import threading
+from typing import Dict, Any, Optional, Tuple, List
+
+from database import DatabaseManager
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Продолжительность события только что начатой поездки (1 минута для лучшего отображения)
+STARTED_EVENT_DURATION_HOURS = 0.017
+
+def build_calendar_event_data(trip: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Данные рейса и водителя (из get_trip_calendar_data) в формате GoogleCalendarManager"""
+    duration_hours = trip['trip_duration_hours']
+    trip_data = {
+        'id': trip['id'],
+        'waybill_number': trip['waybill_number'],
+        'vehicle_number': trip['vehicle_number'],
+        'route_number': trip['route_number'],
+        'route_name': trip['route_name'],
+        'quantity_delivered': trip['quantity_delivered'],
+        'duration_hours': round(duration_hours, 2) if duration_hours else STARTED_EVENT_DURATION_HOURS,
+        'started_at': trip['started_at'],
+        'completed_at': trip['completed_at']
+    }
+    user_data = {
+        'id': trip['user_id'],
+        'surname': trip['surname'],
+        'first_name': trip['first_name'],
+        'middle_name': trip['middle_name']
+    }
+    return trip_data, user_data
+
+class CalendarOutboxMetrics:
+    """Счетчики обработки очереди календаря (общие для процесса)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.api_calls = 0
+        self.calls_saved = 0
+        self.coalesced_mutations = 0
+
+    def record(self, api_calls: int = 0, calls_saved: int = 0, coalesced_mutations: int = 0):
+        with self._lock:
+            self.api_calls += api_calls
+            self.calls_saved += calls_saved
+            self.coalesced_mutations += coalesced_mutations
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'api_calls': self.api_calls,
+                'calls_saved': self.calls_saved,
+                'coalesced_mutations': self.coalesced_mutations
+            }
+
+# Глобальные счетчики процесса
+calendar_outbox_metrics = CalendarOutboxMetrics()
+
+class CalendarOutboxWorker:
+    """Асинхронный обработчик очереди изменений календаря.
+
+    Рейсы меняются только в SQLite: start_trip/complete_trip/delete_trip пишут
+    изменение календаря в calendar_outbox в той же транзакции. Обработчик
+    выбирает готовые записи, выполняет вызовы Google API в пуле потоков,
+    повторяет неудачные с экспоненциальной задержкой и записывает
+    calendar_event_id обратно в рейс.
+
+    Изменения одного рейса, накопившиеся за debounce_seconds, объединяются:
+    создание + обновления дают одно создание с актуальными данными, создание
+    удаленного рейса не отправляется вовсе. Удаления и обновления из одной
+    пачки отправляются batch-запросами Calendar API. Пока выключатель
+    GoogleCalendarManager разомкнут, изменения откладываются без расхода попыток.
+    """
+
+    def __init__(self, db: DatabaseManager, calendar_integration=None,
+                 poll_interval: float = 1.0, batch_size: int = 50, debounce_seconds: float = 10.0,
+                 max_attempts: int = 8, base_delay: float = 5.0, max_delay: float = 3600.0):
+        self.db = db
+        self.calendar_integration = calendar_integration
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.debounce_seconds = debounce_seconds
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    def _get_calendar(self):
+        """Интеграция календаря (по умолчанию - общая для процесса)"""
+        if self.calendar_integration is None:
+            from google_calendar import get_calendar_integration
+            self.calendar_integration = get_calendar_integration()
+        return self.calendar_integration
+
+    def backoff_delay(self, attempts: int) -> float:
+        """Экспоненциальная задержка перед повтором с разбросом ±20%"""
+        delay = min(self.base_delay * (2 ** (attempts - 1)), self.max_delay)
+        return delay * random.uniform(0.8, 1.2)
+
+    def notify(self):
+        """Разбудить обработчик (можно вызывать из любого потока)"""
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def stop(self):
+        """Остановка обработчика после текущей пачки"""
+        self._stopping = True
+        self.notify()
+
+    async def run(self):
+        """Основной цикл обработки очереди"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        logger.info("📤 Обработчик очереди Google Calendar запущен")
+
+        while not self._stopping:
+            try:
+                processed = await self.process_due()
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки очереди календаря: {e}")
+                processed = 0
+
+            # Полная пачка - сразу берем следующую
+            if processed >= self.batch_size:
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+        logger.info("📴 Обработчик очереди Google Calendar остановлен")
+
+    async def process_due(self) -> int:
+        """Обработка одной пачки готовых изменений.
+
+        Вся пачка - выборка из SQLite, вызовы Google API и отметки о
+        выполнении - идет в пуле потоков: цикл событий (бот и веб-сервер)
+        не ждет ни базу, ни сеть.
+        """
+        return await asyncio.to_thread(self._process_due)
+
+    def _process_due(self) -> int:
+        groups = self.db.get_due_calendar_mutation_groups(self.batch_size, self.debounce_seconds)
+        if groups:
+            self._process(groups)
+        return len(groups)
+
+    @staticmethod
+    def coalesce(mutations: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Объединение ожидающих изменений рейса в одно итоговое"""
+        operations = [m['operation'] for m in mutations]
+        result = dict(mutations[0])
+
+        if 'delete' in operations:
+            # После удаления рейса остальные изменения не имеют смысла
+            result['operation'] = 'delete'
+            result['calendar_event_id'] = [m for m in mutations if m['operation'] == 'delete'][-1]['calendar_event_id']
+        elif 'create' in operations:
+            # Создание читает актуальное состояние рейса и покрывает обновления
+            result['operation'] = 'create'
+        else:
+            result['operation'] = 'update'
+
+        return result
+
+    def _process(self, groups: List[List[Dict[str, Any]]]):
+        """Выполнение объединенных изменений рейсов с учетом повторов"""
+        mutations = [self.coalesce(group) for group in groups]
+
+        calendar = self._get_calendar()
+        if not calendar.enabled:
+            for group, mutation in zip(groups, mutations):
+                logger.info(f"ℹ️ Google Calendar отключен, изменение {mutation['operation']} рейса {mutation['trip_id']} пропущено")
+                self.db.complete_calendar_mutations([m['id'] for m in group])
+            return
+
+        retry_after = calendar.circuit_retry_after()
+        if retry_after > 0:
+            # Выключатель разомкнут: не тратим попытки, ждем его восстановления
+            self.db.postpone_calendar_mutations([group[0]['id'] for group in groups], retry_after)
+            logger.info(f"⏸️ Google Calendar недоступен, {len(groups)} изменений отложено на {retry_after:.0f}с")
+            return
+
+        try:
+            outcomes = self._apply_all(calendar, mutations)
+        except Exception as e:
+            outcomes = [(False, str(e), 1)] * len(mutations)
+
+        # Цепь разомкнулась во время пачки - неудачные изменения ждут ее восстановления
+        retry_after = calendar.circuit_retry_after()
+        postponed = []
+        for group, mutation, outcome in zip(groups, mutations, outcomes):
+            if not outcome[0] and retry_after > 0:
+                postponed.append(group[0]['id'])
+                continue
+            self._finish(group, mutation, *outcome)
+
+        if postponed:
+            self.db.postpone_calendar_mutations(postponed, retry_after)
+            logger.info(f"⏸️ Google Calendar недоступен, {len(postponed)} изменений отложено на {retry_after:.0f}с")
+
+    def _finish(self, group: List[Dict[str, Any]], mutation: Dict[str, Any],
+                success: bool, error: Optional[str], api_calls: int):
+        """Удаление выполненных изменений из очереди или планирование повтора"""
+        if success:
+            self.db.complete_calendar_mutations([m['id'] for m in group])
+            calendar_outbox_metrics.record(
+                api_calls=api_calls,
+                calls_saved=len(group) - api_calls,
+                coalesced_mutations=len(group) - 1
+            )
+            if len(group) > 1:
+                logger.info(f"🔗 Объединено {len(group)} изменений календаря рейса {mutation['trip_id']} в {mutation['operation']}")
+            return
+
+        calendar_outbox_metrics.record(api_calls=api_calls)
+        head = group[0]
+        attempts = head['attempts'] + 1
+        give_up = attempts >= self.max_attempts
+        delay = self.backoff_delay(attempts)
+        self.db.retry_calendar_mutation(head['id'], delay, error, give_up=give_up)
+
+        if give_up:
+            logger.error(f"❌ Изменение календаря {mutation['operation']} рейса {mutation['trip_id']} не выполнено после {attempts} попыток: {error}")
+        else:
+            logger.warning(f"⚠️ Изменение календаря {mutation['operation']} рейса {mutation['trip_id']} отложено на {delay:.0f}с (попытка {attempts}): {error}")
+
+    def _apply_all(self, calendar, mutations: List[Dict[str, Any]]) -> List[Tuple[bool, Optional[str], int]]:
+        """Вызовы Google Calendar API для пачки изменений.
+
+        Удаления и обновления существующих событий отправляются batch-запросами,
+        создания - по одному (нужно записать ID события в рейс).
+        Возвращает для каждого изменения (успех, ошибка, число вызовов API).
+        """
+        outcomes: List[Optional[Tuple[bool, Optional[str], int]]] = [None] * len(mutations)
+        deletes: Dict[str, int] = {}
+        updates: Dict[str, Tuple[int, Dict[str, Any], Dict[str, Any]]] = {}
+
+        for index, mutation in enumerate(mutations):
+            if mutation['operation'] == 'delete':
+                if mutation['calendar_event_id']:
+                    deletes[mutation['calendar_event_id']] = index
+                else:
+                    outcomes[index] = (True, None, 0)
+                continue
+
+            trip = self.db.get_trip_calendar_data(mutation['trip_id'])
+            if not trip:
+                # Рейс удален до отправки - создавать/обновлять нечего
+                outcomes[index] = (True, None, 0)
+            elif trip['calendar_event_id'] and mutation['operation'] == 'create':
+                outcomes[index] = (True, None, 0)
+            elif trip['calendar_event_id']:
+                updates[trip['calendar_event_id']] = (index, *build_calendar_event_data(trip))
+            else:
+                # Событие еще не создано (в т.ч. если создание ранее не удалось)
+                outcomes[index] = self._create_event(calendar, trip)
+
+        if len(deletes) == 1:
+            (event_id, index), = deletes.items()
+            results = {event_id: calendar.delete_trip_event_sync(event_id)}
+        else:
+            results = calendar.delete_trip_events_batch_sync(list(deletes)) if deletes else {}
+        for event_id, index in deletes.items():
+            outcomes[index] = (True, None, 1) if results.get(event_id) else (False, 'Не удалось удалить событие', 1)
+
+        if len(updates) == 1:
+            (event_id, (index, trip_data, user_data)), = updates.items()
+            results = {event_id: calendar.update_trip_event_sync(event_id, trip_data, user_data)}
+        else:
+            results = calendar.update_trip_events_batch_sync(
+                [(event_id, trip_data, user_data) for event_id, (_, trip_data, user_data) in updates.items()]
+            ) if updates else {}
+        for event_id, (index, _, _) in updates.items():
+            outcomes[index] = (True, None, 1) if results.get(event_id) else (False, 'Не удалось обновить событие', 1)
+
+        return outcomes
+
+    def _create_event(self, calendar, trip: Dict[str, Any]) -> Tuple[bool, Optional[str], int]:
+        """Создание события рейса и запись его ID в рейс"""
+        trip_data, user_data = build_calendar_event_data(trip)
+        event_id = calendar.create_trip_event_sync(trip_data, user_data)
+        if not event_id:
+            return False, 'Не удалось создать событие', 1
+
+        if not self.db.set_trip_calendar_event(trip['id'], event_id):
+            # Рейс удалили, пока создавалось событие
+            self.db.enqueue_calendar_mutation(trip['id'], 'delete', event_id)
+        logger.info(f"Создано событие в Google Calendar: {event_id}")
+        return True, None, 1
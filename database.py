@@ -1,14 +1,17 @@
 # database.py - Исправленная схема базы данных с отслеживанием времени поездок
 
 import sqlite3
-import hashlib
 import secrets
 import datetime
 import logging
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from dataclasses import dataclass
 from contextlib import contextmanager
 
+from driver_cache import driver_cache, MISS
+from reference_cache import reference_cache
+from password_hashing import hash_password, verify_password, password_hasher
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
@@ -138,6 +141,53 @@ class DatabaseManager:
                 )
             ''')
             
+            # Очередь изменений Google Calendar (пишется в одной транзакции с рейсом)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS calendar_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    trip_id INTEGER NOT NULL,
+                    operation TEXT NOT NULL CHECK (operation IN ('create', 'update', 'delete')),
+                    calendar_event_id TEXT,
+                    status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'failed')),
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Состояния диалогов Telegram бота (FSM), переживают перезапуск
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS fsm_sessions (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}',
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Закрепленные сообщения со статусом текущего рейса (режим TELEGRAM_LIVE_STATUS)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS trip_status_messages (
+                    user_id INTEGER PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+            
+            # Журнал сбросов кэшей: процессы бота и веб-сервер узнают об изменениях друг друга
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cache_invalidations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    origin TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    key TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
             # Таблица системных настроек
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS settings (
@@ -152,6 +202,12 @@ class DatabaseManager:
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_trips_user ON trips(user_id)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_trips_status ON trips(status)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram ON users(telegram_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_surname ON users(surname)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_trips_calendar_event ON trips(calendar_event_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calendar_outbox_due ON calendar_outbox(status, next_attempt_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_calendar_outbox_trip ON calendar_outbox(trip_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated ON fsm_sessions(updated_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created ON cache_invalidations(created_at)')
             
             conn.commit()
             
@@ -204,19 +260,12 @@ class DatabaseManager:
                 logger.info(f"Создан администратор по умолчанию. Логин: admin, Пароль: {admin_password}")
     
     def _hash_password(self, password: str) -> str:
-        """Хеширование пароля"""
-        salt = secrets.token_hex(16)
-        pwd_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-        return f"{salt}:{pwd_hash.hex()}"
+        """Хеширование пароля (в текущем потоке; из цикла событий - через password_hasher)"""
+        return hash_password(password)
     
     def verify_password(self, password: str, password_hash: str) -> bool:
         """Проверка пароля"""
-        try:
-            salt, stored_hash = password_hash.split(':')
-            pwd_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-            return pwd_hash.hex() == stored_hash
-        except:
-            return False
+        return verify_password(password, password_hash)
     
     def generate_password(self) -> str:
         """Генерация случайного пароля для водителя"""
@@ -243,31 +292,54 @@ class DatabaseManager:
             logger.info(f"Создан пользователь ID: {user_id}, Пароль: {password}")
             return user_id
     
-    def authenticate_user(self, surname: str, password: str) -> Optional[User]:
-        """Аутентификация пользователя"""
+    def _get_login_row(self, surname: str) -> Optional[sqlite3.Row]:
+        """Активный пользователь для входа по фамилии"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM users WHERE surname = ? AND is_active = 1
             ''', (surname,))
-            
-            row = cursor.fetchone()
-            if row and self.verify_password(password, row['password_hash']):
-                return User(
-                    id=row['id'],
-                    surname=row['surname'],
-                    first_name=row['first_name'],
-                    middle_name=row['middle_name'] or "",
-                    password_hash=row['password_hash'],
-                    role=row['role'],
-                    telegram_id=row['telegram_id'],
-                    is_active=row['is_active'],
-                    created_at=datetime.datetime.fromisoformat(row['created_at'])
-                )
-            return None
+            return cursor.fetchone()
+    
+    def _user_from_row(self, row: sqlite3.Row) -> User:
+        return User(
+            id=row['id'],
+            surname=row['surname'],
+            first_name=row['first_name'],
+            middle_name=row['middle_name'] or "",
+            password_hash=row['password_hash'],
+            role=row['role'],
+            telegram_id=row['telegram_id'],
+            is_active=row['is_active'],
+            created_at=datetime.datetime.fromisoformat(row['created_at'])
+        )
+    
+    def authenticate_user(self, surname: str, password: str) -> Optional[User]:
+        """Аутентификация пользователя"""
+        row = self._get_login_row(surname)
+        if row and self.verify_password(password, row['password_hash']):
+            return self._user_from_row(row)
+        return None
+    
+    async def authenticate_user_async(self, surname: str, password: str) -> Optional[User]:
+        """Аутентификация из цикла событий: проверка PBKDF2 идет в пуле password_hasher"""
+        row = self._get_login_row(surname)
+        if row and await password_hasher.verify(password, row['password_hash']):
+            return self._user_from_row(row)
+        return None
     
     def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
-        """Получение пользователя по Telegram ID"""
+        """Получение пользователя по Telegram ID (через кэш водителей)"""
+        cached = driver_cache.get_user(telegram_id)
+        if cached is not MISS:
+            return cached
+        
+        generation = driver_cache.generation
+        user = self._load_user_by_telegram_id(telegram_id)
+        driver_cache.put_user(telegram_id, user, generation)
+        return user
+    
+    def _load_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -296,7 +368,13 @@ class DatabaseManager:
             cursor.execute('''
                 UPDATE users SET telegram_id = ? WHERE id = ?
             ''', (telegram_id, user_id))
+            # Сообщение статуса рейса в прежнем чате больше не обновляется
+            cursor.execute('''
+                DELETE FROM trip_status_messages WHERE user_id = ? AND chat_id != ?
+            ''', (user_id, telegram_id))
             conn.commit()
+        driver_cache.invalidate_user(user_id)
+        driver_cache.invalidate_telegram(telegram_id)
     
     def get_all_users(self) -> List[User]:
         """Получение всех пользователей"""
@@ -329,7 +407,8 @@ class DatabaseManager:
                 VALUES (?, ?, ?)
             ''', (number, model, capacity))
             conn.commit()
-            return cursor.lastrowid
+        reference_cache.invalidate('vehicles')
+        return cursor.lastrowid
     
     def get_active_vehicles(self) -> List[Vehicle]:
         """Получение активных ТС"""
@@ -359,7 +438,8 @@ class DatabaseManager:
                 VALUES (?, ?, ?, ?)
             ''', (number, name, price, description))
             conn.commit()
-            return cursor.lastrowid
+        reference_cache.invalidate('routes')
+        return cursor.lastrowid
     
     def get_active_routes(self, include_price: bool = False) -> List[Route]:
         """Получение активных маршрутов"""
@@ -405,10 +485,11 @@ class DatabaseManager:
                 VALUES (?, ?, ?, ?, ?, ?, 'created')
             ''', (user_id, vehicle_id, route_id, waybill_number, quantity_delivered, trip_date))
             conn.commit()
-            return cursor.lastrowid
+        driver_cache.invalidate_user_trips(user_id)
+        return cursor.lastrowid
     
     def start_trip(self, trip_id: int, calendar_event_id: str = None) -> bool:
-        """Начало поездки"""
+        """Начало поездки (без calendar_event_id событие календаря ставится в очередь на создание)"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -416,11 +497,17 @@ class DatabaseManager:
                 SET status = 'started', started_at = CURRENT_TIMESTAMP, calendar_event_id = ?
                 WHERE id = ? AND status = 'created'
             ''', (calendar_event_id, trip_id))
+            started = cursor.rowcount > 0
+            
+            if started and not calendar_event_id:
+                self._enqueue_calendar_mutation(cursor, trip_id, 'create')
+            
             conn.commit()
-            return cursor.rowcount > 0
+        driver_cache.invalidate_trip(trip_id)
+        return started
     
     def complete_trip(self, trip_id: int) -> bool:
-        """Завершение поездки"""
+        """Завершение поездки (обновление события календаря ставится в очередь)"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -428,8 +515,14 @@ class DatabaseManager:
                 SET status = 'completed', completed_at = CURRENT_TIMESTAMP
                 WHERE id = ? AND status = 'started'
             ''', (trip_id,))
+            completed = cursor.rowcount > 0
+            
+            if completed:
+                self._enqueue_calendar_mutation(cursor, trip_id, 'update')
+            
             conn.commit()
-            return cursor.rowcount > 0
+        driver_cache.invalidate_trip(trip_id)
+        return completed
     
     def cancel_trip(self, trip_id: int) -> bool:
         """Отмена рейса"""
@@ -441,10 +534,21 @@ class DatabaseManager:
                 WHERE id = ? AND status IN ('created', 'started')
             ''', (trip_id,))
             conn.commit()
-            return cursor.rowcount > 0
+        driver_cache.invalidate_trip(trip_id)
+        return cursor.rowcount > 0
     
     def get_user_active_trip(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Получение активного рейса пользователя"""
+        """Получение активного рейса пользователя (через кэш водителей)"""
+        cached = driver_cache.get_active_trip(user_id)
+        if cached is not MISS:
+            return cached
+        
+        generation = driver_cache.generation
+        trip = self._load_user_active_trip(user_id)
+        driver_cache.put_active_trip(user_id, trip, generation)
+        return trip
+    
+    def _load_user_active_trip(self, user_id: int) -> Optional[Dict[str, Any]]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -464,42 +568,80 @@ class DatabaseManager:
                 return dict(row)
             return None
     
+    # JOIN для полей отчета по рейсам (подключаются только при необходимости)
+    TRIP_REPORT_JOINS = {
+        'u': 'JOIN users u ON t.user_id = u.id',
+        'v': 'JOIN vehicles v ON t.vehicle_id = v.id',
+        'r': 'JOIN routes r ON t.route_id = r.id'
+    }
+    
+    # Поля отчета по рейсам: поле -> (выражение SELECT, нужные JOIN).
+    # Значения полностью вычисляет SQLite: строка результата уже готова для отчета
+    TRIP_REPORT_FIELDS = {
+        'id': ('t.id', ()),
+        'user_id': ('t.user_id', ()),
+        'vehicle_id': ('t.vehicle_id', ()),
+        'route_id': ('t.route_id', ()),
+        'date': ('t.trip_date', ()),
+        'service_description': ("'Услуги грузоперевозки, маршрут №' || r.number", ('r',)),
+        'driver_name': ("u.surname || ' ' || u.first_name || COALESCE(' ' || NULLIF(u.middle_name, ''), '')", ('u',)),
+        'rate': ('r.price', ('r',)),
+        'vat_status': ("'Без НДС'", ()),
+        'total_amount': ('r.price', ('r',)),
+        'waybill_number': ('t.waybill_number', ()),
+        'quantity': ('t.quantity_delivered', ()),
+        'vehicle_number': ('v.number', ('v',)),
+        'vehicle_model': ('v.model', ('v',)),
+        'route_name': ('r.name', ('r',)),
+        'status': ('t.status', ()),
+        'started_at': ('t.started_at', ()),
+        'completed_at': ('t.completed_at', ()),
+        'duration_hours': ('''ROUND(NULLIF(CASE 
+                        WHEN t.started_at IS NOT NULL AND t.completed_at IS NOT NULL 
+                        THEN (julianday(t.completed_at) - julianday(t.started_at)) * 24 
+                        ELSE NULL 
+                    END, 0), 2)''', ())
+    }
+    
     def get_trips_for_report(self, start_date: datetime.date = None, 
                            end_date: datetime.date = None, 
                            status: str = None,
                            user_id: int = None,
                            vehicle_id: int = None,
-                           route_id: int = None) -> List[Dict[str, Any]]:
-        """Получение рейсов для отчета с фильтрами"""
+                           route_id: int = None,
+                           trip_id: int = None,
+                           fields: List[str] = None) -> List[Dict[str, Any]]:
+        """Получение рейсов для отчета с фильтрами.
+        
+        fields - список полей результата (по умолчанию все); в запрос попадают
+        только нужные столбцы и JOIN.
+        """
+        if fields is None:
+            fields = list(self.TRIP_REPORT_FIELDS)
+        else:
+            unknown = [f for f in fields if f not in self.TRIP_REPORT_FIELDS]
+            if unknown:
+                raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+            # Порядок полей как в полном отчете, без повторов
+            fields = [f for f in self.TRIP_REPORT_FIELDS if f in fields]
+        
+        columns = []
+        joins = {}
+        for field in fields:
+            expression, field_joins = self.TRIP_REPORT_FIELDS[field]
+            columns.append(f"{expression} AS {field}")
+            joins.update(dict.fromkeys(field_joins))
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            # Кортежи вместо sqlite3.Row: словарь рейса собирается из них одним zip
+            cursor.row_factory = None
             
-            query = '''
+            query = f'''
                 SELECT 
-                    t.id,
-                    t.trip_date,
-                    t.waybill_number,
-                    t.quantity_delivered,
-                    t.status,
-                    t.started_at,
-                    t.completed_at,
-                    u.surname,
-                    u.first_name,
-                    u.middle_name,
-                    v.number as vehicle_number,
-                    v.model as vehicle_model,
-                    r.number as route_number,
-                    r.name as route_name,
-                    r.price as route_price,
-                    CASE 
-                        WHEN t.started_at IS NOT NULL AND t.completed_at IS NOT NULL 
-                        THEN (julianday(t.completed_at) - julianday(t.started_at)) * 24 
-                        ELSE NULL 
-                    END as trip_duration_hours
+                    {', '.join(columns) or 't.id'}
                 FROM trips t
-                JOIN users u ON t.user_id = u.id
-                JOIN vehicles v ON t.vehicle_id = v.id
-                JOIN routes r ON t.route_id = r.id
+                {' '.join(self.TRIP_REPORT_JOINS[j] for j in self.TRIP_REPORT_JOINS if j in joins)}
                 WHERE 1=1
             '''
             
@@ -523,37 +665,20 @@ class DatabaseManager:
             if route_id:
                 query += ' AND t.route_id = ?'
                 params.append(route_id)
+            if trip_id:
+                query += ' AND t.id = ?'
+                params.append(trip_id)
                 
             query += ' ORDER BY t.trip_date DESC, t.id'
             
             cursor.execute(query, params)
             
-            trips = []
-            for row in cursor.fetchall():
-                full_name = f"{row['surname']} {row['first_name']}"
-                if row['middle_name']:
-                    full_name += f" {row['middle_name']}"
-                
-                trips.append({
-                    'id': row['id'],
-                    'date': row['trip_date'],
-                    'service_description': f"Услуги грузоперевозки, маршрут №{row['route_number']}",
-                    'driver_name': full_name,
-                    'rate': row['route_price'],
-                    'vat_status': 'Без НДС',
-                    'total_amount': row['route_price'],
-                    'waybill_number': row['waybill_number'],
-                    'quantity': row['quantity_delivered'],
-                    'vehicle_number': row['vehicle_number'],
-                    'vehicle_model': row['vehicle_model'],
-                    'route_name': row['route_name'],
-                    'status': row['status'],
-                    'started_at': row['started_at'],
-                    'completed_at': row['completed_at'],
-                    'duration_hours': round(row['trip_duration_hours'], 2) if row['trip_duration_hours'] else None
-                })
-            
-            return trips
+            return [dict(zip(fields, row)) for row in cursor.fetchall()]
+    
+    def get_trip_for_report(self, trip_id: int) -> Optional[Dict[str, Any]]:
+        """Получение одного рейса в формате отчета"""
+        trips = self.get_trips_for_report(trip_id=trip_id)
+        return trips[0] if trips else None
     
     # Методы для аналитики и отчетов
     def get_driver_statistics(self, start_date: datetime.date = None, end_date: datetime.date = None) -> List[Dict[str, Any]]:
@@ -720,6 +845,91 @@ class DatabaseManager:
             
             return stats
 
+    # Выражения группировки по периоду для временных рядов (ISO-неделя начинается с понедельника)
+    TIMESERIES_BUCKETS = {
+        'day': "t.trip_date",
+        'week': "date(t.trip_date, '-' || ((CAST(strftime('%w', t.trip_date) AS INTEGER) + 6) % 7) || ' days')",
+        'month': "strftime('%Y-%m', t.trip_date)"
+    }
+
+    # Ключ и подпись серии для каждого варианта группировки
+    TIMESERIES_GROUPS = {
+        'driver': ("u.id", "u.surname || ' ' || u.first_name", "JOIN users u ON t.user_id = u.id"),
+        'vehicle': ("v.id", "v.number", "JOIN vehicles v ON t.vehicle_id = v.id"),
+        'route': ("r.id", "'№' || r.number", ""),
+        'status': ("t.status", "t.status", "")
+    }
+
+    def get_trips_timeseries(self, start_date: datetime.date = None,
+                             end_date: datetime.date = None,
+                             bucket: str = 'day',
+                             group_by: str = None,
+                             status: str = None) -> List[Dict[str, Any]]:
+        """Агрегаты рейсов по периодам (день, неделя, месяц) одним сгруппированным запросом"""
+        if bucket not in self.TIMESERIES_BUCKETS:
+            raise ValueError(f"Неизвестный период группировки: {bucket}")
+        if group_by and group_by not in self.TIMESERIES_GROUPS:
+            raise ValueError(f"Неизвестная группировка: {group_by}")
+
+        period_expr = self.TIMESERIES_BUCKETS[bucket]
+        if group_by:
+            key_expr, label_expr, join_clause = self.TIMESERIES_GROUPS[group_by]
+        else:
+            key_expr, label_expr, join_clause = "NULL", "NULL", ""
+
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+
+            query = f'''
+                SELECT
+                    {period_expr} as period,
+                    {key_expr} as group_key,
+                    {label_expr} as group_label,
+                    COUNT(t.id) as total_trips,
+                    COUNT(CASE WHEN t.status = 'completed' THEN 1 END) as completed_trips,
+                    SUM(CASE WHEN t.status = 'completed' THEN r.price ELSE 0 END) as total_revenue,
+                    SUM(t.quantity_delivered) as total_quantity,
+                    AVG(CASE
+                        WHEN t.started_at IS NOT NULL AND t.completed_at IS NOT NULL
+                        THEN (julianday(t.completed_at) - julianday(t.started_at)) * 24
+                        ELSE NULL
+                    END) as avg_trip_duration_hours
+                FROM trips t
+                JOIN routes r ON t.route_id = r.id
+                {join_clause}
+                WHERE 1=1
+            '''
+
+            params = []
+            if start_date:
+                query += ' AND t.trip_date >= ?'
+                params.append(start_date)
+            if end_date:
+                query += ' AND t.trip_date <= ?'
+                params.append(end_date)
+            if status:
+                query += ' AND t.status = ?'
+                params.append(status)
+
+            query += ' GROUP BY period, group_key ORDER BY period, group_key'
+
+            cursor.execute(query, params)
+
+            points = []
+            for row in cursor.fetchall():
+                points.append({
+                    'period': row['period'],
+                    'group_key': row['group_key'],
+                    'group_label': row['group_label'],
+                    'trips': row['total_trips'] or 0,
+                    'completed_trips': row['completed_trips'] or 0,
+                    'revenue': row['total_revenue'] or 0,
+                    'quantity': row['total_quantity'] or 0,
+                    'avg_duration_hours': round(row['avg_trip_duration_hours'], 2) if row['avg_trip_duration_hours'] else 0
+                })
+
+            return points
+
     def reset_user_password(self, user_id: int) -> Optional[str]:
         """Сброс пароля пользователя на новый случайный"""
         try:
@@ -732,6 +942,7 @@ class DatabaseManager:
                     UPDATE users SET password_hash = ? WHERE id = ? AND role = 'driver'
                 ''', (password_hash, user_id))
                 conn.commit()
+                driver_cache.invalidate_user(user_id)
                 
                 if cursor.rowcount > 0:
                     logger.info(f"Пароль пользователя ID: {user_id} сброшен")
@@ -744,6 +955,38 @@ class DatabaseManager:
             logger.error(f"Ошибка сброса пароля пользователя {user_id}: {e}")
             return None
     
+    def reset_user_passwords(self, user_ids: List[int]) -> Dict[int, str]:
+        """Массовый сброс паролей водителей: хеши считаются параллельно в пуле, запись - одной транзакцией
+    
+        Возвращает новые пароли сброшенных водителей (user_id -> пароль)
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        try:
+            passwords = [self.generate_password() for _ in user_ids]
+            hashes = password_hasher.hash_many(passwords)
+    
+            reset = {}
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                for user_id, password, password_hash in zip(user_ids, passwords, hashes):
+                    cursor.execute('''
+                        UPDATE users SET password_hash = ? WHERE id = ? AND role = 'driver'
+                    ''', (password_hash, user_id))
+                    if cursor.rowcount > 0:
+                        reset[user_id] = password
+                conn.commit()
+    
+            for user_id in reset:
+                driver_cache.invalidate_user(user_id)
+            logger.info(f"Сброшены пароли {len(reset)} из {len(user_ids)} пользователей")
+            return reset
+    
+        except Exception as e:
+            logger.error(f"Ошибка массового сброса паролей: {e}")
+            return {}
+    
     def change_user_password(self, user_id: int, new_password: str) -> bool:
         """Изменение пароля пользователя на указанный"""
         try:
@@ -760,6 +1003,7 @@ class DatabaseManager:
                     UPDATE users SET password_hash = ? WHERE id = ? AND role = 'driver'
                 ''', (password_hash, user_id))
                 conn.commit()
+                driver_cache.invalidate_user(user_id)
                 
                 if cursor.rowcount > 0:
                     logger.info(f"Пароль пользователя ID: {user_id} изменен")
@@ -806,12 +1050,16 @@ class DatabaseManager:
                 
                 # Если принудительное удаление, удаляем связанные рейсы
                 if force and trips_count > 0:
+                    self._enqueue_calendar_deletes(cursor, 'user_id = ?', (user_id,))
                     cursor.execute('DELETE FROM trips WHERE user_id = ?', (user_id,))
                     logger.info(f"Удалено {trips_count} рейсов пользователя {user_id}")
                 
+                cursor.execute('DELETE FROM trip_status_messages WHERE user_id = ?', (user_id,))
+                
                 # Удаляем пользователя
                 cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
                 conn.commit()
+                driver_cache.invalidate_user(user_id)
                 
                 if cursor.rowcount > 0:
                     user_name = f"{user_row['surname']} {user_row['first_name']}"
@@ -855,12 +1103,16 @@ class DatabaseManager:
                 
                 # Если принудительное удаление, удаляем связанные рейсы
                 if force and trips_count > 0:
+                    self._enqueue_calendar_deletes(cursor, 'vehicle_id = ?', (vehicle_id,))
                     cursor.execute('DELETE FROM trips WHERE vehicle_id = ?', (vehicle_id,))
                     logger.info(f"Удалено {trips_count} рейсов ТС {vehicle_id}")
                 
                 # Удаляем ТС
                 cursor.execute('DELETE FROM vehicles WHERE id = ?', (vehicle_id,))
                 conn.commit()
+                reference_cache.invalidate('vehicles')
+                if force and trips_count > 0:
+                    driver_cache.invalidate_all_trips()
                 
                 if cursor.rowcount > 0:
                     vehicle_name = f"{vehicle_row['number']} ({vehicle_row['model']})"
@@ -904,12 +1156,16 @@ class DatabaseManager:
                 
                 # Если принудительное удаление, удаляем связанные рейсы
                 if force and trips_count > 0:
+                    self._enqueue_calendar_deletes(cursor, 'route_id = ?', (route_id,))
                     cursor.execute('DELETE FROM trips WHERE route_id = ?', (route_id,))
                     logger.info(f"Удалено {trips_count} рейсов маршрута {route_id}")
                 
                 # Удаляем маршрут
                 cursor.execute('DELETE FROM routes WHERE id = ?', (route_id,))
                 conn.commit()
+                reference_cache.invalidate('routes')
+                if force and trips_count > 0:
+                    driver_cache.invalidate_all_trips()
                 
                 if cursor.rowcount > 0:
                     route_name = f"№{route_row['number']} - {route_row['name']}"
@@ -956,24 +1212,16 @@ class DatabaseManager:
                 if trip_row['status'] == 'started':
                     return False, "Нельзя удалить активный рейс. Сначала завершите или отмените его."
                 
-                calendar_event_id = trip_row['calendar_event_id']
+                # Удаление события календаря ставим в очередь в той же транзакции
+                if cancel_calendar_event:
+                    self._enqueue_calendar_deletes(cursor, 'id = ?', (trip_id,))
                 
                 # Удаляем рейс
                 cursor.execute('DELETE FROM trips WHERE id = ?', (trip_id,))
                 conn.commit()
+                driver_cache.invalidate_trip(trip_id)
                 
                 if cursor.rowcount > 0:
-                    # Пытаемся удалить событие из календаря
-                    if calendar_event_id and cancel_calendar_event:
-                        try:
-                            from google_calendar import CalendarIntegration
-                            calendar_integration = CalendarIntegration(enabled=True)
-                            if calendar_integration.enabled:
-                                calendar_integration.delete_trip_event_sync(calendar_event_id)
-                                logger.info(f"Событие календаря {calendar_event_id} удалено")
-                        except Exception as e:
-                            logger.warning(f"Не удалось удалить событие календаря {calendar_event_id}: {e}")
-                    
                     trip_info = f"#{trip_row['waybill_number']} ({trip_row['surname']} {trip_row['first_name']})"
                     logger.info(f"Рейс {trip_info} (ID: {trip_id}) удален")
                     return True, f"Рейс {trip_info} успешно удален"
@@ -984,6 +1232,379 @@ class DatabaseManager:
             logger.error(f"Ошибка удаления рейса {trip_id}: {e}")
             return False, f"Ошибка удаления: {str(e)}"
     
+    # ===== СИСТЕМНЫЕ НАСТРОЙКИ =====
+    
+    def get_setting(self, key: str, default: str = None) -> Optional[str]:
+        """Получение системной настройки"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            return row['value'] if row else default
+    
+    def set_setting(self, key: str, value: Optional[str], description: str = None):
+        """Сохранение системной настройки (None - удаление)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if value is None:
+                cursor.execute('DELETE FROM settings WHERE key = ?', (key,))
+            else:
+                cursor.execute('''
+                    INSERT INTO settings (key, value, description) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                ''', (key, value, description))
+            conn.commit()
+    
+    # ===== СОСТОЯНИЯ ДИАЛОГОВ БОТА =====
+    
+    def get_fsm_session(self, key: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+        """Состояние и данные диалога (без сессий, простаивающих дольше ttl_seconds)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT state, data FROM fsm_sessions
+                WHERE key = ? AND updated_at >= datetime('now', ?)
+            ''', (key, f'-{int(ttl_seconds)} seconds'))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def save_fsm_sessions(self, upserts: List[Tuple[str, Optional[str], str]], deletes: List[str]):
+        """Запись пачки изменений диалогов одной транзакцией.
+        
+        upserts - список (key, state, data_json), deletes - ключи завершенных диалогов.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if upserts:
+                cursor.executemany('''
+                    INSERT INTO fsm_sessions (key, state, data, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(key) DO UPDATE SET
+                        state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                ''', upserts)
+            if deletes:
+                cursor.executemany('DELETE FROM fsm_sessions WHERE key = ?', [(key,) for key in deletes])
+            conn.commit()
+    
+    def purge_fsm_sessions(self, ttl_seconds: int) -> int:
+        """Удаление диалогов, простаивающих дольше ttl_seconds"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM fsm_sessions WHERE updated_at < datetime('now', ?)",
+                           (f'-{int(ttl_seconds)} seconds',))
+            conn.commit()
+            return cursor.rowcount
+    
+    # ===== СООБЩЕНИЯ СО СТАТУСОМ РЕЙСА =====
+    
+    def get_trip_status_message(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Чат и номер сообщения со статусом рейса водителя"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT chat_id, message_id FROM trip_status_messages WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def save_trip_status_message(self, user_id: int, chat_id: int, message_id: int):
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO trip_status_messages (user_id, chat_id, message_id, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    chat_id = excluded.chat_id, message_id = excluded.message_id, updated_at = excluded.updated_at
+            ''', (user_id, chat_id, message_id))
+            conn.commit()
+    
+    # ===== СБРОСЫ КЭШЕЙ МЕЖДУ ПРОЦЕССАМИ =====
+    
+    def publish_cache_invalidations(self, origin: str, events: List[Tuple[str, Optional[str]]]):
+        """Запись пачки сбросов кэшей процесса origin: список (scope, key)"""
+        with self.get_connection() as conn:
+            conn.executemany(
+                'INSERT INTO cache_invalidations (origin, scope, key) VALUES (?, ?, ?)',
+                [(origin, scope, key) for scope, key in events]
+            )
+            conn.commit()
+    
+    def get_cache_invalidations(self, after_id: int, limit: int = 1000) -> List[Dict[str, Any]]:
+        """Сбросы кэшей с id больше after_id (по порядку записи)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, origin, scope, key FROM cache_invalidations
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after_id, limit))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_last_cache_invalidation_id(self) -> int:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM cache_invalidations')
+            return cursor.fetchone()[0]
+    
+    def purge_cache_invalidations(self, ttl_seconds: int) -> int:
+        """Удаление сбросов старше ttl_seconds (их уже прочитали все процессы)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM cache_invalidations WHERE created_at < datetime('now', ?)",
+                           (f'-{int(ttl_seconds)} seconds',))
+            conn.commit()
+            return cursor.rowcount
+    
+    # ===== ОЧЕРЕДЬ ИЗМЕНЕНИЙ GOOGLE CALENDAR =====
+    
+    def _enqueue_calendar_mutation(self, cursor, trip_id: int, operation: str, calendar_event_id: str = None):
+        """Постановка изменения календаря в очередь (в транзакции вызывающего)"""
+        cursor.execute('''
+            INSERT INTO calendar_outbox (trip_id, operation, calendar_event_id)
+            VALUES (?, ?, ?)
+        ''', (trip_id, operation, calendar_event_id))
+    
+    def _enqueue_calendar_deletes(self, cursor, where: str, params: tuple):
+        """Постановка в очередь удаления событий календаря для удаляемых рейсов"""
+        cursor.execute(f'''
+            INSERT INTO calendar_outbox (trip_id, operation, calendar_event_id)
+            SELECT id, 'delete', calendar_event_id FROM trips
+            WHERE {where} AND calendar_event_id IS NOT NULL
+        ''', params)
+    
+    def enqueue_calendar_mutation(self, trip_id: int, operation: str, calendar_event_id: str = None) -> int:
+        """Постановка изменения календаря в очередь отдельной транзакцией"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._enqueue_calendar_mutation(cursor, trip_id, operation, calendar_event_id)
+            conn.commit()
+            return cursor.lastrowid
+    
+    def get_due_calendar_mutation_groups(self, limit: int = 20, min_age_seconds: int = 0) -> List[List[Dict[str, Any]]]:
+        """Готовые к отправке изменения календаря, сгруппированные по рейсам (одним запросом).
+        
+        Рейс попадает в выборку, только если самое раннее его ожидающее
+        изменение готово к отправке, - чтобы обновление не обогнало создание
+        события. Для каждого такого рейса возвращаются все его ожидающие
+        изменения по порядку. min_age_seconds - окно ожидания после
+        постановки в очередь (для объединения изменений рейса); limit -
+        число рейсов в пачке.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                WITH heads AS (
+                    SELECT o.id, o.trip_id FROM calendar_outbox o
+                    WHERE o.status = 'pending' AND o.next_attempt_at <= CURRENT_TIMESTAMP
+                      AND o.created_at <= datetime('now', ?)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM calendar_outbox p
+                          WHERE p.trip_id = o.trip_id AND p.status = 'pending' AND p.id < o.id
+                      )
+                    ORDER BY o.id
+                    LIMIT ?
+                )
+                SELECT m.* FROM heads h
+                JOIN calendar_outbox m ON m.trip_id = h.trip_id AND m.status = 'pending'
+                ORDER BY h.id, m.id
+            ''', (f'-{int(min_age_seconds)} seconds', limit))
+            groups: Dict[int, List[Dict[str, Any]]] = {}
+            for row in cursor.fetchall():
+                groups.setdefault(row['trip_id'], []).append(dict(row))
+            return list(groups.values())
+    
+    def complete_calendar_mutations(self, mutation_ids: List[int]):
+        """Удаление выполненных изменений из очереди"""
+        if not mutation_ids:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"DELETE FROM calendar_outbox WHERE id IN ({','.join('?' * len(mutation_ids))})",
+                mutation_ids
+            )
+            conn.commit()
+    
+    def retry_calendar_mutation(self, mutation_id: int, delay_seconds: float, error: str, give_up: bool = False):
+        """Отложенный повтор изменения (или пометка как окончательно неудачного)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE calendar_outbox
+                SET attempts = attempts + 1,
+                    status = ?,
+                    last_error = ?,
+                    next_attempt_at = datetime('now', ?)
+                WHERE id = ?
+            ''', ('failed' if give_up else 'pending', error, f'+{int(delay_seconds)} seconds', mutation_id))
+            conn.commit()
+    
+    def postpone_calendar_mutations(self, mutation_ids: List[int], delay_seconds: float):
+        """Перенос изменений на более позднее время без учета попытки (Google временно недоступен)"""
+        if not mutation_ids:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""UPDATE calendar_outbox SET next_attempt_at = datetime('now', ?)
+                    WHERE id IN ({','.join('?' * len(mutation_ids))})""",
+                (f'+{max(1, int(delay_seconds))} seconds', *mutation_ids)
+            )
+            conn.commit()
+    
+    def set_trip_calendar_event(self, trip_id: int, calendar_event_id: str) -> bool:
+        """Запись ID события календаря в рейс"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE trips SET calendar_event_id = ? WHERE id = ?', (calendar_event_id, trip_id))
+            conn.commit()
+        driver_cache.invalidate_trip(trip_id)
+        return cursor.rowcount > 0
+    
+    def get_trip_calendar_data(self, trip_id: int) -> Optional[Dict[str, Any]]:
+        """Данные рейса и водителя для события календаря"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT t.id, t.user_id, t.waybill_number, t.quantity_delivered, t.status,
+                       t.started_at, t.completed_at, t.calendar_event_id,
+                       u.surname, u.first_name, u.middle_name,
+                       v.number as vehicle_number,
+                       r.number as route_number, r.name as route_name,
+                       CASE 
+                           WHEN t.started_at IS NOT NULL AND t.completed_at IS NOT NULL 
+                           THEN (julianday(t.completed_at) - julianday(t.started_at)) * 24 
+                           ELSE NULL 
+                       END as trip_duration_hours
+                FROM trips t
+                JOIN users u ON t.user_id = u.id
+                JOIN vehicles v ON t.vehicle_id = v.id
+                JOIN routes r ON t.route_id = r.id
+                WHERE t.id = ?
+            ''', (trip_id,))
+            
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def get_trips_by_calendar_events(self, event_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Рейсы по ID событий календаря (по индексу idx_trips_calendar_event).
+        
+        pending - есть ли у рейса неотправленные изменения календаря.
+        """
+        if not event_ids:
+            return {}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            trips = {}
+            # Ограничение SQLite на число параметров запроса
+            for chunk_start in range(0, len(event_ids), 500):
+                chunk = event_ids[chunk_start:chunk_start + 500]
+                cursor.execute(f'''
+                    SELECT t.id, t.calendar_event_id,
+                           EXISTS (SELECT 1 FROM calendar_outbox o
+                                   WHERE o.trip_id = t.id AND o.status = 'pending') as pending
+                    FROM trips t
+                    WHERE t.calendar_event_id IN ({','.join('?' * len(chunk))})
+                ''', chunk)
+                for row in cursor.fetchall():
+                    trips[row['calendar_event_id']] = dict(row)
+            return trips
+    
+    def get_trips_with_calendar_events(self) -> Dict[str, Dict[str, Any]]:
+        """Все рейсы, связанные с событиями календаря"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT t.id, t.calendar_event_id,
+                       EXISTS (SELECT 1 FROM calendar_outbox o
+                               WHERE o.trip_id = t.id AND o.status = 'pending') as pending
+                FROM trips t
+                WHERE t.calendar_event_id IS NOT NULL
+            ''')
+            return {row['calendar_event_id']: dict(row) for row in cursor.fetchall()}
+    
+    def relink_trip_calendar_event(self, trip_id: int) -> bool:
+        """Сброс потерянного события рейса и постановка пересоздания в очередь"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE trips SET calendar_event_id = NULL WHERE id = ?', (trip_id,))
+            if cursor.rowcount == 0:
+                return False
+            self._enqueue_calendar_mutation(cursor, trip_id, 'create')
+            conn.commit()
+        driver_cache.invalidate_trip(trip_id)
+        return True
+    
+    def get_calendar_outbox_stats(self) -> Dict[str, Any]:
+        """Состояние очереди изменений календаря"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT 
+                    COUNT(CASE WHEN status = 'pending' THEN 1 END) as pending,
+                    COUNT(CASE WHEN status = 'failed' THEN 1 END) as failed,
+                    MIN(CASE WHEN status = 'pending' THEN created_at END) as oldest_pending_at
+                FROM calendar_outbox
+            ''')
+            return dict(cursor.fetchone())
+    
+    def get_drivers_trip_stats(self, user_ids: List[int] = None) -> Dict[int, Dict[str, Any]]:
+        """Статистика рейсов для всех водителей (или списка ID) одним сгруппированным запросом"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            query = '''
+                SELECT 
+                    u.id,
+                    COUNT(t.id) as total_trips,
+                    COUNT(CASE WHEN t.status = 'completed' THEN 1 END) as completed_trips,
+                    COUNT(CASE WHEN t.status = 'started' THEN 1 END) as active_trips,
+                    COUNT(CASE WHEN t.status = 'cancelled' THEN 1 END) as cancelled_trips,
+                    MAX(t.trip_date) as last_trip_date
+                FROM users u
+                LEFT JOIN trips t ON u.id = t.user_id
+                WHERE u.role = 'driver'
+            '''
+            
+            params = []
+            if user_ids is not None:
+                if not user_ids:
+                    return {}
+                query += f" AND u.id IN ({','.join('?' * len(user_ids))})"
+                params.extend(user_ids)
+            
+            query += ' GROUP BY u.id'
+            
+            cursor.execute(query, params)
+            
+            stats = {}
+            for row in cursor.fetchall():
+                stats[row['id']] = {
+                    'total_trips': row['total_trips'],
+                    'completed_trips': row['completed_trips'],
+                    'active_trips': row['active_trips'],
+                    'cancelled_trips': row['cancelled_trips'],
+                    'last_trip_date': row['last_trip_date']
+                }
+            
+            return stats
+    
+    def get_driver_telegram_ids(self, user_ids: List[int] = None) -> List[int]:
+        """Telegram ID активных водителей, привязавших бота (всех или из списка ID)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            query = '''
+                SELECT telegram_id FROM users
+                WHERE role = 'driver' AND is_active = 1 AND telegram_id IS NOT NULL
+            '''
+            
+            params = []
+            if user_ids is not None:
+                if not user_ids:
+                    return []
+                query += f" AND id IN ({','.join('?' * len(user_ids))})"
+                params.extend(user_ids)
+            
+            cursor.execute(query, params)
+            return [row['telegram_id'] for row in cursor.fetchall()]
+    
     def get_user_info(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получение подробной информации о пользователе"""
         try:
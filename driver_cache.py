@@ -0,0 +1,176 @@
+# driver_cache.py - Кэш водителей бота: telegram_id -> пользователь и его активный рейс
+
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional, Tuple, Callable
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Признак отсутствия записи в кэше (None - это закэшированное «нет пользователя/рейса»)
+MISS = object()
+
+class DriverCache:
+    """Общий для процесса кэш идентификации водителей и их активных рейсов.
+
+    Заполняется при чтении (DatabaseManager.get_user_by_telegram_id и
+    get_user_active_trip) и сбрасывается методами, которые меняют
+    пользователей и рейсы. Бот и веб-сервер работают в разных потоках и с
+    разными DatabaseManager, поэтому кэш - один на процесс и защищен
+    блокировкой. Чтобы не записать в кэш данные, прочитанные до
+    параллельного изменения, запись принимается, только если с начала
+    чтения не было сбросов (счетчик generation). Срок жизни записей
+    ограничивает устаревание при изменениях базы из других процессов; если
+    бот запущен несколькими процессами, сбросы передаются между ними через
+    publisher (см. cache_sync.CacheInvalidationChannel).
+    """
+
+    def __init__(self, ttl_seconds: float = 60.0):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._users: Dict[int, Tuple[Any, float]] = {}
+        self._telegram_by_user: Dict[int, int] = {}
+        self._trips: Dict[int, Tuple[Optional[Dict[str, Any]], float]] = {}
+        self._user_by_trip: Dict[int, int] = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        # Получатель сбросов для других процессов: publisher(scope, key)
+        self.publisher: Optional[Callable[[str, Optional[str]], None]] = None
+
+    def _fresh(self, entry: Optional[Tuple[Any, float]]) -> Any:
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return MISS
+        self.hits += 1
+        return entry[0]
+
+    # ===== ПОЛЬЗОВАТЕЛИ =====
+
+    def get_user(self, telegram_id: int) -> Any:
+        """Пользователь по telegram_id, None (точно нет) или MISS"""
+        with self._lock:
+            return self._fresh(self._users.get(telegram_id))
+
+    def put_user(self, telegram_id: int, user, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._users[telegram_id] = (user, time.monotonic() + self.ttl_seconds)
+            if user is not None:
+                self._telegram_by_user[user.id] = telegram_id
+
+    # ===== АКТИВНЫЕ РЕЙСЫ =====
+
+    def get_active_trip(self, user_id: int) -> Any:
+        """Копия активного рейса пользователя, None (рейса нет) или MISS"""
+        with self._lock:
+            trip = self._fresh(self._trips.get(user_id))
+            return dict(trip) if isinstance(trip, dict) else trip
+
+    def put_active_trip(self, user_id: int, trip: Optional[Dict[str, Any]], generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._trips[user_id] = (dict(trip) if trip else None, time.monotonic() + self.ttl_seconds)
+            if trip:
+                self._user_by_trip[trip['id']] = user_id
+
+    # ===== СБРОС =====
+
+    def invalidate_user(self, user_id: int, publish: bool = True):
+        """Изменен пользователь (вход через бота, блокировка, удаление, пароль)"""
+        with self._lock:
+            self.generation += 1
+            telegram_id = self._telegram_by_user.pop(user_id, None)
+            if telegram_id is not None:
+                self._users.pop(telegram_id, None)
+            # Отрицательные записи без user_id (например, у заблокированного водителя) тоже сбрасываем
+            self._users = {key: entry for key, entry in self._users.items() if entry[0] is not None}
+            self._drop_trip(user_id)
+        self._publish('user', user_id, publish)
+
+    def invalidate_telegram(self, telegram_id: int, publish: bool = True):
+        """Изменилась привязка Telegram ID (в т.ч. закэшированное «не найден»)"""
+        with self._lock:
+            self.generation += 1
+            entry = self._users.pop(telegram_id, None)
+            if entry and entry[0] is not None:
+                self._telegram_by_user.pop(entry[0].id, None)
+        self._publish('telegram', telegram_id, publish)
+
+    def invalidate_user_trips(self, user_id: int, publish: bool = True):
+        """У пользователя создан рейс"""
+        with self._lock:
+            self.generation += 1
+            self._drop_trip(user_id)
+        self._publish('user_trips', user_id, publish)
+
+    def invalidate_trip(self, trip_id: int, publish: bool = True):
+        """Изменился статус рейса или рейс удален"""
+        with self._lock:
+            self.generation += 1
+            user_id = self._user_by_trip.get(trip_id)
+            if user_id is not None:
+                self._drop_trip(user_id)
+        self._publish('trip', trip_id, publish)
+
+    def invalidate_all_trips(self, publish: bool = True):
+        """Массовое удаление рейсов (удаление ТС или маршрута с рейсами)"""
+        with self._lock:
+            self.generation += 1
+            self._trips.clear()
+            self._user_by_trip.clear()
+        self._publish('all_trips', None, publish)
+
+    def clear(self, publish: bool = True):
+        with self._lock:
+            self.generation += 1
+            self._users.clear()
+            self._telegram_by_user.clear()
+            self._trips.clear()
+            self._user_by_trip.clear()
+        self._publish('drivers', None, publish)
+
+    # ===== СБРОСЫ ИЗ ДРУГИХ ПРОЦЕССОВ =====
+
+    def _publish(self, scope: str, key: Optional[int], publish: bool):
+        publisher = self.publisher
+        if publish and publisher is not None:
+            publisher(scope, None if key is None else str(key))
+
+    def apply(self, scope: str, key: Optional[str]) -> bool:
+        """Сброс, пришедший из другого процесса (без повторной публикации); False - чужая область"""
+        handlers = {
+            'user': self.invalidate_user,
+            'telegram': self.invalidate_telegram,
+            'user_trips': self.invalidate_user_trips,
+            'trip': self.invalidate_trip
+        }
+        if scope in handlers:
+            handlers[scope](int(key), publish=False)
+        elif scope == 'all_trips':
+            self.invalidate_all_trips(publish=False)
+        elif scope == 'drivers':
+            self.clear(publish=False)
+        else:
+            return False
+        return True
+
+    def _drop_trip(self, user_id: int):
+        entry = self._trips.pop(user_id, None)
+        if entry and entry[0]:
+            self._user_by_trip.pop(entry[0]['id'], None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'users': len(self._users),
+                'active_trips': len(self._trips),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+# Глобальный кэш процесса
+driver_cache = DriverCache()
@@ -0,0 +1,191 @@
+# driver_swarm_benchmark.py - Нагрузочный тест бота: толпа водителей проходит рейс от входа до завершения
+
+import os
+import time
+import random
+import asyncio
+import logging
+import secrets
+import argparse
+import tempfile
+from typing import Dict, Any, List, Tuple
+
+from fake_telegram_api import FakeTelegramBackend, create_fake_telegram_app
+from bot_latency_benchmark import start_server, start_bot, stop_bot, percentile, _server_loop, FAKE_TOKEN
+
+# Настройка логирования
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Пароль всех тестовых водителей
+DRIVER_PASSWORD = 'swarm-password'
+
+# Шаги сценария: (шаг, сообщение водителя, начало ожидаемого ответа бота)
+def driver_scenario(driver: Dict[str, Any]) -> List[Tuple[str, str, str]]:
+    return [
+        ('start', '/start', '🚛 Добро пожаловать'),
+        ('login', driver['surname'], 'Фамилия'),
+        ('password', DRIVER_PASSWORD, '✅ Авторизация успешна'),
+        ('create', '➕ Создать рейс', '🚛 Создание нового рейса'),
+        ('vehicle', driver['vehicle'], '✅ Выбрано ТС'),
+        ('waybill', driver['waybill'], '✅ Путевой лист'),
+        ('route', driver['route'], '✅ Выбран маршрут'),
+        ('quantity', str(driver['quantity']), '📋 Подтверждение рейса'),
+        ('confirm', '✅ Подтвердить', '✅ Рейс #'),
+        ('start_trip', '🚀 Начать поездку', '🚀 Поездка начата'),
+        ('complete', '🏁 Завершить поездку', '🏁 Поездка завершена'),
+    ]
+
+def prepare_database(db, drivers: int, vehicles: int, routes: int) -> List[Dict[str, Any]]:
+    """Водители, ТС и маршруты для прогона (хеш пароля считается один раз)"""
+    vehicle_numbers = [f'Н{i:03d}ГР' for i in range(vehicles)]
+    route_numbers = [str(100 + i) for i in range(routes)]
+    for number in vehicle_numbers:
+        db.create_vehicle(number, 'Нагрузочный')
+    for number in route_numbers:
+        db.create_route(number, f'Маршрут {number}', 1000)
+
+    password_hash = db._hash_password(DRIVER_PASSWORD)
+    surnames = [f'Нагрузка{i:05d}' for i in range(drivers)]
+    with db.get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (surname, first_name, password_hash, role) VALUES (?, 'Водитель', ?, 'driver')",
+            [(surname, password_hash) for surname in surnames]
+        )
+        conn.commit()
+
+    return [
+        {
+            'chat_id': 500000 + i,
+            'surname': surname,
+            'vehicle': random.choice(vehicle_numbers),
+            'route': f"№{random.choice(route_numbers)}",
+            'waybill': f'{random.randint(100000, 999999)}',
+            'quantity': random.randint(1, 500)
+        }
+        for i, surname in enumerate(surnames)
+    ]
+
+async def run_driver(driver: Dict[str, Any], backend: FakeTelegramBackend, api_loop: asyncio.AbstractEventLoop,
+                     delay: float, timeout: float, think_time: float, results: Dict[str, Dict[str, Any]]):
+    """Один водитель: шаги сценария по очереди, каждый следующий - после ответа бота"""
+    await asyncio.sleep(delay)
+    for step, text, expected in driver_scenario(driver):
+        future = asyncio.run_coroutine_threadsafe(
+            backend.send_message(driver['chat_id'], text, timeout=timeout), api_loop
+        )
+        result = await asyncio.wrap_future(future)
+        stats = results[step]
+
+        if result['latency_ms'] is None:
+            stats['lost'] += 1
+            return  # Без ответа дальше идти нельзя: бот мог не сменить состояние
+        stats['latencies'].append(result['latency_ms'])
+        reply = (result['reply'] or {}).get('text', '')
+        if not reply.startswith(expected):
+            stats['errors'] += 1
+            if not stats['sample_error']:
+                stats['sample_error'] = reply[:120]
+            return
+        if think_time:
+            await asyncio.sleep(random.uniform(0, think_time))
+
+async def start_cluster(mode: str, db_path: str, workers: int, base_port: int, api_url: str, web_url: str):
+    """Бот из нескольких процессов (bot_cluster): (диспетчер, задача получения обновлений)"""
+    from bot_cluster import BotCluster
+    from web_app import register_telegram_webhook, TELEGRAM_WEBHOOK_PATH
+
+    cluster = BotCluster(FAKE_TOKEN, db_path, workers, base_port=base_port, api_url=api_url)
+    if not await cluster.start():
+        raise RuntimeError("Процессы бота не запустились")
+    if mode == 'webhook':
+        register_telegram_webhook(cluster)
+        task = asyncio.create_task(cluster.run_webhook(web_url + TELEGRAM_WEBHOOK_PATH, secrets.token_urlsafe(32)))
+    else:
+        task = asyncio.create_task(cluster.run_polling(timeout=1))
+    await asyncio.sleep(0.5)
+    return cluster, task
+
+async def stop_cluster(mode: str, cluster, task: asyncio.Task):
+    from web_app import register_telegram_webhook
+
+    await cluster.stop()
+    await task
+    if mode == 'webhook':
+        register_telegram_webhook(None)
+
+async def benchmark(args):
+    from database import DatabaseManager
+
+    backend = FakeTelegramBackend(latency=args.api_latency)
+    api_server = start_server(create_fake_telegram_app(backend), args.api_port)
+    api_loop = await asyncio.to_thread(lambda: _server_loop(api_server))
+
+    web_url = f'http://127.0.0.1:{args.web_port}'
+    if args.mode == 'webhook':
+        from web_app import app
+        start_server(app, args.web_port)
+
+    db = DatabaseManager(args.db or os.path.join(tempfile.mkdtemp(), 'swarm.db'))
+    drivers = prepare_database(db, args.drivers, args.vehicles, args.routes)
+
+    api_url = f'http://127.0.0.1:{args.api_port}'
+    if args.workers > 1:
+        bot, task = await start_cluster(args.mode, db.db_path, args.workers, args.worker_port, api_url, web_url)
+    else:
+        bot, task = await start_bot(args.mode, db, api_url, web_url)
+
+    steps = [step for step, _, _ in driver_scenario(drivers[0])]
+    results = {step: {'latencies': [], 'errors': 0, 'lost': 0, 'sample_error': None} for step in steps}
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_driver(driver, backend, api_loop, args.ramp * i / len(drivers), args.timeout, args.think_time, results)
+        for i, driver in enumerate(drivers)
+    ))
+    elapsed = time.perf_counter() - started
+
+    if args.workers > 1:
+        await stop_cluster(args.mode, bot, task)
+    else:
+        await stop_bot(args.mode, bot, task)
+
+    answered = sum(len(r['latencies']) for r in results.values())
+    completed = len(results['complete']['latencies']) - results['complete']['errors']
+    print(f"\n📊 Нагрузочный тест бота: {args.drivers} водителей, режим {args.mode}, процессов {args.workers}, "
+          f"разгон {args.ramp:.0f} с, задержка API {args.api_latency * 1000:.0f} мс")
+    print(f"{'шаг':<12}{'ответов':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'макс':>9}{'ошибок':>8}{'потеряно':>10}")
+    for step in steps:
+        r = results[step]
+        latencies = sorted(r['latencies'])
+        if not latencies:
+            print(f"{step:<12}{0:>9}{'-':>9}{'-':>9}{'-':>9}{'-':>9}{r['errors']:>8}{r['lost']:>10}")
+            continue
+        print(f"{step:<12}{len(latencies):>9}{percentile(latencies, 0.50):>9.1f}{percentile(latencies, 0.95):>9.1f}"
+              f"{percentile(latencies, 0.99):>9.1f}{latencies[-1]:>9.1f}{r['errors']:>8}{r['lost']:>10}")
+    print(f"\nРейсов завершено: {completed} из {args.drivers} за {elapsed:.1f} с")
+    print(f"Пропускная способность: {answered / elapsed:.1f} обновлений/с")
+    for step in steps:
+        if results[step]['sample_error']:
+            print(f"⚠️ Пример неожиданного ответа на шаге {step}: {results[step]['sample_error']!r}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота: водители проходят вход -> рейс -> начало -> завершение")
+    parser.add_argument('--drivers', type=int, default=200, help="Водителей, работающих одновременно")
+    parser.add_argument('--ramp', type=float, default=5.0, help="За сколько секунд подключаются все водители")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Максимальная пауза водителя между шагами, с")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Ожидание ответа бота на шаг, с")
+    parser.add_argument('--vehicles', type=int, default=50)
+    parser.add_argument('--routes', type=int, default=20)
+    parser.add_argument('--mode', default='polling', choices=['polling', 'webhook'])
+    parser.add_argument('--workers', type=int, default=1, help="Процессов бота (больше 1 - bot_cluster)")
+    parser.add_argument('--worker-port', type=int, default=8100, help="Первый порт процессов бота")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Задержка ответа Bot API, с")
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--web-port', type=int, default=8082)
+    parser.add_argument('--db', help="Файл базы (по умолчанию - временный)")
+    asyncio.run(benchmark(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# fake_google_calendar.py - Локальная замена Google Calendar API v3 для тестов и нагрузочных прогонов
+
+import re
+import json
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from copy import deepcopy
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from fastapi import FastAPI, Request, Response
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Пути Calendar API, которые поддерживает заглушка
+CALENDAR_PATH = re.compile(r'^/calendar/v3/calendars/(?P<calendar_id>[^/]+)$')
+EVENTS_PATH = re.compile(r'^/calendar/v3/calendars/(?P<calendar_id>[^/]+)/events$')
+EVENT_PATH = re.compile(r'^/calendar/v3/calendars/(?P<calendar_id>[^/]+)/events/(?P<event_id>[^/]+)$')
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def _error(code: int, message: str, reason: str) -> Tuple[int, Dict[str, Any]]:
+    return code, {'error': {'code': code, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+
+def _merge(target: Dict[str, Any], patch: Dict[str, Any]):
+    """Слияние объектов по правилам PATCH (вложенные объекты сливаются, остальное заменяется)"""
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = deepcopy(value)
+
+class FakeCalendarBackend:
+    """Хранилище событий и обработка вызовов Calendar API в памяти.
+
+    Каждое изменение получает порядковый номер; sync token - номер последнего
+    изменения, выданного клиенту. Удаленные события остаются с
+    status='cancelled', чтобы их можно было вернуть в списке изменений.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Очистка событий и счетчиков"""
+        with self._lock:
+            self.events: Dict[str, Dict[str, Dict[str, Any]]] = {}
+            self.sequence = 0
+            self.calls: Dict[str, int] = {}
+            self.injected_errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'injected_errors': self.injected_errors,
+                'events': sum(1 for calendar in self.events.values()
+                              for event in calendar.values() if event['status'] != 'cancelled'),
+                'sequence': self.sequence
+            }
+
+    def _count(self, operation: str):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _inject_error(self) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Случайная ошибка с вероятностью error_rate"""
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.injected_errors += 1
+            if self._random.random() < 0.5:
+                return _error(429, 'Rate Limit Exceeded', 'rateLimitExceeded')
+            return _error(503, 'Backend Error', 'backendError')
+        return None
+
+    def _touch(self, event: Dict[str, Any]):
+        self.sequence += 1
+        event['_sequence'] = self.sequence
+        event['updated'] = _now()
+        event['etag'] = f'"{self.sequence}"'
+
+    @staticmethod
+    def _public(event: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in event.items() if not key.startswith('_')}
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: Optional[Dict[str, Any]]) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """Обработка одного вызова API: (HTTP-статус, JSON-ответ)"""
+        with self._lock:
+            error = self._inject_error()
+            if error:
+                self._count('injected_error')
+                return error
+
+            match = EVENT_PATH.match(path)
+            if match:
+                return self._event(method, unquote(match['calendar_id']), unquote(match['event_id']), body)
+
+            match = EVENTS_PATH.match(path)
+            if match:
+                calendar_id = unquote(match['calendar_id'])
+                if method == 'POST':
+                    return self._insert(calendar_id, body or {})
+                if method == 'GET':
+                    return self._list(calendar_id, query)
+
+            match = CALENDAR_PATH.match(path)
+            if match and method == 'GET':
+                self._count('calendars.get')
+                calendar_id = unquote(match['calendar_id'])
+                return 200, {
+                    'kind': 'calendar#calendar',
+                    'id': 'fake@example.com' if calendar_id == 'primary' else calendar_id,
+                    'summary': 'Fake Calendar',
+                    'timeZone': 'Europe/Riga'
+                }
+
+            return _error(404, f'Not Found: {method} {path}', 'notFound')
+
+    def _insert(self, calendar_id: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        self._count('events.insert')
+        event = deepcopy(body)
+        event_id = event.get('id') or uuid.uuid4().hex
+        event.update({
+            'kind': 'calendar#event',
+            'id': event_id,
+            'status': 'confirmed',
+            'created': _now(),
+            'htmlLink': f'https://calendar.example.com/event?eid={event_id}'
+        })
+        self._touch(event)
+        self.events.setdefault(calendar_id, {})[event_id] = event
+        return 200, self._public(event)
+
+    def _event(self, method: str, calendar_id: str, event_id: str, body: Optional[Dict[str, Any]]) -> Tuple[int, Optional[Dict[str, Any]]]:
+        event = self.events.get(calendar_id, {}).get(event_id)
+
+        if method == 'GET':
+            self._count('events.get')
+            if not event:
+                return _error(404, 'Not Found', 'notFound')
+            return 200, self._public(event)
+
+        if method == 'DELETE':
+            self._count('events.delete')
+            if not event:
+                return _error(404, 'Not Found', 'notFound')
+            if event['status'] == 'cancelled':
+                return _error(410, 'Resource has been deleted', 'deleted')
+            event['status'] = 'cancelled'
+            self._touch(event)
+            return 204, None
+
+        if method in ('PUT', 'PATCH'):
+            self._count('events.update' if method == 'PUT' else 'events.patch')
+            if not event:
+                return _error(404, 'Not Found', 'notFound')
+            if method == 'PUT':
+                keep = {key: event[key] for key in ('kind', 'id', 'created', 'htmlLink') if key in event}
+                event.clear()
+                event.update(deepcopy(body or {}))
+                event.update(keep)
+                event.setdefault('status', 'confirmed')
+            else:
+                _merge(event, body or {})
+            self._touch(event)
+            return 200, self._public(event)
+
+        return _error(405, 'Method Not Allowed', 'methodNotAllowed')
+
+    def _list(self, calendar_id: str, query: Dict[str, str]) -> Tuple[int, Dict[str, Any]]:
+        self._count('events.list')
+        events = sorted(self.events.get(calendar_id, {}).values(), key=lambda e: e['_sequence'])
+
+        sync_token = query.get('syncToken')
+        if sync_token:
+            if not sync_token.isdigit() or int(sync_token) > self.sequence:
+                return _error(410, 'Sync token is no longer valid, a full sync is required.', 'fullSyncRequired')
+            events = [e for e in events if e['_sequence'] > int(sync_token)]
+        elif query.get('showDeleted', 'false').lower() != 'true':
+            events = [e for e in events if e['status'] != 'cancelled']
+
+        max_results = int(query.get('maxResults', 250))
+        offset = int(query.get('pageToken', 0))
+        page = events[offset:offset + max_results]
+
+        response = {
+            'kind': 'calendar#events',
+            'summary': 'Fake Calendar',
+            'items': [self._public(e) for e in page]
+        }
+        if offset + max_results < len(events):
+            response['nextPageToken'] = str(offset + max_results)
+        else:
+            response['nextSyncToken'] = str(self.sequence)
+        return 200, response
+
+    async def delay(self):
+        """Искусственная задержка ответа"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+def _parse_http_request(raw: bytes) -> Tuple[str, str, Dict[str, str], Optional[Dict[str, Any]]]:
+    """Разбор HTTP-запроса из части batch-запроса"""
+    head, _, body = raw.replace(b'\r\n', b'\n').partition(b'\n\n')
+    request_line = head.split(b'\n', 1)[0].decode()
+    method, url = request_line.split(' ')[:2]
+    parts = urlsplit(url)
+    query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+    payload = json.loads(body) if body.strip() else None
+    return method, parts.path, query, payload
+
+def _status_line(status: int) -> str:
+    reasons = {200: 'OK', 204: 'No Content', 404: 'Not Found', 405: 'Method Not Allowed',
+               410: 'Gone', 429: 'Too Many Requests', 503: 'Service Unavailable'}
+    return f"HTTP/1.1 {status} {reasons.get(status, 'Error')}"
+
+def create_fake_calendar_app(backend: FakeCalendarBackend = None) -> FastAPI:
+    """FastAPI-приложение, имитирующее используемую часть Calendar API v3"""
+    backend = backend or FakeCalendarBackend()
+    app = FastAPI(title="Fake Google Calendar")
+    app.state.backend = backend
+
+    def _json_response(status: int, payload: Optional[Dict[str, Any]]) -> Response:
+        if payload is None:
+            return Response(status_code=status)
+        return Response(json.dumps(payload, ensure_ascii=False), status_code=status,
+                        media_type='application/json; charset=UTF-8')
+
+    @app.get("/fake/stats")
+    async def fake_stats():
+        return backend.stats()
+
+    @app.post("/fake/reset")
+    async def fake_reset():
+        backend.reset()
+        return {'success': True}
+
+    @app.post("/batch/calendar/v3")
+    async def batch(request: Request):
+        await backend.delay()
+        backend._count('batch')
+        content_type = request.headers.get('content-type', '')
+        raw = await request.body()
+        message = BytesParser(policy=HTTP).parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + raw)
+
+        boundary = f'batch_{uuid.uuid4().hex}'
+        chunks = []
+        for part in message.iter_parts():
+            content_id = part['Content-ID'] or ''
+            method, path, query, payload = _parse_http_request(part.get_payload(decode=True))
+            status, result = backend.handle(method, path, query, payload)
+            body = json.dumps(result, ensure_ascii=False) if result is not None else ''
+            chunks.append(
+                f'--{boundary}\r\n'
+                f'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id.strip("<>")}>\r\n\r\n'
+                f'{_status_line(status)}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                f'{body}\r\n'
+            )
+        chunks.append(f'--{boundary}--\r\n')
+        return Response(''.join(chunks).encode('utf-8'), media_type=f'multipart/mixed; boundary={boundary}')
+
+    @app.api_route("/calendar/v3/{path:path}", methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+    async def calendar_api(path: str, request: Request):
+        await backend.delay()
+        raw = await request.body()
+        payload = json.loads(raw) if raw.strip() else None
+        status, result = backend.handle(request.method, request.url.path, dict(request.query_params), payload)
+        return _json_response(status, result)
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Google Calendar API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 429/503 (0..1)")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    backend = FakeCalendarBackend(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    print(f"📅 Fake Google Calendar: http://{args.host}:{args.port}/")
+    print(f"   Для подключения: GOOGLE_CALENDAR_API_URL=http://{args.host}:{args.port}/")
+    uvicorn.run(create_fake_calendar_app(backend), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
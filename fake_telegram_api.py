@@ -0,0 +1,354 @@
+# fake_telegram_api.py - Локальная замена Telegram Bot API для тестов и замеров задержек бота
+
+import json
+import math
+import time
+import asyncio
+import logging
+import argparse
+from typing import Dict, Any, Optional, List
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from rate_limit import TokenBucket
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Заголовок с секретом webhook, который Telegram добавляет к каждому запросу
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class BotAPIError(Exception):
+    """Ошибка метода Bot API (ok=false в ответе)"""
+
+    def __init__(self, code: int, description: str, parameters: Dict[str, Any] = None):
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+        super().__init__(description)
+
+class FakeTelegramBackend:
+    """Состояние заглушки Bot API: входящие обновления, webhook и ответы бота.
+
+    Сообщения «водителей» создаются через send_message(): обновление отдается
+    боту через getUpdates или доставляется POST-запросом на webhook, а
+    отправитель может дождаться ответа бота в тот же чат и получить задержку
+    от появления обновления до sendMessage. Все методы выполняются в цикле
+    сервера заглушки. С flood_limits отправка сообщений ограничена как в
+    Telegram (30 в секунду всего, около 1 в секунду в чат с небольшим
+    запасом): сверх лимита - ответ 429 с retry_after.
+    """
+
+    # Методы, на которые действуют лимиты отправки
+    FLOOD_METHODS = {'sendmessage', 'editmessagetext', 'editmessagereplymarkup'}
+
+    def __init__(self, latency: float = 0.0, flood_limits: bool = False):
+        self.latency = latency
+        self.flood_limits = flood_limits
+        self.reset()
+
+    def reset(self):
+        """Очистка обновлений, webhook и счетчиков"""
+        self.pending_updates: List[Dict[str, Any]] = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.webhook_url: Optional[str] = None
+        self.webhook_secret: Optional[str] = None
+        self.calls: Dict[str, int] = {}
+        self.sent_messages = 0
+        self.webhook_deliveries = 0
+        self.webhook_failures = 0
+        self.flood_errors = 0
+        self.sent_by_chat: Dict[int, List[str]] = {}
+        self.edited_messages = 0
+        # Последнее состояние сообщений бота: (chat_id, message_id) -> {'text', 'reply_markup'}
+        self.bot_messages: Dict[tuple, Dict[str, Any]] = {}
+        self._global_bucket = TokenBucket(30, 30)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        self._updates_available: Optional[asyncio.Event] = None
+        self._http: Optional[httpx.AsyncClient] = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'calls': dict(self.calls),
+            'pending_updates': len(self.pending_updates),
+            'sent_messages': self.sent_messages,
+            'edited_messages': self.edited_messages,
+            'webhook_url': self.webhook_url,
+            'webhook_deliveries': self.webhook_deliveries,
+            'webhook_failures': self.webhook_failures,
+            'flood_errors': self.flood_errors
+        }
+
+    def _event(self) -> asyncio.Event:
+        if self._updates_available is None:
+            self._updates_available = asyncio.Event()
+        return self._updates_available
+
+    async def delay(self):
+        """Искусственная задержка ответа"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    # ===== СООБЩЕНИЯ ВОДИТЕЛЕЙ =====
+
+    def _message(self, chat_id: int, text: str, from_bot: bool = False) -> Dict[str, Any]:
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': f'Driver {chat_id}'},
+            'text': text
+        }
+        if from_bot:
+            message['from'] = {'id': 1, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_bot'}
+        else:
+            message['from'] = {'id': chat_id, 'is_bot': False, 'first_name': f'Driver {chat_id}', 'language_code': 'ru'}
+            if text.startswith('/'):
+                command = text.split()[0]
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return message
+
+    async def send_message(self, chat_id: int, text: str, wait_reply: bool = True,
+                           timeout: float = 10.0) -> Dict[str, Any]:
+        """Сообщение водителя боту; при wait_reply - ждать ответа и вернуть задержку"""
+        update = {'update_id': self.next_update_id, 'message': self._message(chat_id, text)}
+        self.next_update_id += 1
+
+        reply = None
+        if wait_reply:
+            reply = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(chat_id, []).append(reply)
+
+        started = time.perf_counter()
+        if self.webhook_url:
+            asyncio.create_task(self._deliver_webhook(update))
+        else:
+            self.pending_updates.append(update)
+            self._event().set()
+
+        result = {'update_id': update['update_id'], 'reply': None, 'latency_ms': None}
+        if reply is not None:
+            try:
+                result['reply'] = await asyncio.wait_for(reply, timeout)
+                result['latency_ms'] = (time.perf_counter() - started) * 1000
+            except asyncio.TimeoutError:
+                waiters = self._waiters.get(chat_id, [])
+                if reply in waiters:
+                    waiters.remove(reply)
+        return result
+
+    def press_button(self, chat_id: int, message_id: int, data: str) -> int:
+        """Нажатие водителем inline-кнопки сообщения бота; возвращает update_id"""
+        message = self.bot_messages.get((chat_id, message_id), {})
+        update = {
+            'update_id': self.next_update_id,
+            'callback_query': {
+                'id': str(self.next_update_id),
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'Driver {chat_id}', 'language_code': 'ru'},
+                'message': {**self._message(chat_id, message.get('text', ''), from_bot=True), 'message_id': message_id},
+                'chat_instance': str(chat_id),
+                'data': data
+            }
+        }
+        self.next_update_id += 1
+        if self.webhook_url:
+            asyncio.create_task(self._deliver_webhook(update))
+        else:
+            self.pending_updates.append(update)
+            self._event().set()
+        return update['update_id']
+
+    async def _deliver_webhook(self, update: Dict[str, Any]):
+        """Доставка обновления на webhook бота, как это делает Telegram"""
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=10.0)
+        headers = {SECRET_HEADER: self.webhook_secret} if self.webhook_secret else {}
+        try:
+            response = await self._http.post(self.webhook_url, json=update, headers=headers)
+            if response.status_code == 200:
+                self.webhook_deliveries += 1
+                return
+            logger.warning(f"⚠️ Webhook ответил {response.status_code} на обновление {update['update_id']}")
+        except httpx.HTTPError as e:
+            logger.warning(f"⚠️ Ошибка доставки обновления {update['update_id']} на webhook: {e}")
+        self.webhook_failures += 1
+
+    def _resolve_reply(self, chat_id: int, message: Dict[str, Any]):
+        waiters = self._waiters.get(chat_id)
+        while waiters:
+            waiter = waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(message)
+                return
+
+    # ===== МЕТОДЫ BOT API =====
+
+    async def call(self, method: str, params: Dict[str, Any]) -> Any:
+        """Выполнение метода Bot API: результат или BotAPIError"""
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.flood_limits and method.lower() in self.FLOOD_METHODS:
+            self._check_flood(int(params.get('chat_id') or 0))
+        handler = getattr(self, f'_method_{method.lower()}', None)
+        if handler is None:
+            # Прочие методы (setMyCommands, answerCallbackQuery, ...) просто подтверждаем
+            return True
+        return await handler(params)
+
+    def _check_flood(self, chat_id: int):
+        """Лимиты отправки Telegram: 429 Too Many Requests сверх них"""
+        chat_bucket = self._chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = self._chat_buckets[chat_id] = TokenBucket(1, 3)
+        wait = max(chat_bucket.time_until(1), self._global_bucket.time_until(1))
+        if wait > 0:
+            self.flood_errors += 1
+            retry_after = max(1, math.ceil(wait))
+            raise BotAPIError(429, f"Too Many Requests: retry after {retry_after}", {'retry_after': retry_after})
+        chat_bucket.reserve(1)
+        self._global_bucket.reserve(1)
+
+    async def _method_getme(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'id': 1, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_bot',
+                'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': True}
+
+    async def _method_getupdates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if self.webhook_url:
+            raise BotAPIError(409, "Conflict: can't use getUpdates method while webhook is active; "
+                                   "use deleteWebhook to delete the webhook first")
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+
+        if offset:
+            self.pending_updates = [u for u in self.pending_updates if u['update_id'] >= offset]
+        if not self.pending_updates and timeout:
+            event = self._event()
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.pending_updates[:limit]
+
+    async def _method_setwebhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook_url = params.get('url') or None
+        self.webhook_secret = params.get('secret_token') or None
+        if params.get('drop_pending_updates') in (True, 'true', 'True'):
+            self.pending_updates = []
+        # Накопленные обновления уходят на новый webhook
+        if self.webhook_url:
+            pending, self.pending_updates = self.pending_updates, []
+            for update in pending:
+                asyncio.create_task(self._deliver_webhook(update))
+        return True
+
+    async def _method_deletewebhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook_url = None
+        self.webhook_secret = None
+        if params.get('drop_pending_updates') in (True, 'true', 'True'):
+            self.pending_updates = []
+        return True
+
+    async def _method_getwebhookinfo(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'url': self.webhook_url or '', 'has_custom_certificate': False,
+                'pending_update_count': len(self.pending_updates)}
+
+    async def _method_sendmessage(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, params.get('text', ''), from_bot=True)
+        self.sent_messages += 1
+        self.sent_by_chat.setdefault(chat_id, []).append(message['text'])
+        self.bot_messages[(chat_id, message['message_id'])] = {'text': message['text'], 'reply_markup': params.get('reply_markup')}
+        self._resolve_reply(chat_id, message)
+        return message
+
+    async def _method_editmessagetext(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, params.get('text', ''), from_bot=True)
+        message['message_id'] = int(params['message_id'])
+        message['edit_date'] = int(time.time())
+        self.edited_messages += 1
+        self.bot_messages[(chat_id, message['message_id'])] = {'text': message['text'], 'reply_markup': params.get('reply_markup')}
+        return message
+
+def _parse_value(value: Any) -> Any:
+    """Сложные параметры (reply_markup и т.п.) aiogram передает JSON-строкой"""
+    if isinstance(value, str) and value[:1] in ('{', '['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+def create_fake_telegram_app(backend: FakeTelegramBackend = None) -> FastAPI:
+    """FastAPI-приложение, имитирующее используемую ботом часть Bot API"""
+    backend = backend or FakeTelegramBackend()
+    app = FastAPI(title="Fake Telegram Bot API")
+    app.state.backend = backend
+
+    @app.get("/fake/stats")
+    async def fake_stats():
+        return backend.stats()
+
+    @app.post("/fake/reset")
+    async def fake_reset():
+        backend.reset()
+        return {'success': True}
+
+    @app.post("/fake/messages")
+    async def fake_message(request: Request):
+        """Сообщение водителя: {"chat_id", "text", "wait_reply"} -> ответ бота и задержка"""
+        data = await request.json()
+        return await backend.send_message(
+            int(data['chat_id']), data['text'],
+            wait_reply=data.get('wait_reply', True),
+            timeout=float(data.get('timeout', 10.0))
+        )
+
+    @app.api_route("/bot{token}/{method}", methods=['GET', 'POST'])
+    async def bot_api(token: str, method: str, request: Request):
+        await backend.delay()
+        params: Dict[str, Any] = dict(request.query_params)
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            params.update(await request.json())
+        elif content_type:
+            form = await request.form()
+            params.update({key: _parse_value(value) for key, value in form.items()})
+
+        try:
+            result = await backend.call(method, params)
+        except BotAPIError as e:
+            payload = {'ok': False, 'error_code': e.code, 'description': e.description}
+            if e.parameters:
+                payload['parameters'] = e.parameters
+            return _api_response(payload, e.code)
+        return _api_response({'ok': True, 'result': result})
+
+    return app
+
+def _api_response(payload: Dict[str, Any], status: int = 200) -> JSONResponse:
+    return JSONResponse(payload, status_code=status)
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа, с")
+    parser.add_argument('--flood-limits', action='store_true', help="Отвечать 429 сверх лимитов отправки Telegram")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    backend = FakeTelegramBackend(latency=args.latency, flood_limits=args.flood_limits)
+    print(f"🤖 Fake Telegram Bot API: http://{args.host}:{args.port}/")
+    print(f"   Для подключения: TELEGRAM_API_URL=http://{args.host}:{args.port}")
+    uvicorn.run(create_fake_telegram_app(backend), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
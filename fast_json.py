@@ -0,0 +1,59 @@
+# fast_json.py - Быстрая JSON-сериализация ответов API
+
+import json
+import logging
+from dataclasses import asdict, is_dataclass
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Глобальная переменная для определения доступности orjson
+ORJSON_AVAILABLE = False
+
+# Безопасный импорт orjson
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    logger.warning("⚠️ orjson недоступен, используется стандартный json")
+
+# Опции orjson: разрешаем числовые ключи словарей (статистика по ID)
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if ORJSON_AVAILABLE else 0
+
+def _default(obj: Any) -> Any:
+    """Сериализация типов, которые не поддерживаются кодировщиком напрямую"""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date, time)):
+        # Только для стандартного json: orjson кодирует даты сам
+        return obj.isoformat()
+    if is_dataclass(obj) and not isinstance(obj, type):
+        return asdict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Объект типа {type(obj).__name__} не сериализуется в JSON")
+
+def dumps_bytes(obj: Any) -> bytes:
+    """Сериализация в JSON (UTF-8 байты)"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+def dumps(obj: Any) -> str:
+    """Сериализация в JSON-строку"""
+    return dumps_bytes(obj).decode('utf-8')
+
+class FastJSONResponse(JSONResponse):
+    """JSON-ответ на orjson (с откатом на стандартный json).
+
+    Даты, datetime, Decimal и dataclass сериализуются без предварительного
+    преобразования в обработчике.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
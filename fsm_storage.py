@@ -0,0 +1,220 @@
+# fsm_storage.py - Хранилище состояний диалогов Telegram бота (aiogram FSM) в SQLite
+
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Mapping, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+
+from database import DatabaseManager
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class _Session:
+    """Состояние диалога в памяти (данные хранятся в виде JSON).
+
+    saved - когда диалог последний раз записан в базу (0 - не записывался
+    этим процессом, например загружен из базы).
+    """
+
+    __slots__ = ('state', 'data', 'touched', 'saved')
+
+    def __init__(self, state: Optional[str] = None, data: str = '{}'):
+        self.state = state
+        self.data = data
+        self.touched = time.monotonic()
+        self.saved = 0.0
+
+    @property
+    def is_empty(self) -> bool:
+        return self.state is None and self.data == '{}'
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх таблицы fsm_sessions.
+
+    Чтение идет из горячего кэша в памяти (LRU на cache_size диалогов), при
+    промахе - один запрос по первичному ключу в пуле потоков. Запись только меняет кэш и
+    помечает диалог измененным; фоновая задача раз в flush_interval (или
+    сразу при накоплении flush_batch изменений) пишет их в базу одной
+    транзакцией. Диалоги, простаивающие дольше ttl_seconds, удаляются из
+    кэша и базы. Перед остановкой бота нужно вызвать close().
+    """
+
+    def __init__(self, db: DatabaseManager, ttl_seconds: int = 24 * 3600, cache_size: int = 1000,
+                 flush_interval: float = 1.0, flush_batch: int = 100, purge_interval: float = 600.0):
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.purge_interval = purge_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: 'OrderedDict[str, _Session]' = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_needed: Optional[asyncio.Event] = None
+        self._last_purge = time.monotonic()
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'flushes': 0, 'rows_flushed': 0, 'expired': 0}
+
+    # ===== КЭШ =====
+
+    async def _session(self, key: StorageKey) -> '_Session':
+        """Диалог из кэша или базы (пустой, если его нет или он истек)"""
+        storage_key = self.key_builder.build(key)
+        session = self._cache.get(storage_key)
+        now = time.monotonic()
+
+        if session is not None:
+            if now - session.touched > self.ttl_seconds:
+                # Брошенный диалог: начинаем с чистого состояния
+                self.stats['expired'] += 1
+                session = _Session()
+                self._cache[storage_key] = session
+                self._dirty.add(storage_key)
+            else:
+                self.stats['hits'] += 1
+            self._cache.move_to_end(storage_key)
+        else:
+            self.stats['misses'] += 1
+            # Запрос к SQLite - не в цикле событий (FSM читается на каждом обновлении)
+            row = await asyncio.to_thread(self.db.get_fsm_session, storage_key, self.ttl_seconds)
+            # Пока шел запрос, диалог мог загрузить или изменить другой обработчик
+            session = self._cache.get(storage_key)
+            if session is None:
+                session = _Session(row['state'], row['data']) if row else _Session()
+                self._cache[storage_key] = session
+                self._trim()
+
+        session.touched = now
+        return session
+
+    def _changed(self, key: StorageKey):
+        """Пометка диалога для записи в базу"""
+        self._dirty.add(self.key_builder.build(key))
+        self.stats['writes'] += 1
+        self._ensure_flusher()
+        if len(self._dirty) >= self.flush_batch:
+            self._flush_needed.set()
+
+    def _trim(self):
+        """Вытеснение давно не использованных диалогов (только уже записанных в базу)"""
+        if len(self._cache) <= self.cache_size:
+            return
+        for storage_key in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if storage_key not in self._dirty:
+                del self._cache[storage_key]
+
+    # ===== ИНТЕРФЕЙС BaseStorage =====
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        session = await self._session(key)
+        session.state = state.state if isinstance(state, State) else state
+        self._changed(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._session(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise TypeError(f"Данные диалога должны быть словарем, а не {type(data).__name__}")
+        # Сериализуем сразу: ошибка видна в обработчике, а не при фоновой записи
+        encoded = json.dumps(data, ensure_ascii=False)
+        session = await self._session(key)
+        if encoded != session.data:
+            session.data = encoded
+            self._changed(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return json.loads((await self._session(key)).data)
+
+    async def close(self) -> None:
+        """Остановка фоновой записи и сохранение оставшихся изменений"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    # ===== ЗАПИСЬ В БАЗУ =====
+
+    def _ensure_flusher(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_needed = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_purge >= self.purge_interval:
+                    await self.purge_expired()
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи состояний диалогов: {e}")
+
+    async def flush(self) -> int:
+        """Запись накопленных изменений в базу одной транзакцией"""
+        if not self._dirty:
+            return 0
+
+        keys, self._dirty = self._dirty, set()
+        flushed_at = time.monotonic()
+        upserts, deletes = [], []
+        for storage_key in keys:
+            session = self._cache.get(storage_key)
+            if session is None or session.is_empty:
+                deletes.append(storage_key)
+            else:
+                upserts.append((storage_key, session.state, session.data))
+
+        try:
+            await asyncio.to_thread(self.db.save_fsm_sessions, upserts, deletes)
+        except Exception:
+            # Повторим запись при следующем сбросе
+            self._dirty |= keys
+            raise
+
+        for storage_key, _, _ in upserts:
+            session = self._cache.get(storage_key)
+            if session is not None:
+                session.saved = flushed_at
+
+        self.stats['flushes'] += 1
+        self.stats['rows_flushed'] += len(keys)
+        self._trim()
+        return len(keys)
+
+    async def purge_expired(self) -> int:
+        """Удаление брошенных диалогов из кэша и базы"""
+        self._last_purge = time.monotonic()
+        deadline = self._last_purge - self.ttl_seconds
+        for storage_key in [k for k, s in self._cache.items() if s.touched < deadline and k not in self._dirty]:
+            del self._cache[storage_key]
+
+        # Диалоги, которые читались после последней записи, продлеваем в базе,
+        # чтобы их не удалить; остальные и так записаны не раньше последнего обращения
+        self._dirty.update(k for k, s in self._cache.items() if not s.is_empty and s.touched > s.saved)
+        await self.flush()
+
+        removed = await asyncio.to_thread(self.db.purge_fsm_sessions, self.ttl_seconds)
+        if removed:
+            logger.info(f"🧹 Удалено брошенных диалогов бота: {removed}")
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'cached': len(self._cache), 'dirty': len(self._dirty)}
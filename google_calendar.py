@@ -2,9 +2,14 @@
 
 import os
 import json
+import asyncio
 import logging
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+from rate_limit import TokenBucket, CircuitBreaker, CircuitOpenError, RateLimitExceededError
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -16,37 +21,204 @@ GOOGLE_CALENDAR_AVAILABLE = False
 try:
     from google.auth.transport.requests import Request
     from google.oauth2.credentials import Credentials
+    from google.auth.credentials import AnonymousCredentials
     from google_auth_oauthlib.flow import InstalledAppFlow
-    from googleapiclient.discovery import build
+    from googleapiclient.discovery import build_from_document, DISCOVERY_URI
+    from googleapiclient.discovery_cache import get_static_doc
     from googleapiclient.errors import HttpError
+    import google_auth_httplib2
+    import httplib2
     GOOGLE_CALENDAR_AVAILABLE = True
     logger.info("✅ Google Calendar API модули доступны")
 except ImportError as e:
     logger.warning(f"⚠️ Google Calendar API недоступен: {e}")
 
+class SyncTokenExpiredError(Exception):
+    """Sync token календаря устарел (HTTP 410), нужна полная синхронизация"""
+
 class GoogleCalendarManager:
-    """Менеджер для работы с Google Calendar API"""
+    """Менеджер для работы с Google Calendar API.
+    
+    Экземпляр рассчитан на долгую жизнь (см. get_calendar_manager): аутентификация
+    выполняется один раз, токен обновляется в фоне до истечения срока, объект
+    сервиса строится один раз из локально закэшированного discovery-документа.
+    Запросы выполняются через HTTP-клиент своего потока, поэтому менеджер можно
+    использовать одновременно из веб-сервера и бота.
+    """
     
     SCOPES = ['https://www.googleapis.com/auth/calendar']
     
-    def __init__(self, credentials_file: str = "credentials.json", token_file: str = "token.json"):
+    # За сколько секунд до истечения токена обновлять его в фоне
+    TOKEN_REFRESH_MARGIN = 300
+    # Пауза перед повтором неудачного фонового обновления
+    TOKEN_REFRESH_RETRY = 60
+    
+    # Максимум вызовов в одном batch-запросе Calendar API
+    BATCH_SIZE = 50
+    # Повторы неудачных элементов batch-запроса и базовая задержка между ними
+    BATCH_RETRIES = 3
+    BATCH_RETRY_DELAY = 1.0
+    # HTTP-статусы, при которых элемент batch-запроса повторяется
+    RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+    
+    # Сколько максимум ждать свободной квоты, прежде чем отказаться от вызова
+    RATE_LIMIT_MAX_WAIT = 10.0
+    
+    def __init__(self, credentials_file: str = "credentials.json", token_file: str = "token.json",
+                 discovery_file: str = "calendar_discovery.json", api_url: str = None,
+                 rate_per_second: float = None, rate_per_day: float = None,
+                 failure_threshold: int = None, recovery_timeout: float = None):
         self.credentials_file = credentials_file
         self.token_file = token_file
+        self.discovery_file = discovery_file
+        # Адрес альтернативного сервера API (например, fake_google_calendar.py); без OAuth
+        self.api_url = api_url
         self.service = None
+        self.creds = None
         self.calendar_id = 'primary'
         self.is_authenticated = False
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._refresh_timer = None
+        
+        # Клиентские лимиты вызовов (0 - без ограничения) и выключатель при сбоях Google
+        if rate_per_second is None:
+            rate_per_second = float(os.getenv("GOOGLE_CALENDAR_RATE_PER_SECOND", "5"))
+        if rate_per_day is None:
+            rate_per_day = float(os.getenv("GOOGLE_CALENDAR_RATE_PER_DAY", "500000"))
+        if failure_threshold is None:
+            failure_threshold = int(os.getenv("GOOGLE_CALENDAR_BREAKER_THRESHOLD", "5"))
+        if recovery_timeout is None:
+            recovery_timeout = float(os.getenv("GOOGLE_CALENDAR_BREAKER_TIMEOUT", "30"))
+        self.second_limiter = TokenBucket(rate_per_second) if rate_per_second > 0 else None
+        self.day_limiter = TokenBucket(rate_per_day / 86400, capacity=rate_per_day) if rate_per_day > 0 else None
+        self.circuit_breaker = CircuitBreaker("Google Calendar", failure_threshold, recovery_timeout)
+    
+    def _http(self):
+        """HTTP-клиент текущего потока (httplib2.Http не потокобезопасен)"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
+    
+    def _load_discovery_document(self) -> str:
+        """Discovery-документ Calendar API из локального кэша (загружается один раз)"""
+        if os.path.exists(self.discovery_file):
+            with open(self.discovery_file, 'r', encoding='utf-8') as f:
+                return f.read()
         
+        document = get_static_doc('calendar', 'v3')
+        if document is None:
+            response, content = httplib2.Http().request(
+                DISCOVERY_URI.format(api='calendar', apiVersion='v3'))
+            if response.status >= 400:
+                raise RuntimeError(f"Не удалось загрузить discovery-документ: HTTP {response.status}")
+            document = content.decode('utf-8')
+        
+        try:
+            with open(self.discovery_file, 'w', encoding='utf-8') as f:
+                f.write(document)
+        except Exception as e:
+            logger.warning(f"Ошибка сохранения discovery-документа: {e}")
+        
+        return document
+    
+    def _save_token(self, creds):
+        """Сохранение учетных данных в token_file"""
+        try:
+            with open(self.token_file, 'w') as token:
+                token.write(creds.to_json())
+            logger.info("Токен сохранен")
+        except Exception as e:
+            logger.warning(f"Ошибка сохранения токена: {e}")
+    
+    def _schedule_refresh(self, delay: float = None):
+        """Планирование фонового обновления токена"""
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        
+        if delay is None:
+            if not self.creds or not self.creds.expiry or not self.creds.refresh_token:
+                return
+            # expiry у google-auth хранится в наивном UTC
+            delay = (self.creds.expiry - datetime.utcnow()).total_seconds() - self.TOKEN_REFRESH_MARGIN
+            delay = max(delay, 0)
+        
+        self._refresh_timer = threading.Timer(delay, self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+    
+    def _background_refresh(self):
+        """Фоновое обновление токена до истечения срока"""
+        with self._lock:
+            if self.creds is None:
+                # Календарь отключен (reset), пока таймер ждал блокировку
+                return
+            try:
+                self.creds.refresh(Request())
+                self._save_token(self.creds)
+                logger.info("🔄 Токен Google Calendar обновлен в фоне")
+                self._schedule_refresh()
+            except Exception as e:
+                logger.error(f"❌ Ошибка фонового обновления токена: {e}")
+                self._schedule_refresh(self.TOKEN_REFRESH_RETRY)
+    
+    def reset(self):
+        """Сброс подключения (отключение календаря): таймер обновления токена,
+        сервис, учетные данные и HTTP-клиенты потоков; следующий вызов
+        выполнит аутентификацию заново"""
+        with self._lock:
+            if self._refresh_timer:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+            self.service = None
+            self.creds = None
+            self._local = threading.local()
+            self.is_authenticated = False
+        logger.info("Подключение к Google Calendar сброшено")
+    
     def authenticate(self) -> bool:
-        """Аутентификация с Google Calendar API"""
+        """Аутентификация с Google Calendar API (повторно не выполняется, пока токен действителен)"""
         if not GOOGLE_CALENDAR_AVAILABLE:
             logger.error("Google Calendar API недоступен")
             return False
+        
+        with self._lock:
+            if self.service and self.creds and self.creds.valid:
+                return True
+            if self.api_url:
+                return self._connect_custom_endpoint()
+            return self._authenticate()
+    
+    def _connect_custom_endpoint(self) -> bool:
+        """Подключение к альтернативному серверу API без OAuth"""
+        try:
+            document = json.loads(self._load_discovery_document())
+            # Все адреса (включая batch) строятся от rootUrl документа
+            root_url = self.api_url.rstrip('/') + '/'
+            document['rootUrl'] = root_url
+            document['baseUrl'] = root_url + document['servicePath']
             
+            self.creds = AnonymousCredentials()
+            self.service = build_from_document(document, credentials=self.creds)
+            self._local = threading.local()
+            self.is_authenticated = True
+            logger.info(f"✅ Google Calendar API: используется сервер {root_url}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка подключения к серверу календаря {self.api_url}: {e}")
+            self.is_authenticated = False
+            return False
+    
+    def _authenticate(self) -> bool:
+        """Загрузка/обновление/получение токена и построение сервиса"""
         try:
-            creds = None
+            # Учетные данные из памяти, если уже загружались
+            creds = self.creds
             
             # Проверяем существующий токен
-            if os.path.exists(self.token_file):
+            if creds is None and os.path.exists(self.token_file):
                 try:
                     creds = Credentials.from_authorized_user_file(self.token_file, self.SCOPES)
                     logger.info("Загружен существующий токен")
@@ -79,16 +251,15 @@ class GoogleCalendarManager:
                         return False
                 
                 # Сохраняем учетные данные
-                try:
-                    with open(self.token_file, 'w') as token:
-                        token.write(creds.to_json())
-                    logger.info("Токен сохранен")
-                except Exception as e:
-                    logger.warning(f"Ошибка сохранения токена: {e}")
+                self._save_token(creds)
             
-            # Создаем сервис
-            self.service = build('calendar', 'v3', credentials=creds)
+            # Создаем сервис один раз; при смене токена достаточно сбросить HTTP-клиенты потоков
+            if self.service is None:
+                self.service = build_from_document(self._load_discovery_document(), credentials=creds)
+            self.creds = creds
+            self._local = threading.local()
             self.is_authenticated = True
+            self._schedule_refresh()
             logger.info("✅ Успешная аутентификация с Google Calendar")
             return True
             
@@ -97,81 +268,76 @@ class GoogleCalendarManager:
             self.is_authenticated = False
             return False
     
-    def create_trip_event(self, trip_data: Dict[str, Any], user_data: Dict[str, Any]) -> Optional[str]:
-        """Создание события рейса в календаре с улучшенной обработкой времени"""
-        if not self.service:
-            if not self.authenticate():
-                return None
+    def _build_trip_event_body(self, trip_data: Dict[str, Any], user_data: Dict[str, Any]):
+        """Формирование тела события рейса; возвращает (событие, начало, окончание)"""
+        # Определяем время события
+        now = datetime.now()
         
-        try:
-            # Определяем время события
-            now = datetime.now()
-            
-            if trip_data.get('started_at'):
-                # Если есть время начала, парсим его
-                if isinstance(trip_data['started_at'], str):
-                    try:
-                        # Пробуем разные форматы времени
-                        if 'T' in trip_data['started_at']:
-                            # ISO формат
-                            start_time = datetime.fromisoformat(trip_data['started_at'].replace('Z', ''))
-                        else:
-                            # Возможно, это уже datetime объект в строковом виде
-                            start_time = datetime.fromisoformat(trip_data['started_at'])
-                    except:
-                        logger.warning(f"Не удалось парсить время начала: {trip_data['started_at']}")
-                        start_time = now
-                else:
-                    start_time = trip_data['started_at']
-            else:
-                # Если нет времени начала, используем текущее время
-                start_time = now
-            
-            # Определяем время окончания
-            if trip_data.get('completed_at'):
-                if isinstance(trip_data['completed_at'], str):
-                    try:
-                        if 'T' in trip_data['completed_at']:
-                            end_time = datetime.fromisoformat(trip_data['completed_at'].replace('Z', ''))
-                        else:
-                            end_time = datetime.fromisoformat(trip_data['completed_at'])
-                    except:
-                        logger.warning(f"Не удалось парсить время окончания: {trip_data['completed_at']}")
-                        duration = max(trip_data.get('duration_hours', 2.0), 1.0)  # Минимум 1 час
-                        end_time = start_time + timedelta(hours=duration)
-                else:
-                    end_time = trip_data['completed_at']
+        if trip_data.get('started_at'):
+            # Если есть время начала, парсим его
+            if isinstance(trip_data['started_at'], str):
+                try:
+                    # Пробуем разные форматы времени
+                    if 'T' in trip_data['started_at']:
+                        # ISO формат
+                        start_time = datetime.fromisoformat(trip_data['started_at'].replace('Z', ''))
+                    else:
+                        # Возможно, это уже datetime объект в строковом виде
+                        start_time = datetime.fromisoformat(trip_data['started_at'])
+                except:
+                    logger.warning(f"Не удалось парсить время начала: {trip_data['started_at']}")
+                    start_time = now
             else:
-                # Если поездка не завершена, используем продолжительность
-                duration = max(trip_data.get('duration_hours', 2.0), 1.0)  # Минимум 1 час для видимости
-                end_time = start_time + timedelta(hours=duration)
-            
-            # Убеждаемся, что end_time > start_time
-            if end_time <= start_time:
-                end_time = start_time + timedelta(hours=1)
-            
-            # Формируем название и описание
-            driver_name = f"{user_data.get('surname', '')} {user_data.get('first_name', '')}"
-            if user_data.get('middle_name'):
-                driver_name += f" {user_data.get('middle_name', '')}"
-            
-            # Определяем статус поездки
-            status_info = ""
-            if trip_data.get('completed_at'):
-                status_info = "✅ ЗАВЕРШЕНА"
-                if trip_data.get('duration_hours'):
-                    real_duration = trip_data['duration_hours']
-                    hours = int(real_duration)
-                    minutes = int((real_duration - hours) * 60)
-                    status_info += f" ({hours}ч {minutes}мин)"
-            elif trip_data.get('started_at'):
-                status_info = "🚀 В ПУТИ"
+                start_time = trip_data['started_at']
+        else:
+            # Если нет времени начала, используем текущее время
+            start_time = now
+        
+        # Определяем время окончания
+        if trip_data.get('completed_at'):
+            if isinstance(trip_data['completed_at'], str):
+                try:
+                    if 'T' in trip_data['completed_at']:
+                        end_time = datetime.fromisoformat(trip_data['completed_at'].replace('Z', ''))
+                    else:
+                        end_time = datetime.fromisoformat(trip_data['completed_at'])
+                except:
+                    logger.warning(f"Не удалось парсить время окончания: {trip_data['completed_at']}")
+                    duration = max(trip_data.get('duration_hours', 2.0), 1.0)  # Минимум 1 час
+                    end_time = start_time + timedelta(hours=duration)
             else:
-                status_info = "⏰ ЗАПЛАНИРОВАНА"
-            
-            summary = f"Рейс #{trip_data.get('waybill_number', 'N/A')} - {driver_name} [{status_info}]"
-            
-            description = f"""
+                end_time = trip_data['completed_at']
+        else:
+            # Если поездка не завершена, используем продолжительность
+            duration = max(trip_data.get('duration_hours', 2.0), 1.0)  # Минимум 1 час для видимости
+            end_time = start_time + timedelta(hours=duration)
+        
+        # Убеждаемся, что end_time > start_time
+        if end_time <= start_time:
+            end_time = start_time + timedelta(hours=1)
+        
+        # Формируем название и описание
+        driver_name = f"{user_data.get('surname', '')} {user_data.get('first_name', '')}"
+        if user_data.get('middle_name'):
+            driver_name += f" {user_data.get('middle_name', '')}"
+        
+        # Определяем статус поездки
+        status_info = ""
+        if trip_data.get('completed_at'):
+            status_info = "✅ ЗАВЕРШЕНА"
+            if trip_data.get('duration_hours'):
+                real_duration = trip_data['duration_hours']
+                hours = int(real_duration)
+                minutes = int((real_duration - hours) * 60)
+                status_info += f" ({hours}ч {minutes}мин)"
+        elif trip_data.get('started_at'):
+            status_info = "🚀 В ПУТИ"
+        else:
+            status_info = "⏰ ЗАПЛАНИРОВАНА"
+        
+        summary = f"Рейс #{trip_data.get('waybill_number', 'N/A')} - {driver_name} [{status_info}]"
+        
+        description = f"""
 🚛 Детали рейса:
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 👤 Водитель: {driver_name}
@@ -188,54 +354,65 @@ class GoogleCalendarManager:
 🚀 Начало: {start_time.strftime('%d.%m.%Y %H:%M')}
 🏁 Окончание: {end_time.strftime('%d.%m.%Y %H:%M')}
 ⏱ Продолжительность: {(end_time - start_time).total_seconds() / 3600:.1f}ч
-            """.strip()
-            
-            # Выбираем цвет в зависимости от статуса
-            color_id = '9'  # Синий по умолчанию
-            if trip_data.get('completed_at'):
-                color_id = '10'  # Зеленый для завершенных
-            elif trip_data.get('started_at'):
-                color_id = '11'  # Красный для активных
-            
-            # Создаем событие
-            event = {
-                'summary': summary,
-                'description': description,
-                'start': {
-                    'dateTime': start_time.isoformat(),
-                    'timeZone': 'Europe/Riga',
-                },
-                'end': {
-                    'dateTime': end_time.isoformat(),
-                    'timeZone': 'Europe/Riga',
-                },
-                'colorId': color_id,
-                'reminders': {
-                    'useDefault': False,
-                    'overrides': [
-                        {'method': 'popup', 'minutes': 15},
-                    ],
-                },
-                'extendedProperties': {
-                    'private': {
-                        'source': 'expedition_system',
-                        'trip_id': str(trip_data.get('id', '')),
-                        'driver_id': str(user_data.get('id', '')),
-                        'vehicle_number': trip_data.get('vehicle_number', ''),
-                        'route_number': trip_data.get('route_number', ''),
-                        'waybill_number': trip_data.get('waybill_number', ''),
-                        'created_at': datetime.now().isoformat(),
-                        'status': 'completed' if trip_data.get('completed_at') else 'started' if trip_data.get('started_at') else 'planned',
-                        'duration_hours': str(trip_data.get('duration_hours', 0))
-                    }
+        """.strip()
+        
+        # Выбираем цвет в зависимости от статуса
+        color_id = '9'  # Синий по умолчанию
+        if trip_data.get('completed_at'):
+            color_id = '10'  # Зеленый для завершенных
+        elif trip_data.get('started_at'):
+            color_id = '11'  # Красный для активных
+        
+        # Создаем событие
+        event = {
+            'summary': summary,
+            'description': description,
+            'start': {
+                'dateTime': start_time.isoformat(),
+                'timeZone': 'Europe/Riga',
+            },
+            'end': {
+                'dateTime': end_time.isoformat(),
+                'timeZone': 'Europe/Riga',
+            },
+            'colorId': color_id,
+            'reminders': {
+                'useDefault': False,
+                'overrides': [
+                    {'method': 'popup', 'minutes': 15},
+                ],
+            },
+            'extendedProperties': {
+                'private': {
+                    'source': 'expedition_system',
+                    'trip_id': str(trip_data.get('id', '')),
+                    'driver_id': str(user_data.get('id', '')),
+                    'vehicle_number': trip_data.get('vehicle_number', ''),
+                    'route_number': trip_data.get('route_number', ''),
+                    'waybill_number': trip_data.get('waybill_number', ''),
+                    'created_at': datetime.now().isoformat(),
+                    'status': 'completed' if trip_data.get('completed_at') else 'started' if trip_data.get('started_at') else 'planned',
+                    'duration_hours': str(trip_data.get('duration_hours', 0))
                 }
             }
+        }
+        
+        return event, start_time, end_time
+    
+    def create_trip_event(self, trip_data: Dict[str, Any], user_data: Dict[str, Any]) -> Optional[str]:
+        """Создание события рейса в календаре с улучшенной обработкой времени"""
+        if not self.service:
+            if not self.authenticate():
+                return None
+        
+        try:
+            event, start_time, end_time = self._build_trip_event_body(trip_data, user_data)
             
             # Создаем событие в календаре
-            created_event = self.service.events().insert(
+            created_event = self._execute(self.service.events().insert(
                 calendarId=self.calendar_id,
                 body=event
-            ).execute()
+            ))
             
             event_id = created_event.get('id')
             event_link = created_event.get('htmlLink')
@@ -258,10 +435,10 @@ class GoogleCalendarManager:
         
         try:
             # Получаем существующее событие
-            event = self.service.events().get(
+            event = self._execute(self.service.events().get(
                 calendarId=self.calendar_id,
                 eventId=event_id
-            ).execute()
+            ))
             
             # Обновляем время на основе реальных данных
             if trip_data.get('started_at') and trip_data.get('completed_at'):
@@ -370,11 +547,11 @@ class GoogleCalendarManager:
             })
             
             # Обновляем событие
-            updated_event = self.service.events().update(
+            updated_event = self._execute(self.service.events().update(
                 calendarId=self.calendar_id,
                 eventId=event_id,
                 body=event
-            ).execute()
+            ))
             
             logger.info(f"✅ Событие обновлено в Google Calendar: {event_id}")
             logger.info(f"⏰ Обновленное время: {start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')} ({(end_time - start_time).total_seconds() / 3600:.1f}ч)")
@@ -391,21 +568,228 @@ class GoogleCalendarManager:
                 return False
         
         try:
-            self.service.events().delete(
+            self._execute(self.service.events().delete(
                 calendarId=self.calendar_id,
                 eventId=event_id
-            ).execute()
+            ))
             
             logger.info(f"✅ Событие удалено из Google Calendar: {event_id}")
             return True
             
         except Exception as error:
-            if hasattr(error, 'resp') and error.resp.status == 404:
+            if hasattr(error, 'resp') and error.resp.status in (404, 410):
                 logger.warning(f"⚠️ Событие не найдено для удаления: {event_id}")
                 return True  # Считаем успехом, если события уже нет
             logger.error(f"❌ Ошибка при удалении события: {error}")
             return False
     
+    def _acquire_quota(self, cost: int = 1):
+        """Ожидание свободной квоты вызовов (RateLimitExceededError, если ждать слишком долго).
+        
+        В потоке с работающим циклом событий (веб-сервер и бот) ждать нельзя -
+        time.sleep остановил бы весь процесс: без свободной квоты вызов сразу
+        отклоняется.
+        """
+        try:
+            asyncio.get_running_loop()
+            on_event_loop = True
+        except RuntimeError:
+            on_event_loop = False
+        
+        for limiter in (self.day_limiter, self.second_limiter):
+            if limiter is None:
+                continue
+            if on_event_loop:
+                limiter.try_acquire(cost)
+            else:
+                limiter.acquire(cost, max_wait=self.RATE_LIMIT_MAX_WAIT)
+    
+    def _execute(self, request, cost: int = 1, failed: Callable[[], bool] = None):
+        """Выполнение запроса к API через лимиты и выключатель.
+        
+        cost - число вызовов API в запросе (для batch - число элементов).
+        failed - проверка ответа, которая считает сбоем успешный по HTTP
+        запрос (batch, в котором все элементы отклонены Google).
+        """
+        self.circuit_breaker.before_call()
+        try:
+            self._acquire_quota(cost)
+        except RateLimitExceededError:
+            self.circuit_breaker.cancel_call()
+            raise
+        
+        try:
+            response = request.execute(http=self._http())
+        except Exception as error:
+            # Сбоем сервиса считаем только временные ошибки (404 и т.п. - нормальный ответ)
+            if self._is_retryable(error):
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+            raise
+        
+        if failed is not None and failed():
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        return response
+    
+    def _is_retryable(self, error: Exception) -> bool:
+        """Можно ли повторить вызов после ошибки"""
+        status = getattr(getattr(error, 'resp', None), 'status', None)
+        if status is None:
+            # Сетевая ошибка без HTTP-ответа
+            return True
+        if status == 403 and 'rateLimitExceeded' in str(error):
+            return True
+        return status in self.RETRYABLE_STATUSES
+    
+    def execute_batch(self, requests: Dict[str, Any],
+                      is_success: Callable[[Optional[Exception]], bool] = None) -> Dict[str, bool]:
+        """Выполнение вызовов API через batch-эндпоинт (до BATCH_SIZE в запросе).
+        
+        requests - {ключ: HttpRequest}. Неудачные элементы с временной ошибкой
+        повторяются до BATCH_RETRIES раз. Возвращает {ключ: успех}.
+        """
+        results = {key: False for key in requests}
+        if not requests:
+            return results
+        if not self.service:
+            if not self.authenticate():
+                return results
+        
+        if is_success is None:
+            is_success = lambda error: error is None
+        
+        pending = dict(requests)
+        for attempt in range(self.BATCH_RETRIES + 1):
+            if attempt:
+                time.sleep(self.BATCH_RETRY_DELAY * (2 ** (attempt - 1)))
+            
+            retry = {}
+            keys = list(pending)
+            for chunk_start in range(0, len(keys), self.BATCH_SIZE):
+                chunk = keys[chunk_start:chunk_start + self.BATCH_SIZE]
+                errors: Dict[str, Optional[Exception]] = {}
+                
+                def callback(request_id, response, exception):
+                    errors[request_id] = exception
+                
+                batch = self.service.new_batch_http_request(callback=callback)
+                for key in chunk:
+                    batch.add(pending[key], request_id=key)
+                
+                def all_throttled():
+                    return all(errors.get(key) is not None and self._is_retryable(errors[key]) for key in chunk)
+                
+                try:
+                    self._execute(batch, cost=len(chunk), failed=all_throttled)
+                except (CircuitOpenError, RateLimitExceededError) as e:
+                    # Повторять бессмысленно: вызовы приостановлены, ошибки вернет вызывающему
+                    logger.warning(f"⚠️ Batch-запрос к Google Calendar отложен: {e}")
+                    return results
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка batch-запроса к Google Calendar: {e}")
+                    retry.update({key: pending[key] for key in chunk})
+                    continue
+                
+                for key in chunk:
+                    error = errors.get(key)
+                    if is_success(error):
+                        results[key] = True
+                    elif self._is_retryable(error):
+                        retry[key] = pending[key]
+                    else:
+                        logger.error(f"❌ Ошибка элемента batch-запроса {key}: {error}")
+            
+            if not retry:
+                break
+            pending = retry
+        else:
+            logger.error(f"❌ Не выполнено {len(pending)} вызовов batch-запроса после {self.BATCH_RETRIES} повторов")
+        
+        return results
+    
+    def delete_trip_events_batch(self, event_ids: List[str]) -> Dict[str, bool]:
+        """Удаление событий рейсов batch-запросами"""
+        if not self.service:
+            if not self.authenticate():
+                return {event_id: False for event_id in event_ids}
+        
+        requests = {
+            event_id: self.service.events().delete(calendarId=self.calendar_id, eventId=event_id)
+            for event_id in event_ids
+        }
+        # Уже удаленное событие (404/410) считаем успехом
+        results = self.execute_batch(
+            requests,
+            is_success=lambda error: error is None or getattr(getattr(error, 'resp', None), 'status', None) in (404, 410)
+        )
+        logger.info(f"✅ Удалено событий из Google Calendar: {sum(results.values())} из {len(event_ids)}")
+        return results
+    
+    def update_trip_events_batch(self, items: List[Tuple[str, Dict[str, Any], Dict[str, Any]]]) -> Dict[str, bool]:
+        """Обновление событий рейсов batch-запросами (events.patch без предварительного чтения).
+        
+        items - список (event_id, trip_data, user_data).
+        """
+        if not self.service:
+            if not self.authenticate():
+                return {event_id: False for event_id, _, _ in items}
+        
+        requests = {}
+        for event_id, trip_data, user_data in items:
+            event, start_time, end_time = self._build_trip_event_body(trip_data, user_data)
+            # Напоминания и дату создания события при обновлении не трогаем
+            event.pop('reminders', None)
+            private = event['extendedProperties']['private']
+            private.pop('created_at', None)
+            private.update({
+                'updated_at': datetime.now().isoformat(),
+                'real_start_time': start_time.isoformat(),
+                'real_end_time': end_time.isoformat()
+            })
+            requests[event_id] = self.service.events().patch(
+                calendarId=self.calendar_id,
+                eventId=event_id,
+                body=event
+            )
+        
+        results = self.execute_batch(requests)
+        logger.info(f"✅ Обновлено событий в Google Calendar: {sum(results.values())} из {len(items)}")
+        return results
+    
+    def list_event_changes(self, sync_token: str = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Изменения событий с момента выдачи sync_token (без токена - все события).
+        
+        Возвращает (события, новый sync token). Удаленные события приходят
+        со status='cancelled'. При устаревшем токене - SyncTokenExpiredError.
+        """
+        if not self.service:
+            if not self.authenticate():
+                raise RuntimeError("Нет подключения к Google Calendar")
+        
+        events = []
+        page_token = None
+        while True:
+            params = {'calendarId': self.calendar_id, 'showDeleted': True, 'maxResults': 250}
+            if sync_token:
+                params['syncToken'] = sync_token
+            if page_token:
+                params['pageToken'] = page_token
+            
+            try:
+                response = self._execute(self.service.events().list(**params))
+            except Exception as error:
+                if getattr(getattr(error, 'resp', None), 'status', None) == 410:
+                    raise SyncTokenExpiredError(str(error))
+                raise
+            
+            events.extend(response.get('items', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return events, response.get('nextSyncToken')
+    
     def test_connection(self) -> bool:
         """Тестирование подключения к Google Calendar"""
         if not GOOGLE_CALENDAR_AVAILABLE:
@@ -416,7 +800,7 @@ class GoogleCalendarManager:
             return False
         
         try:
-            calendar = self.service.calendars().get(calendarId='primary').execute()
+            calendar = self._execute(self.service.calendars().get(calendarId='primary'))
             calendar_name = calendar.get('summary', 'Неизвестно')
             logger.info(f"✅ Подключение к Google Calendar успешно! Календарь: {calendar_name}")
             return True
@@ -425,6 +809,17 @@ class GoogleCalendarManager:
             logger.error(f"❌ Ошибка подключения к Google Calendar: {error}")
             return False
     
+    def quota_retry_after(self, cost: int = 1) -> float:
+        """Секунд до появления квоты на cost вызовов (0 - вызывать можно сейчас)"""
+        return max([limiter.time_until(cost) for limiter in (self.day_limiter, self.second_limiter) if limiter] or [0.0])
+    
+    def get_rate_limit_state(self) -> Dict[str, Any]:
+        """Состояние клиентских лимитов вызовов API"""
+        return {
+            'per_second': self.second_limiter.get_state() if self.second_limiter else None,
+            'per_day': self.day_limiter.get_state() if self.day_limiter else None
+        }
+    
     def get_connection_status(self) -> Dict[str, Any]:
         """Получение статуса подключения"""
         if not GOOGLE_CALENDAR_AVAILABLE:
@@ -437,8 +832,9 @@ class GoogleCalendarManager:
                 'error': 'Google Calendar API недоступен. Установите зависимости: pip install google-auth google-auth-oauthlib google-auth-httplib2 google-api-python-client'
             }
         
-        has_credentials = os.path.exists(self.credentials_file)
-        has_token = os.path.exists(self.token_file)
+        # Альтернативный сервер API работает без файлов учетных данных
+        has_credentials = bool(self.api_url) or os.path.exists(self.credentials_file)
+        has_token = bool(self.api_url) or os.path.exists(self.token_file)
         
         status = {
             'is_available': True,
@@ -446,13 +842,23 @@ class GoogleCalendarManager:
             'has_credentials': has_credentials,
             'has_token': has_token,
             'calendar_info': None,
-            'error': None
+            'error': None,
+            'circuit_breaker': self.circuit_breaker.get_state(),
+            'rate_limit': self.get_rate_limit_state()
         }
         
-        if has_credentials and has_token:
+        retry_after = self.circuit_breaker.retry_after()
+        quota_retry_after = self.quota_retry_after(2)
+        if retry_after > 0:
+            # Не обращаемся к Google, пока цепь разомкнута
+            status['error'] = f'Google Calendar временно недоступен, повтор через {retry_after:.0f}с'
+        elif quota_retry_after > self.RATE_LIMIT_MAX_WAIT:
+            # Проверка статуса не должна расходовать квоту, нужную очереди изменений
+            status['error'] = f'Квота вызовов Google Calendar исчерпана, повтор через {quota_retry_after:.0f}с'
+        elif has_credentials and has_token:
             if self.test_connection():
                 try:
-                    calendar = self.service.calendars().get(calendarId='primary').execute()
+                    calendar = self._execute(self.service.calendars().get(calendarId='primary'))
                     status['calendar_info'] = {
                         'name': calendar.get('summary'),
                         'id': calendar.get('id'),
@@ -470,16 +876,144 @@ class GoogleCalendarManager:
         
         return status
 
+# Общие для процесса менеджеры календаря (по паре файлов учетных данных)
+_calendar_managers: Dict[tuple, GoogleCalendarManager] = {}
+_calendar_managers_lock = threading.Lock()
+
+def get_calendar_manager(credentials_file: str = "credentials.json",
+                         token_file: str = "token.json",
+                         api_url: str = None) -> GoogleCalendarManager:
+    """Получение общего для процесса менеджера календаря.
+    
+    api_url по умолчанию берется из GOOGLE_CALENDAR_API_URL (локальный сервер для тестов).
+    """
+    if api_url is None:
+        api_url = os.getenv("GOOGLE_CALENDAR_API_URL") or None
+    key = (credentials_file, token_file, api_url)
+    with _calendar_managers_lock:
+        manager = _calendar_managers.get(key)
+        if manager is None:
+            manager = GoogleCalendarManager(credentials_file, token_file, api_url=api_url)
+            _calendar_managers[key] = manager
+        return manager
+
+class CalendarReconciler:
+    """Сверка событий календаря с рейсами.
+    
+    По sync token забираются только изменения с прошлого запуска; события
+    сопоставляются с рейсами по индексу trips.calendar_event_id. Источник
+    истины - рейсы: удаленное вручную событие пересоздается, измененное
+    вручную - перезаписывается (через очередь calendar_outbox), событие
+    удаленного рейса удаляется. При полной
+    синхронизации (первый запуск или устаревший токен) дополнительно
+    пересоздаются события рейсов, которых нет в календаре.
+    """
+    
+    SYNC_TOKEN_SETTING = 'calendar_sync_token'
+    
+    def __init__(self, db, calendar_manager: GoogleCalendarManager = None):
+        self.db = db
+        self.calendar_manager = calendar_manager
+    
+    def run_once(self) -> Dict[str, Any]:
+        """Один проход сверки"""
+        from calendar_outbox import build_calendar_event_data
+        
+        manager = self.calendar_manager or get_calendar_manager()
+        sync_token = self.db.get_setting(self.SYNC_TOKEN_SETTING)
+        
+        try:
+            events, next_sync_token = manager.list_event_changes(sync_token)
+        except SyncTokenExpiredError:
+            logger.warning("⚠️ Sync token календаря устарел, выполняется полная синхронизация")
+            sync_token = None
+            events, next_sync_token = manager.list_event_changes(None)
+        
+        stats = {
+            'full_sync': sync_token is None,
+            'changed_events': len(events),
+            'recreated': 0,
+            'repaired': 0,
+            'orphans_deleted': 0
+        }
+        
+        trips = self.db.get_trips_by_calendar_events([event['id'] for event in events])
+        orphan_event_ids = []
+        
+        for event in events:
+            trip = trips.get(event['id'])
+            private = event.get('extendedProperties', {}).get('private', {})
+            
+            if event.get('status') == 'cancelled':
+                # Событие удалено вручную, а рейс на него ссылается
+                if trip and not trip['pending'] and self.db.relink_trip_calendar_event(trip['id']):
+                    stats['recreated'] += 1
+                continue
+            
+            if trip is None:
+                if private.get('source') != 'expedition_system':
+                    continue
+                # Событие системы без рейса: рейс удален или событие - дубликат
+                trip_id = int(private['trip_id']) if str(private.get('trip_id', '')).isdigit() else 0
+                owner = self.db.get_trip_calendar_data(trip_id) if trip_id else None
+                if owner and not owner['calendar_event_id']:
+                    # Событие только что создано, ID еще не записан в рейс
+                    continue
+                orphan_event_ids.append(event['id'])
+                continue
+            
+            if trip['pending']:
+                continue
+            
+            # Событие изменено вручную: сравниваем поля, которые формирует система
+            trip_row = self.db.get_trip_calendar_data(trip['id'])
+            if not trip_row:
+                continue
+            expected, _, _ = manager._build_trip_event_body(*build_calendar_event_data(trip_row))
+            if event.get('summary') != expected['summary'] or event.get('colorId') != expected['colorId']:
+                self.db.enqueue_calendar_mutation(trip['id'], 'update')
+                stats['repaired'] += 1
+        
+        if stats['full_sync']:
+            # Рейсы со ссылками на события, которых нет в календаре
+            live_events = {event['id'] for event in events if event.get('status') != 'cancelled'}
+            for event_id, trip in self.db.get_trips_with_calendar_events().items():
+                if event_id not in live_events and not trip['pending'] and self.db.relink_trip_calendar_event(trip['id']):
+                    stats['recreated'] += 1
+        
+        if orphan_event_ids:
+            # Рейсов у этих событий нет - удаляем напрямую, минуя очередь рейсов
+            results = manager.delete_trip_events_batch(orphan_event_ids)
+            stats['orphans_deleted'] = sum(results.values())
+        
+        self.db.set_setting(self.SYNC_TOKEN_SETTING, next_sync_token, 'Sync token сверки Google Calendar')
+        
+        logger.info(
+            f"🔄 Сверка календаря: изменений {stats['changed_events']}, пересоздано {stats['recreated']}, "
+            f"исправлено {stats['repaired']}, удалено лишних {stats['orphans_deleted']}"
+            f"{' (полная синхронизация)' if stats['full_sync'] else ''}"
+        )
+        return stats
+    
+    async def run_periodic(self, interval: float = 900.0):
+        """Периодическая сверка в фоне"""
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logger.error(f"❌ Ошибка сверки календаря: {e}")
+            await asyncio.sleep(interval)
+
 # Функция-обертка для интеграции в основное приложение
 class CalendarIntegration:
     """Обертка для интеграции с Google Calendar в системе экспедирования"""
     
-    def __init__(self, enabled: bool = True):
+    def __init__(self, enabled: bool = True, api_url: str = None):
         self.enabled = enabled and GOOGLE_CALENDAR_AVAILABLE
         self.calendar_manager = None
         
         if self.enabled:
-            self.calendar_manager = GoogleCalendarManager()
+            self.calendar_manager = get_calendar_manager(api_url=api_url)
     
     def create_trip_event_sync(self, trip_data: Dict[str, Any], user_data: Dict[str, Any]) -> Optional[str]:
         """Синхронная версия создания события"""
@@ -518,6 +1052,36 @@ class CalendarIntegration:
             logger.error(f"❌ Ошибка удаления события в календаре: {e}")
             return False
     
+    def delete_trip_events_batch_sync(self, event_ids: List[str]) -> Dict[str, bool]:
+        """Пакетное удаление событий"""
+        if not self.enabled or not self.calendar_manager:
+            logger.info("ℹ️ Google Calendar отключен, события не удалены")
+            return {event_id: False for event_id in event_ids}
+        
+        try:
+            return self.calendar_manager.delete_trip_events_batch(event_ids)
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетного удаления событий в календаре: {e}")
+            return {event_id: False for event_id in event_ids}
+    
+    def update_trip_events_batch_sync(self, items: List[Tuple[str, Dict[str, Any], Dict[str, Any]]]) -> Dict[str, bool]:
+        """Пакетное обновление событий"""
+        if not self.enabled or not self.calendar_manager:
+            logger.info("ℹ️ Google Calendar отключен, события не обновлены")
+            return {event_id: False for event_id, _, _ in items}
+        
+        try:
+            return self.calendar_manager.update_trip_events_batch(items)
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетного обновления событий в календаре: {e}")
+            return {event_id: False for event_id, _, _ in items}
+    
+    def circuit_retry_after(self) -> float:
+        """Секунд до возобновления вызовов Google (0 - выключатель замкнут)"""
+        if not self.enabled or not self.calendar_manager:
+            return 0.0
+        return self.calendar_manager.circuit_breaker.retry_after()
+    
     def test_connection(self) -> Dict[str, Any]:
         """Тестирование подключения"""
         if not self.enabled:
@@ -527,9 +1091,18 @@ class CalendarIntegration:
                 'calendar_info': None
             }
         
+        quota_retry_after = self.calendar_manager.quota_retry_after(2)
+        if quota_retry_after > self.calendar_manager.RATE_LIMIT_MAX_WAIT:
+            return {
+                'success': False,
+                'message': f'Квота вызовов Google Calendar исчерпана, повтор через {quota_retry_after:.0f}с',
+                'calendar_info': None
+            }
+        
         try:
             if self.calendar_manager.test_connection():
-                calendar = self.calendar_manager.service.calendars().get(calendarId='primary').execute()
+                calendar = self.calendar_manager._execute(
+                    self.calendar_manager.service.calendars().get(calendarId='primary'))
                 return {
                     'success': True,
                     'message': 'Подключение успешно',
@@ -567,9 +1140,9 @@ class CalendarIntegration:
         return self.calendar_manager.get_connection_status()
 
 # Глобальная функция для получения интеграции календаря
-def get_calendar_integration(enabled: bool = True) -> CalendarIntegration:
-    """Получение экземпляра интеграции календаря"""
-    return CalendarIntegration(enabled=enabled)
+def get_calendar_integration(enabled: bool = True, api_url: str = None) -> CalendarIntegration:
+    """Получение экземпляра интеграции календаря (менеджер календаря общий для процесса)"""
+    return CalendarIntegration(enabled=enabled, api_url=api_url)
 
 # Функция для печати инструкций по настройке
 def print_setup_instructions():
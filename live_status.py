@@ -0,0 +1,178 @@
+# live_status.py - Закрепленное сообщение «текущий рейс» водителя, которое бот редактирует на месте
+
+import asyncio
+import logging
+from typing import Dict, Any, Optional, Callable, Tuple, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramAPIError
+from aiogram.types import InlineKeyboardMarkup
+
+from database import DatabaseManager
+from message_queue import OutgoingMessageQueue, PRIORITY_NOTIFICATION
+from trip_events import trip_events
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class TripStatusBoard:
+    """Одно сообщение со статусом рейса на водителя вместо нового сообщения на каждый шаг.
+
+    Доска подписана на шину событий рейсов: создание, начало, завершение,
+    отмена и удаление рейса (из бота или веб-интерфейса) помечают водителя
+    измененным. Изменения копятся debounce секунд и затем применяются одной
+    пачкой: по каждому водителю - только последнее состояние рейса, и
+    только если текст сообщения изменился. Статус редактируется в уже
+    отправленном сообщении (editMessageText через очередь исходящих с
+    приоритетом уведомлений); первое сообщение (или новое, если старое
+    удалено) отправляется и закрепляется. Номера сообщений хранятся в
+    таблице trip_status_messages и переживают перезапуск. render(trip)
+    возвращает текст и inline-клавиатуру статуса, owns(chat_id) - обслуживает
+    ли водителя этот процесс бота.
+    """
+
+    def __init__(self, bot: Bot, db: DatabaseManager, outbox: OutgoingMessageQueue,
+                 render: Callable[[Dict[str, Any]], Tuple[str, Optional[InlineKeyboardMarkup]]],
+                 debounce: float = 1.0, owns: Callable[[int], bool] = None):
+        self.bot = bot
+        self.db = db
+        self.outbox = outbox
+        self.render = render
+        self.debounce = debounce
+        self.owns = owns or (lambda chat_id: True)
+        self._records: Dict[int, Dict[str, Any]] = {}      # user_id -> chat_id, message_id, text
+        self._dirty: Dict[int, Dict[str, Any]] = {}        # user_id -> последнее состояние рейса
+        self._inflight: Set[int] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._events: Optional[asyncio.Queue] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._tasks = set()
+        self.stats = {'events': 0, 'coalesced': 0, 'edited': 0, 'sent': 0, 'unchanged': 0, 'errors': 0}
+
+    # ===== СОБЫТИЯ =====
+
+    def start(self):
+        """Подписка на события рейсов (в цикле бота)"""
+        if self._listener is None or self._listener.done():
+            self._events = trip_events.subscribe()
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            event = await self._events.get()
+            trip = event.get('trip')
+            if not trip:
+                continue
+            self.stats['events'] += 1
+            if event['type'] == 'deleted':
+                # В событии - рейс до удаления
+                trip = {**trip, 'status': 'deleted'}
+            self.schedule(trip)
+
+    def schedule(self, trip: Dict[str, Any]):
+        """Отложенное обновление статуса водителя рейса (повторы за debounce сливаются)"""
+        user_id = trip['user_id']
+        if user_id in self._dirty:
+            self.stats['coalesced'] += 1
+        self._dirty[user_id] = trip
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.debounce, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        # Водителя, чье сообщение еще редактируется, обновим следующей пачкой
+        batch = {user_id: trip for user_id, trip in self._dirty.items() if user_id not in self._inflight}
+        for user_id in batch:
+            del self._dirty[user_id]
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch: Dict[int, Dict[str, Any]]):
+        await asyncio.gather(*(self._update(user_id, trip) for user_id, trip in batch.items()))
+
+    # ===== СООБЩЕНИЕ СТАТУСА =====
+
+    def _record(self, user_id: int) -> Optional[Dict[str, Any]]:
+        record = self._records.get(user_id)
+        if record is None:
+            record = self.db.get_trip_status_message(user_id)
+            if record is None:
+                telegram_ids = self.db.get_driver_telegram_ids([user_id])
+                if not telegram_ids:
+                    return None  # Водитель не подключил бота или заблокирован
+                record = {'chat_id': telegram_ids[0], 'message_id': None}
+            record['text'] = None
+            self._records[user_id] = record
+        return record
+
+    async def _update(self, user_id: int, trip: Dict[str, Any]):
+        self._inflight.add(user_id)
+        try:
+            record = self._record(user_id)
+            if record is None or not self.owns(record['chat_id']):
+                return
+            text, markup = self.render(trip)
+            if text == record['text']:
+                self.stats['unchanged'] += 1
+                return
+
+            chat_id = record['chat_id']
+            if record['message_id']:
+                try:
+                    await self.outbox.submit(chat_id, lambda: self.bot.edit_message_text(
+                        text, chat_id=chat_id, message_id=record['message_id'], reply_markup=markup
+                    ), PRIORITY_NOTIFICATION)
+                    record['text'] = text
+                    self.stats['edited'] += 1
+                    return
+                except TelegramBadRequest as e:
+                    if 'not modified' in str(e):
+                        record['text'] = text
+                        return
+                    # Сообщение удалено или слишком старое - отправим новое
+                    logger.info(f"ℹ️ Статус рейса водителя {user_id} отправляется заново: {e}")
+
+            message = await self.outbox.submit(
+                chat_id, lambda: self.bot.send_message(chat_id, text, reply_markup=markup), PRIORITY_NOTIFICATION
+            )
+            record.update(message_id=message.message_id, text=text)
+            self.db.save_trip_status_message(user_id, chat_id, message.message_id)
+            self.stats['sent'] += 1
+            try:
+                await self.bot.pin_chat_message(chat_id, message.message_id, disable_notification=True)
+            except TelegramAPIError as e:
+                logger.warning(f"⚠️ Не удалось закрепить статус рейса в чате {chat_id}: {e}")
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"❌ Ошибка обновления статуса рейса водителя {user_id}: {e}")
+        finally:
+            self._inflight.discard(user_id)
+            if user_id in self._dirty and self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.debounce, self._start_flush)
+
+    def forget(self, user_id: int):
+        """Сброс закэшированного сообщения водителя (вход в бота из другого чата)"""
+        self._records.pop(user_id, None)
+
+    async def close(self, timeout: float = 5.0):
+        """Применение отложенных изменений и отписка от событий"""
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+            trip_events.unsubscribe(self._events)
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._dirty:
+            self._start_flush()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'pending': len(self._dirty), 'drivers': len(self._records)}
@@ -0,0 +1,138 @@
+# login_throttle.py - Ограничение неудачных входов до проверки пароля
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, Deque, Optional
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class LoginThrottle:
+    """Скользящее окно неудачных входов по фамилии и по источнику с нарастающей блокировкой.
+
+    Каждая неудачная попытка (бот или Basic-авторизация веб-интерфейса)
+    стоит полного вычисления PBKDF2, поэтому подбор пароля или клиент с
+    неверным паролем могут занять процессор. Неудачи считаются отдельно по
+    фамилии (без учета регистра) и по источнику - чату Telegram ("tg:<id>")
+    или IP-адресу ("ip:<адрес>"). Если за window секунд неудач по ключу
+    набралось max_failures (для источника - source_max_failures), ключ
+    блокируется на lockout секунд; каждая следующая блокировка того же
+    ключа вдвое длиннее (не больше max_lockout). Пока ключ заблокирован,
+    check() отклоняет попытку сразу, без обращения к базе и хеширования.
+    Счет блокировок сбрасывается, если ключ max_lockout секунд вел себя
+    спокойно. Успешный вход сбрасывает неудачи по фамилии.
+
+    С per_source_surname=True фамилия считается отдельно для каждого
+    источника: чужие неудачные попытки не блокируют владельца учетной
+    записи, входящего со своего адреса (панель администратора - фамилию
+    admin знают все).
+
+    Ограничитель работает в памяти процесса. В bot_cluster и при
+    SYSTEM_PROCESS_MODE=multi у каждого процесса бота свои окна, и общий
+    предел неудач умножается на число процессов (чат водителя при этом
+    всегда обслуживается одним процессом).
+    """
+
+    def __init__(self, max_failures: int = 5, source_max_failures: int = 20, window: float = 300.0,
+                 lockout: float = 60.0, max_lockout: float = 3600.0, max_keys: int = 50000,
+                 per_source_surname: bool = False):
+        self.max_failures = max_failures
+        self.source_max_failures = source_max_failures
+        self.window = window
+        self.lockout = lockout
+        self.max_lockout = max_lockout
+        self.max_keys = max_keys
+        self.per_source_surname = per_source_surname
+        self._failures: Dict[str, Deque[float]] = {}
+        self._lockouts: Dict[str, Dict[str, float]] = {}   # ключ -> until, strikes
+        self._lock = threading.Lock()
+        self.stats = {'checked': 0, 'rejected': 0, 'failures': 0, 'successes': 0, 'lockouts': 0}
+
+    def _surname_key(self, surname: Optional[str], source: str) -> str:
+        key = f"surname:{(surname or '').strip().lower()}"
+        return f"{key}|{source}" if self.per_source_surname else key
+
+    def check(self, surname: Optional[str], source: str) -> float:
+        """Сколько секунд еще действует блокировка фамилии или источника (0 - попытку можно проверять)"""
+        now = time.monotonic()
+        with self._lock:
+            self.stats['checked'] += 1
+            retry_after = 0.0
+            for key in (self._surname_key(surname, source), source):
+                lockout = self._lockouts.get(key)
+                if lockout and lockout['until'] > now:
+                    retry_after = max(retry_after, lockout['until'] - now)
+            if retry_after:
+                self.stats['rejected'] += 1
+            return retry_after
+
+    def record_failure(self, surname: Optional[str], source: str):
+        """Неудачный вход: учет в окнах фамилии и источника, при превышении - блокировка"""
+        now = time.monotonic()
+        with self._lock:
+            self.stats['failures'] += 1
+            for key, limit in ((self._surname_key(surname, source), self.max_failures), (source, self.source_max_failures)):
+                failures = self._failures.setdefault(key, deque())
+                failures.append(now)
+                while failures and failures[0] <= now - self.window:
+                    failures.popleft()
+                if len(failures) >= limit:
+                    del self._failures[key]
+                    self._lock_out(key, now)
+            if len(self._failures) + len(self._lockouts) > self.max_keys:
+                self._prune(now)
+
+    def _lock_out(self, key: str, now: float):
+        lockout = self._lockouts.get(key)
+        strikes = 1
+        if lockout and now - lockout['until'] < self.max_lockout:
+            strikes = lockout['strikes'] + 1
+        duration = min(self.lockout * 2 ** (strikes - 1), self.max_lockout)
+        self._lockouts[key] = {'until': now + duration, 'strikes': strikes}
+        self.stats['lockouts'] += 1
+        logger.warning(f"🔒 Вход заблокирован на {int(duration)} с: {key} (блокировка №{strikes})")
+
+    def record_success(self, surname: Optional[str], source: str):
+        """Успешный вход: неудачи по фамилии забываются (источник продолжает считаться)"""
+        with self._lock:
+            self.stats['successes'] += 1
+            key = self._surname_key(surname, source)
+            self._failures.pop(key, None)
+            self._lockouts.pop(key, None)
+
+    def _prune(self, now: float):
+        """Удаление устаревших окон и давно истекших блокировок"""
+        for key in [key for key, failures in self._failures.items() if not failures or failures[-1] <= now - self.window]:
+            del self._failures[key]
+        for key in [key for key, lockout in self._lockouts.items() if now - lockout['until'] >= self.max_lockout]:
+            del self._lockouts[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                **self.stats,
+                'locked_now': sum(1 for lockout in self._lockouts.values() if lockout['until'] > now),
+                'tracked_keys': len(self._failures),
+                'max_failures': self.max_failures,
+                'source_max_failures': self.source_max_failures,
+                'window_seconds': self.window
+            }
+
+def _throttle_from_env(per_source_surname: bool = False) -> LoginThrottle:
+    return LoginThrottle(
+        max_failures=int(os.getenv("LOGIN_MAX_FAILURES", "5")),
+        source_max_failures=int(os.getenv("LOGIN_SOURCE_MAX_FAILURES", "20")),
+        window=float(os.getenv("LOGIN_FAILURE_WINDOW", "300")),
+        lockout=float(os.getenv("LOGIN_LOCKOUT", "60")),
+        max_lockout=float(os.getenv("LOGIN_MAX_LOCKOUT", "3600")),
+        per_source_surname=per_source_surname
+    )
+
+# Вход водителей в бота
+login_throttle = _throttle_from_env()
+# Basic-авторизация панели администратора: фамилия блокируется только для адреса, с которого ошибались
+admin_login_throttle = _throttle_from_env(per_source_surname=True)
@@ -1,19 +1,29 @@
 # main.py - Исправленный главный файл для запуска всей системы экспедирования
 
 import asyncio
-import threading
+import contextlib
+import signal
 import time
 import os
 import sys
 import logging
+import secrets
 from datetime import datetime
+from typing import Optional
 from telegram_bot import ExpeditionBot
 
+import uvicorn
+
 
 # Импорт модулей системы
 from database import DatabaseManager
 from telegram_bot import ExpeditionBot
-from web_app import app, create_templates
+from web_app import (
+    app, create_templates, register_telegram_webhook, register_telegram_bot, set_system_status, TELEGRAM_WEBHOOK_PATH
+)
+from calendar_outbox import CalendarOutboxWorker
+from bot_cluster import BotCluster
+from cache_sync import CacheInvalidationChannel
 
 # Безопасный импорт Google Calendar
 try:
@@ -48,6 +58,34 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+class WebServer(uvicorn.Server):
+    """uvicorn.Server, работающий задачей в общем цикле событий системы.
+    
+    Сигналы остановки перехватывает не сервер, а ExpeditionSystem (плавная
+    остановка всех компонентов по порядку). Событие ready выставляется,
+    когда сервер начал принимать соединения.
+    """
+    
+    def __init__(self, config: uvicorn.Config):
+        super().__init__(config)
+        self.ready = asyncio.Event()
+    
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+    
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started:
+            self.ready.set()
+    
+    async def serve(self, sockets=None):
+        try:
+            await super().serve(sockets=sockets)
+        except SystemExit:
+            # uvicorn завершает процесс, если не удалось занять порт или запустить приложение
+            logger.error(f"❌ Веб-сервер не запустился на {self.config.host}:{self.config.port}")
+
 class ExpeditionSystem:
     """Главный класс системы экспедирования"""
     
@@ -55,13 +93,32 @@ class ExpeditionSystem:
         self.db_manager = None
         self.telegram_bot = None
         self.calendar_integration = None
-        self.web_app_process = None
+        self.calendar_outbox = None
+        self.web_server = None
+        self._stop_requested: Optional[asyncio.Event] = None
+        self._component_tasks = []
         
         # Настройки из переменных окружения
         self.telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
         self.web_host = os.getenv("WEB_HOST", "0.0.0.0")
         self.web_port = int(os.getenv("WEB_PORT", "8000"))
         self.google_calendar_enabled = os.getenv("GOOGLE_CALENDAR_ENABLED", "true").lower() == "true"
+        self.calendar_reconcile_interval = float(os.getenv("CALENDAR_RECONCILE_INTERVAL", "900"))
+        
+        # Режим получения обновлений Telegram: polling или webhook
+        self.telegram_mode = os.getenv("TELEGRAM_MODE", "polling").lower()
+        # Публичный https-адрес веб-сервера, на который Telegram шлет обновления
+        self.telegram_webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip('/')
+        # Без явного секрета генерируем новый при каждом запуске (webhook переустанавливается)
+        self.telegram_webhook_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+        # Процессов бота (1 - бот работает в главном процессе) и первый порт их внутренних HTTP-серверов
+        self.telegram_workers = int(os.getenv("TELEGRAM_WORKERS", "1"))
+        self.telegram_worker_base_port = int(os.getenv("TELEGRAM_WORKER_BASE_PORT", "8100"))
+        # Режим процессов: single - веб-сервер и бот в одном цикле событий (при TELEGRAM_WORKERS=1),
+        # multi - бот всегда в отдельных процессах под надзором главного (bot_cluster)
+        self.process_mode = os.getenv("SYSTEM_PROCESS_MODE", "single").lower()
+        # Сколько ждать каждый компонент при плавной остановке, прежде чем прервать его (секунды)
+        self.shutdown_timeout = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
         
     def initialize_database(self):
         """Инициализация базы данных"""
@@ -103,7 +160,15 @@ class ExpeditionSystem:
         
         logger.info("🤖 Инициализация Telegram бота...")
         try:
-            self.telegram_bot = ExpeditionBot(self.telegram_token, self.db_manager)
+            if self.telegram_workers > 1 or self.process_mode == 'multi':
+                # Обновления делятся между процессами бота, главный процесс - диспетчер
+                self.telegram_bot = BotCluster(
+                    self.telegram_token, self.db_manager.db_path, max(1, self.telegram_workers),
+                    base_port=self.telegram_worker_base_port, api_url=os.getenv("TELEGRAM_API_URL")
+                )
+            else:
+                self.telegram_bot = ExpeditionBot(self.telegram_token, self.db_manager)
+            register_telegram_bot(self.telegram_bot)
             logger.info("✅ Telegram бот инициализирован успешно")
             return True
         except Exception as e:
@@ -175,22 +240,18 @@ class ExpeditionSystem:
             logger.error(f"❌ Ошибка создания демонстрационных данных: {e}")
             return False
     
-    def run_web_app(self):
-        """Запуск веб-приложения в отдельном потоке"""
-        import uvicorn
-        
+    def create_web_server(self) -> WebServer:
+        """Веб-сервер для запуска задачей в цикле событий системы"""
         logger.info(f"🌐 Запуск веб-приложения на {self.web_host}:{self.web_port}...")
-        
-        try:
-            uvicorn.run(
-                app,
-                host=self.web_host,
-                port=self.web_port,
-                log_level="info",
-                access_log=True
-            )
-        except Exception as e:
-            logger.error(f"❌ Ошибка запуска веб-приложения: {e}")
+        return WebServer(uvicorn.Config(
+            app,
+            host=self.web_host,
+            port=self.web_port,
+            log_level="info",
+            access_log=True,
+            # Открытые запросы (в т.ч. потоки SSE) при остановке дорабатывают не дольше этого
+            timeout_graceful_shutdown=int(self.shutdown_timeout)
+        ))
     
     async def run_telegram_bot(self):
         """Запуск Telegram бота"""
@@ -203,6 +264,15 @@ class ExpeditionSystem:
         logger.info(f"🔍 Методы объекта: {[method for method in dir(self.telegram_bot) if not method.startswith('_')]}")
         
         try:
+            if isinstance(self.telegram_bot, BotCluster):
+                await self.run_telegram_cluster()
+                return
+            
+            if self.telegram_mode == 'webhook':
+                if await self.run_telegram_webhook():
+                    return
+                logger.warning("⚠️ Webhook недоступен, бот переходит на long polling")
+            
             if hasattr(self.telegram_bot, 'start_polling'):
                 await self.telegram_bot.start_polling()
             else:
@@ -210,6 +280,47 @@ class ExpeditionSystem:
         except Exception as e:
             logger.error(f"❌ Ошибка запуска Telegram бота: {e}")
     
+    async def run_telegram_webhook(self) -> bool:
+        """Работа бота через webhook веб-приложения (False - нужно перейти на polling)"""
+        if not self.telegram_webhook_url:
+            logger.error("❌ Для режима webhook не задан TELEGRAM_WEBHOOK_URL")
+            return False
+        
+        webhook_url = self.telegram_webhook_url + TELEGRAM_WEBHOOK_PATH
+        register_telegram_webhook(self.telegram_bot)
+        try:
+            return await self.telegram_bot.start_webhook(webhook_url, self.telegram_webhook_secret)
+        finally:
+            register_telegram_webhook(None)
+    
+    async def run_telegram_cluster(self):
+        """Работа бота несколькими процессами: главный процесс получает обновления и пересылает их"""
+        cluster = self.telegram_bot
+        # Сбросы кэшей веб-приложения уходят процессам бота, события рейсов приходят в SSE
+        channel = CacheInvalidationChannel(self.db_manager)
+        channel.attach()
+        try:
+            if not await cluster.start():
+                logger.warning("⚠️ Не все процессы бота запустились, обновления их водителей ждут перезапуска")
+            
+            if self.telegram_mode == 'webhook':
+                if not self.telegram_webhook_url:
+                    logger.error("❌ Для режима webhook не задан TELEGRAM_WEBHOOK_URL")
+                else:
+                    register_telegram_webhook(cluster)
+                    try:
+                        if await cluster.run_webhook(self.telegram_webhook_url + TELEGRAM_WEBHOOK_PATH,
+                                                     self.telegram_webhook_secret):
+                            return
+                    finally:
+                        register_telegram_webhook(None)
+                logger.warning("⚠️ Webhook недоступен, бот переходит на long polling")
+            
+            await cluster.run_polling()
+        finally:
+            await cluster.stop()
+            channel.close()
+    
     def print_startup_info(self):
         """Вывод информации о запуске системы"""
         print("\n" + "="*60)
@@ -218,7 +329,9 @@ class ExpeditionSystem:
         print(f"📅 Запуск: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}")
         print(f"🌐 Веб-интерфейс: http://localhost:{self.web_port}")
         print(f"👤 Администратор: admin / admin123")
-        print(f"🤖 Telegram бот: {'✅ Активен' if self.telegram_bot else '❌ Отключен'}")
+        print(f"🤖 Telegram бот: {'✅ Активен' if self.telegram_bot else '❌ Отключен'}"
+              f"{f' ({self.telegram_mode}, процессов: {self.telegram_workers})' if self.telegram_bot else ''}")
+        print(f"⚙️ Процессы: {'бот отдельно от веб-сервера' if isinstance(self.telegram_bot, BotCluster) else 'веб-сервер и бот в одном процессе'}")
         print(f"📅 Google Calendar: {'✅ Активен' if self.calendar_integration and self.calendar_integration.enabled else '❌ Отключен'}")
         print("="*60)
         
@@ -248,8 +361,94 @@ class ExpeditionSystem:
         print("   • Остановка: Ctrl+C")
         print("="*60)
     
+    # ===== ЗАПУСК И ОСТАНОВКА =====
+    
+    def install_signal_handlers(self):
+        """SIGINT/SIGTERM - плавная остановка, повторный сигнал - немедленная"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig)
+            except NotImplementedError:
+                # Windows: цикл событий не поддерживает обработчики сигналов - передаем остановку в цикл сами
+                signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(self.request_stop, signum))
+    
+    def request_stop(self, sig: Optional[int] = None):
+        """Запрос плавной остановки системы (повторный запрос прерывает ее)"""
+        name = signal.Signals(sig).name if sig else "запрос"
+        if self._stop_requested.is_set():
+            logger.warning(f"⚠️ Повторный сигнал остановки ({name}), немедленное завершение")
+            if self.web_server:
+                self.web_server.force_exit = True
+                self.web_server.should_exit = True
+            for task in self._component_tasks:
+                task.cancel()
+            return
+        logger.info(f"🛑 Получен сигнал остановки ({name}), плавная остановка...")
+        self._stop_requested.set()
+    
+    async def wait_web_ready(self, web_task: asyncio.Task) -> bool:
+        """Ожидание готовности веб-сервера (False - сервер завершился, не запустившись)"""
+        ready = asyncio.create_task(self.web_server.ready.wait())
+        await asyncio.wait({ready, web_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not ready.done():
+            ready.cancel()
+            return False
+        return True
+    
+    async def supervise(self, web_task: asyncio.Task, bot_task: Optional[asyncio.Task]):
+        """Ожидание сигнала остановки; остановившийся раньше веб-сервер останавливает и систему"""
+        stop_requested = asyncio.create_task(self._stop_requested.wait())
+        watched = {stop_requested, web_task} | ({bot_task} if bot_task else set())
+        while not stop_requested.done():
+            done, _ = await asyncio.wait(watched, return_when=asyncio.FIRST_COMPLETED)
+            if web_task in done:
+                logger.error("❌ Веб-сервер остановился, остановка системы")
+                break
+            if bot_task in done:
+                # Без бота система продолжает работать: токен можно исправить в веб-интерфейсе
+                watched.discard(bot_task)
+                logger.error("❌ Telegram бот остановился, веб-интерфейс продолжает работу")
+        stop_requested.cancel()
+    
+    async def finish_component(self, task: Optional[asyncio.Task], name: str):
+        """Ожидание завершения компонента не дольше shutdown_timeout, затем прерывание"""
+        if task is None:
+            return
+        done, _ = await asyncio.wait({task}, timeout=self.shutdown_timeout)
+        if not done:
+            logger.warning(f"⚠️ {name}: не остановился за {self.shutdown_timeout:.0f} с, прерывание")
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    
+    async def shutdown(self, web_task: asyncio.Task, bot_task: Optional[asyncio.Task],
+                       outbox_task: asyncio.Task, reconcile_task: Optional[asyncio.Task]):
+        """Плавная остановка по порядку: прием обновлений бота, фоновые задачи, затем веб-сервер"""
+        # /ready отвечает 503 - балансировщик перестает направлять запросы, потоки SSE закрываются
+        set_system_status(ready=False, draining=True)
+        
+        # 1. Бот перестает принимать обновления и дорабатывает принятые
+        #    (webhook отвечает 503 - Telegram доставит обновления после перезапуска)
+        if bot_task and not bot_task.done():
+            try:
+                await asyncio.wait_for(self.telegram_bot.request_stop(), self.shutdown_timeout)
+            except asyncio.TimeoutError:
+                pass
+            await self.finish_component(bot_task, "Telegram бот")
+        
+        # 2. Сверка и очередь изменений Google Calendar (текущая пачка дописывается)
+        if reconcile_task:
+            reconcile_task.cancel()
+            await asyncio.gather(reconcile_task, return_exceptions=True)
+        self.calendar_outbox.stop()
+        await self.finish_component(outbox_task, "Очередь Google Calendar")
+        
+        # 3. Веб-сервер: новые соединения не принимаются, открытые запросы дорабатываются
+        self.web_server.should_exit = True
+        await asyncio.gather(web_task, return_exceptions=True)
+    
     async def run_system(self):
-        """Запуск всей системы"""
+        """Запуск всей системы: веб-сервер, бот и фоновые задачи - задачи одного цикла событий"""
         logger.info("🚀 Запуск системы экспедирования...")
         
         # Инициализация компонентов
@@ -267,35 +466,41 @@ class ExpeditionSystem:
         # Вывод информации о запуске
         self.print_startup_info()
         
-        # Запуск веб-приложения в отдельном потоке
-        web_thread = threading.Thread(
-            target=self.run_web_app,
-            daemon=True,
-            name="WebAppThread"
-        )
-        web_thread.start()
+        self._stop_requested = asyncio.Event()
+        self.install_signal_handlers()
+        
+        # Веб-сервер первым: бот в режиме webhook запускается, только когда сервер принимает соединения
+        self.web_server = self.create_web_server()
+        web_task = asyncio.create_task(self.web_server.serve(), name="web")
+        if not await self.wait_web_ready(web_task):
+            logger.error("❌ Критическая ошибка: веб-сервер не запустился")
+            return False
+        
+        # Обработчик очереди изменений Google Calendar
+        self.calendar_outbox = CalendarOutboxWorker(self.db_manager, self.calendar_integration)
+        outbox_task = asyncio.create_task(self.calendar_outbox.run(), name="calendar_outbox")
         
-        # Небольшая задержка для запуска веб-сервера
-        await asyncio.sleep(2)
+        # Периодическая сверка календаря с рейсами
+        reconcile_task = None
+        if self.calendar_integration and self.calendar_integration.enabled:
+            from google_calendar import CalendarReconciler
+            reconciler = CalendarReconciler(self.db_manager)
+            reconcile_task = asyncio.create_task(reconciler.run_periodic(self.calendar_reconcile_interval), name="calendar_reconcile")
         
         # Запуск Telegram бота (если доступен)
+        bot_task = None
         if telegram_ready:
-            try:
-                await self.run_telegram_bot()
-            except KeyboardInterrupt:
-                logger.info("🛑 Получен сигнал остановки")
-            except Exception as e:
-                logger.error(f"❌ Ошибка работы Telegram бота: {e}")
+            bot_task = asyncio.create_task(self.run_telegram_bot(), name="telegram")
         else:
             logger.info("⏳ Система работает только с веб-интерфейсом")
-            logger.info("🌐 Веб-интерфейс доступен по адресу: http://localhost:8000")
-            
-            # Ожидание сигнала остановки
-            try:
-                while True:
-                    await asyncio.sleep(1)
-            except KeyboardInterrupt:
-                logger.info("🛑 Получен сигнал остановки")
+            logger.info(f"🌐 Веб-интерфейс доступен по адресу: http://localhost:{self.web_port}")
+        
+        self._component_tasks = [task for task in (bot_task, outbox_task, reconcile_task) if task]
+        set_system_status(ready=True, draining=False)
+        logger.info("✅ Система запущена, остановка: Ctrl+C или SIGTERM")
+        
+        await self.supervise(web_task, bot_task)
+        await self.shutdown(web_task, bot_task, outbox_task, reconcile_task)
         
         logger.info("📴 Система экспедирования остановлена")
         return True
@@ -360,6 +565,51 @@ def create_env_file():
 # Токен Telegram бота (получить у @BotFather)
 TELEGRAM_BOT_TOKEN=YOUR_BOT_TOKEN_HERE
 
+# Режим получения обновлений бота: polling или webhook
+TELEGRAM_MODE=polling
+
+# Для webhook: публичный https-адрес веб-сервера и секрет (пусто - генерируется при запуске)
+# TELEGRAM_WEBHOOK_URL=https://example.com
+# TELEGRAM_WEBHOOK_SECRET=
+
+# Лимиты исходящих сообщений бота: всего в секунду, в один чат в секунду и запас на короткий всплеск
+TELEGRAM_GLOBAL_RATE=30
+TELEGRAM_CHAT_RATE=1
+TELEGRAM_CHAT_BURST=3
+
+# Входящие обновления: воркеров (обновления одного водителя - по порядку) и предел обновлений в работе
+TELEGRAM_UPDATE_WORKERS=32
+TELEGRAM_MAX_PENDING_UPDATES=1000
+
+# Статус рейса одним закрепленным сообщением, которое бот редактирует (true/false),
+# и задержка, за которую изменения статуса сливаются в одну правку (секунды)
+TELEGRAM_LIVE_STATUS=false
+TELEGRAM_LIVE_STATUS_DEBOUNCE=1.0
+
+# Процессов бота (водитель всегда обслуживается одним процессом; 1 - бот в главном процессе)
+# и первый порт их внутренних HTTP-серверов на 127.0.0.1 (заняты порты с него до +число процессов)
+TELEGRAM_WORKERS=1
+TELEGRAM_WORKER_BASE_PORT=8100
+
+# Потоков для хеширования паролей PBKDF2 (вход водителей и администраторов, сброс паролей; 0 - по числу ядер)
+PASSWORD_HASH_WORKERS=0
+
+# Неудачные входы: блокировка после LOGIN_MAX_FAILURES неудач по фамилии (LOGIN_SOURCE_MAX_FAILURES -
+# с одного чата/IP) за LOGIN_FAILURE_WINDOW секунд; первая блокировка LOGIN_LOCKOUT секунд,
+# каждая следующая вдвое дольше, но не дольше LOGIN_MAX_LOCKOUT
+LOGIN_MAX_FAILURES=5
+LOGIN_SOURCE_MAX_FAILURES=20
+LOGIN_FAILURE_WINDOW=300
+LOGIN_LOCKOUT=60
+LOGIN_MAX_LOCKOUT=3600
+
+# Режим процессов: single - веб-сервер и бот в одном процессе (при TELEGRAM_WORKERS=1),
+# multi - бот в отдельных процессах, которые главный процесс перезапускает при сбое
+SYSTEM_PROCESS_MODE=single
+
+# Сколько ждать каждый компонент при остановке по SIGTERM/Ctrl+C (секунды); повторный сигнал - сразу
+SHUTDOWN_TIMEOUT=30
+
 # Настройки веб-сервера
 WEB_HOST=0.0.0.0
 WEB_PORT=8000
@@ -367,6 +617,20 @@ WEB_PORT=8000
 # Google Calendar интеграция (true/false)
 GOOGLE_CALENDAR_ENABLED=true
 
+# Интервал сверки календаря с рейсами (секунды)
+CALENDAR_RECONCILE_INTERVAL=900
+
+# Адрес заменителя Calendar API (python fake_google_calendar.py), пусто - Google
+# GOOGLE_CALENDAR_API_URL=http://127.0.0.1:8089/
+
+# Лимиты вызовов Google Calendar API (0 - без ограничения)
+GOOGLE_CALENDAR_RATE_PER_SECOND=5
+GOOGLE_CALENDAR_RATE_PER_DAY=500000
+
+# Выключатель: ошибок подряд до паузы и длительность паузы (секунды)
+GOOGLE_CALENDAR_BREAKER_THRESHOLD=5
+GOOGLE_CALENDAR_BREAKER_TIMEOUT=30
+
 # Настройки базы данных
 DATABASE_PATH=expedition.db
 
@@ -499,7 +763,9 @@ def main():
     # Запуск системы
     try:
         system = ExpeditionSystem()
-        asyncio.run(system.run_system())
+        if not asyncio.run(system.run_system()):
+            # Ненулевой код - менеджер процессов (systemd, Docker) перезапустит систему
+            sys.exit(1)
     except KeyboardInterrupt:
         logger.info("🛑 Система остановлена пользователем")
     except Exception as e:
@@ -0,0 +1,278 @@
+# message_queue.py - Очередь исходящих сообщений бота с соблюдением лимитов Telegram
+
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextvars import ContextVar
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.methods import TelegramMethod
+
+from rate_limit import TokenBucket
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше - раньше
+PRIORITY_INTERACTIVE = 0    # ответы на действия водителя
+PRIORITY_NOTIFICATION = 1   # уведомления конкретному водителю
+PRIORITY_BROADCAST = 2      # массовые рассылки
+
+# Методы, на которые действуют лимиты Telegram (отправка и изменение сообщений в чате)
+RATE_LIMITED_PREFIXES = ('send', 'copy', 'forward', 'edit')
+UNLIMITED_METHODS = {'sendChatAction'}
+
+# Признак того, что запрос выполняется самой очередью (middleware его пропускает)
+_dispatching: ContextVar[bool] = ContextVar('outgoing_dispatching', default=False)
+
+ChatId = Union[int, str]
+
+class _Outgoing:
+    """Сообщение в очереди чата"""
+
+    __slots__ = ('priority', 'seq', 'call', 'future', 'attempts', 'queued_at')
+
+    def __init__(self, priority: int, seq: int, call: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.call = call
+        self.future = future
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other: '_Outgoing') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutgoingMessageQueue:
+    """Планировщик исходящих запросов к Bot API.
+
+    У каждого чата своя очередь (по приоритету, внутри приоритета - по
+    порядку) и ведро токенов chat_rate/chat_burst; общее ведро global_rate
+    ограничивает бота целиком. Диспетчер выбирает чат с самым приоритетным
+    сообщением, у которого есть токен, так что ответы водителям обгоняют
+    рассылку, а чат, ждущий своего токена, не задерживает остальные. В
+    каждом чате одновременно отправляется не больше одного сообщения -
+    порядок ответов сохраняется. Ответ 429 откладывает чат на retry_after и
+    повторяет то же сообщение. Работает в цикле событий бота.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_attempts: int = 5, max_retry_after: float = 120.0, idle_chat_ttl: float = 300.0):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.max_retry_after = max_retry_after
+        self.idle_chat_ttl = idle_chat_ttl
+        self._seq = itertools.count()
+        self._chats: Dict[ChatId, List[_Outgoing]] = {}
+        self._buckets: Dict[ChatId, TokenBucket] = {}
+        self._chat_state: Dict[ChatId, str] = {}           # ready / delayed / sending
+        self._ready: List[tuple] = []                      # (priority, seq, chat_id)
+        self._delayed: List[tuple] = []                    # (ready_at, seq, chat_id)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._sending = set()
+        self._last_prune = time.monotonic()
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0, 'max_queue_wait_ms': 0.0}
+
+    # ===== ПОСТАНОВКА В ОЧЕРЕДЬ =====
+
+    def submit_nowait(self, chat_id: ChatId, call: Callable[[], Awaitable[Any]],
+                      priority: int = PRIORITY_INTERACTIVE) -> asyncio.Future:
+        """Постановка запроса в очередь чата; результат - future с ответом Bot API"""
+        future = asyncio.get_running_loop().create_future()
+        item = _Outgoing(priority, next(self._seq), call, future)
+        heapq.heappush(self._chats.setdefault(chat_id, []), item)
+        self.stats['queued'] += 1
+
+        state = self._chat_state.get(chat_id)
+        if state is None or state == 'ready':
+            # Новая запись в куче готовых: старую с меньшим приоритетом диспетчер пропустит
+            self._mark_ready(chat_id)
+        self._ensure_dispatcher()
+        return future
+
+    async def submit(self, chat_id: ChatId, call: Callable[[], Awaitable[Any]],
+                     priority: int = PRIORITY_INTERACTIVE) -> Any:
+        """Постановка в очередь и ожидание отправки"""
+        return await self.submit_nowait(chat_id, call, priority)
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._chats.values())
+
+    # ===== ДИСПЕТЧЕР =====
+
+    def _mark_ready(self, chat_id: ChatId):
+        queue = self._chats.get(chat_id)
+        if not queue:
+            self._chat_state.pop(chat_id, None)
+            return
+        self._chat_state[chat_id] = 'ready'
+        heapq.heappush(self._ready, (queue[0].priority, queue[0].seq, chat_id))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _delay(self, chat_id: ChatId, seconds: float):
+        self._chat_state[chat_id] = 'delayed'
+        heapq.heappush(self._delayed, (time.monotonic() + seconds, next(self._seq), chat_id))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _bucket(self, chat_id: ChatId) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def _dispatch_loop(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                if self._chat_state.get(chat_id) == 'delayed':
+                    self._mark_ready(chat_id)
+
+            if not self._ready:
+                self._prune_buckets(now)
+                timeout = (self._delayed[0][0] - now) if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            queue = self._chats.get(chat_id)
+            if self._chat_state.get(chat_id) != 'ready' or not queue or (queue[0].priority, queue[0].seq) != (priority, seq):
+                continue  # Устаревшая запись
+
+            # Отмененные ожидающими сообщения не отправляем
+            while queue and queue[0].future.done():
+                heapq.heappop(queue)
+                self.stats['dropped'] += 1
+            if not queue:
+                self._mark_ready(chat_id)
+                continue
+
+            bucket = self._bucket(chat_id)
+            chat_wait = bucket.time_until(1)
+            if chat_wait > 0:
+                self._delay(chat_id, chat_wait)
+                continue
+            bucket.reserve(1)
+
+            global_wait = self.global_bucket.reserve(1)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+
+            item = heapq.heappop(queue)
+            self._chat_state[chat_id] = 'sending'
+            task = asyncio.create_task(self._send(chat_id, item))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat_id: ChatId, item: _Outgoing):
+        _dispatching.set(True)
+        queue_wait_ms = (time.monotonic() - item.queued_at) * 1000
+        self.stats['max_queue_wait_ms'] = max(self.stats['max_queue_wait_ms'], round(queue_wait_ms, 1))
+        item.attempts += 1
+        try:
+            result = await item.call()
+        except TelegramRetryAfter as e:
+            if item.attempts < self.max_attempts and e.retry_after <= self.max_retry_after:
+                logger.warning(f"⏳ Telegram ограничил отправку в чат {chat_id}: повтор через {e.retry_after}с")
+                self.stats['retried'] += 1
+                heapq.heappush(self._chats.setdefault(chat_id, []), item)
+                self._delay(chat_id, e.retry_after)
+                return
+            self._fail(item, e)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован водителем или запрос некорректен - повтор не поможет
+            logger.warning(f"⚠️ Сообщение в чат {chat_id} не доставлено: {e}")
+            self._fail(item, e)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self.stats['sent'] += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        self._mark_ready(chat_id)
+
+    def _fail(self, item: _Outgoing, error: Exception):
+        self.stats['failed'] += 1
+        if not item.future.done():
+            item.future.set_exception(error)
+
+    def _prune_buckets(self, now: float):
+        """Удаление ведер чатов, которые давно ничего не получали"""
+        if now - self._last_prune < self.idle_chat_ttl:
+            return
+        self._last_prune = now
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._chat_state and now - bucket.updated > self.idle_chat_ttl:
+                del self._buckets[chat_id]
+                self._chats.pop(chat_id, None)
+
+    async def close(self, timeout: float = 10.0):
+        """Отправка оставшихся сообщений (не дольше timeout) и остановка диспетчера"""
+        deadline = time.monotonic() + timeout
+        while (self.pending() or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+        for queue in self._chats.values():
+            for item in queue:
+                self._fail(item, RuntimeError("Очередь исходящих сообщений остановлена"))
+        dropped = self.pending()
+        if dropped:
+            logger.warning(f"⚠️ При остановке бота не отправлено сообщений: {dropped}")
+        self._chats.clear()
+        self._chat_state.clear()
+        self._ready.clear()
+        self._delayed.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'pending': self.pending(),
+            'chats_waiting': len(self._chat_state),
+            'global': self.global_bucket.get_state()
+        }
+
+class OutgoingRateLimitMiddleware(BaseRequestMiddleware):
+    """Middleware сессии aiogram: отправка сообщений в чаты идет через очередь.
+
+    Обработчики продолжают вызывать message.answer() и т.п. - запрос
+    ставится в очередь чата с приоритетом PRIORITY_INTERACTIVE, и вызов
+    возвращает ответ Bot API после отправки.
+    """
+
+    def __init__(self, queue: OutgoingMessageQueue):
+        self.queue = queue
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, 'chat_id', None)
+        api_method = method.__api_method__
+        if (_dispatching.get() or chat_id is None or api_method in UNLIMITED_METHODS
+                or not api_method.startswith(RATE_LIMITED_PREFIXES)):
+            return await make_request(bot, method)
+        return await self.queue.submit(chat_id, lambda: make_request(bot, method), PRIORITY_INTERACTIVE)
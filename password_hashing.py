@@ -0,0 +1,80 @@
+# password_hashing.py - Хеширование паролей (PBKDF2) в пуле потоков
+
+import os
+import hmac
+import asyncio
+import hashlib
+import logging
+import secrets
+import concurrent.futures
+from typing import Dict, Any, List, Optional
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Параметры PBKDF2 (формат хеша в базе: "соль:хеш" в hex)
+PBKDF2_ALGORITHM = 'sha256'
+PBKDF2_ITERATIONS = 100000
+
+def hash_password(password: str) -> str:
+    """Хеш пароля со случайной солью"""
+    salt = secrets.token_hex(16)
+    pwd_hash = hashlib.pbkdf2_hmac(PBKDF2_ALGORITHM, password.encode('utf-8'), salt.encode('utf-8'), PBKDF2_ITERATIONS)
+    return f"{salt}:{pwd_hash.hex()}"
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Проверка пароля по хешу из базы (сравнение за постоянное время)"""
+    try:
+        salt, stored_hash = password_hash.split(':')
+        pwd_hash = hashlib.pbkdf2_hmac(PBKDF2_ALGORITHM, password.encode('utf-8'), salt.encode('utf-8'), PBKDF2_ITERATIONS)
+        return hmac.compare_digest(pwd_hash.hex(), stored_hash)
+    except (ValueError, AttributeError):
+        return False
+
+class PasswordHasher:
+    """Пул для PBKDF2: 100 000 итераций - десятки миллисекунд процессора на пароль.
+
+    hashlib.pbkdf2_hmac отпускает GIL на время вычисления, поэтому потоки
+    пула считают хеши параллельно на всех ядрах, а циклы событий бота и
+    веб-сервера в это время продолжают работу. Число потоков (по умолчанию
+    по числу ядер) ограничивает нагрузку: при волне входов лишние проверки
+    ждут в очереди пула, а не вытесняют остальную работу процесса.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or os.cpu_count() or 1
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.stats = {'hashed': 0, 'verified': 0}
+
+    @property
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # Пул создается при первом обращении (в т.ч. заново после shutdown)
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='pbkdf2')
+        return self._executor
+
+    async def hash(self, password: str) -> str:
+        """Хеш пароля без блокировки цикла событий"""
+        self.stats['hashed'] += 1
+        return await asyncio.get_running_loop().run_in_executor(self.executor, hash_password, password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        """Проверка пароля без блокировки цикла событий"""
+        self.stats['verified'] += 1
+        return await asyncio.get_running_loop().run_in_executor(self.executor, verify_password, password, password_hash)
+
+    def hash_many(self, passwords: List[str]) -> List[str]:
+        """Хеши пачки паролей, параллельно на всех потоках пула (синхронно, для кода вне цикла событий)"""
+        self.stats['hashed'] += len(passwords)
+        return list(self.executor.map(hash_password, passwords))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'workers': self.workers}
+
+# Общий пул процесса (PASSWORD_HASH_WORKERS - число потоков, 0 - по числу ядер)
+password_hasher = PasswordHasher(int(os.getenv("PASSWORD_HASH_WORKERS", "0")) or None)
@@ -0,0 +1,177 @@
+# rate_limit.py - Ограничение частоты вызовов внешних API и автоматический выключатель (circuit breaker)
+
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class RateLimitExceededError(Exception):
+    """Квота вызовов исчерпана, ждать освобождения дольше допустимого"""
+
+class CircuitOpenError(Exception):
+    """Выключатель разомкнут: вызов отклонен без обращения к API"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"{name}: сервис временно недоступен, повтор через {retry_after:.0f}с")
+
+class TokenBucket:
+    """Потокобезопасное ведро токенов.
+
+    Токены пополняются со скоростью rate в секунду до capacity. Запрос
+    резервирует токены сразу (баланс может уйти в минус), а ждать
+    вызывающий должен сам - столько, сколько вернул reserve(). Благодаря
+    резервированию одновременные запросы выстраиваются в очередь без
+    блокировки ведра на время ожидания.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost: float = 1.0, max_wait: float = None) -> Optional[float]:
+        """Резервирование cost токенов.
+
+        Возвращает время ожидания в секундах или None, если ждать пришлось бы
+        дольше max_wait (токены в этом случае не списываются). Запрос дороже
+        емкости ведра ждет только до полной емкости, остаток уходит в долг.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            needed = min(cost, self.capacity)
+            wait = max(0.0, (needed - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= cost
+            return wait
+
+    def time_until(self, cost: float = 1.0) -> float:
+        """Сколько ждать, пока станет доступно cost токенов (без резервирования)"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+    def acquire(self, cost: float = 1.0, max_wait: float = None):
+        """Блокирующее получение токенов (для потоков)"""
+        wait = self.reserve(cost, max_wait)
+        if wait is None:
+            raise RateLimitExceededError(f"Квота исчерпана, ожидание превысило бы {max_wait}с")
+        if wait > 0:
+            time.sleep(wait)
+
+    def try_acquire(self, cost: float = 1.0):
+        """Неблокирующее получение токенов (для цикла событий): RateLimitExceededError, если их нет сейчас"""
+        if self.reserve(cost, max_wait=0) is None:
+            raise RateLimitExceededError("Квота исчерпана, повторите позже")
+
+    def get_state(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'capacity': self.capacity,
+                'available': round(self.tokens, 2)
+            }
+
+class CircuitBreaker:
+    """Автоматический выключатель для вызовов внешнего сервиса.
+
+    После failure_threshold неудач подряд цепь размыкается: вызовы сразу
+    получают CircuitOpenError. Через recovery_timeout пропускается один
+    пробный вызов (полуоткрытое состояние): успех замыкает цепь, неудача
+    снова размыкает ее.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_failure_at: Optional[str] = None
+        self.open_count = 0
+        self.rejected_calls = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        """Секунд до следующего пробного вызова (0 - вызовы разрешены)"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def before_call(self):
+        """Проверка перед вызовом: CircuitOpenError, если вызов запрещен"""
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError(self.name, remaining)
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+                logger.info(f"🔌 {self.name}: пробный вызов после размыкания цепи")
+
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError(self.name, 0.0)
+                self._probe_in_flight = True
+
+    def cancel_call(self):
+        """Вызов не состоялся (например, не хватило квоты) - освобождаем пробу"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"✅ {self.name}: сервис снова доступен, цепь замкнута")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.last_failure_at = datetime.now().isoformat()
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.open_count += 1
+                logger.warning(f"⚠️ {self.name}: цепь разомкнута после {self.failures} ошибок подряд, "
+                               f"вызовы приостановлены на {self.recovery_timeout:.0f}с")
+
+    def get_state(self) -> Dict[str, Any]:
+        retry_after = self.retry_after()
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'recovery_timeout': self.recovery_timeout,
+                'retry_after': round(retry_after, 1),
+                'open_count': self.open_count,
+                'rejected_calls': self.rejected_calls,
+                'last_failure_at': self.last_failure_at
+            }
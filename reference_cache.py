@@ -0,0 +1,156 @@
+# reference_cache.py - Кэш справочников бота (ТС и маршруты) с готовыми клавиатурами
+
+import time
+import bisect
+import logging
+import threading
+from typing import Dict, Any, List, Callable, Optional, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+def normalize_search(text: str) -> str:
+    """Ключ поиска: без пробелов и регистра («а 123 вс» == «А123ВС»)"""
+    return ''.join(text.split()).casefold()
+
+class ReferenceMenu:
+    """Снимок справочника: записи, готовая клавиатура, поиск выбора по тексту и префиксный индекс"""
+
+    __slots__ = ('version', 'items', 'keyboard', 'by_text', 'by_id', 'index', 'expires_at')
+
+    def __init__(self, version: int, items: List[Any], keyboard: Any, by_text: Dict[str, Any],
+                 index: List[Tuple[str, int, Any]], expires_at: float):
+        self.version = version
+        self.items = items
+        self.keyboard = keyboard
+        self.by_text = by_text
+        self.by_id = {item.id: item for item in items}
+        self.index = index
+        self.expires_at = expires_at
+
+    def find(self, text: str) -> Optional[Any]:
+        """Запись по тексту кнопки или по введенному вручную номеру"""
+        return self.by_text.get(text.strip())
+
+    def page(self, number: int, size: int) -> Tuple[List[Any], int, int]:
+        """Страница записей: (записи, номер страницы с учетом границ, всего страниц)"""
+        pages = max(1, -(-len(self.items) // size))
+        number = min(max(number, 0), pages - 1)
+        return self.items[number * size:(number + 1) * size], number, pages
+
+    def search(self, query: str, limit: int, offset: int = 0) -> Tuple[List[Any], bool]:
+        """Записи, у которых ключ поиска начинается с query: (страница, есть ли еще)"""
+        prefix = normalize_search(query)
+        if not prefix:
+            return self.items[offset:offset + limit], len(self.items) > offset + limit
+
+        # Бинарный поиск начала диапазона в отсортированном индексе
+        position = bisect.bisect_left(self.index, (prefix,))
+        found, seen = [], set()
+        while position < len(self.index) and len(found) <= offset + limit:
+            key, _, item = self.index[position]
+            if not key.startswith(prefix):
+                break
+            if item.id not in seen:
+                seen.add(item.id)
+                found.append(item)
+            position += 1
+        return found[offset:offset + limit], len(found) > offset + limit
+
+class ReferenceCache:
+    """Общий для процесса кэш справочников, которые водитель выбирает в боте.
+
+    Для каждого справочника (kind) хранится снимок ReferenceMenu: список
+    активных записей, собранная один раз клавиатура, словарь «текст ->
+    запись» и отсортированный индекс ключей для поиска по префиксу (inline-
+    режим бота). Изменения ТС и маршрутов (создание, удаление, активация,
+    деактивация) увеличивают версию справочника, и следующий запрос
+    перечитывает его из базы. Снимок, прочитанный до параллельного
+    изменения, не сохраняется. Срок жизни ограничивает устаревание при
+    изменениях из других процессов, если сбросы не передаются через
+    publisher (см. cache_sync.CacheInvalidationChannel).
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._menus: Dict[str, ReferenceMenu] = {}
+        self._versions: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        # Получатель сбросов для других процессов: publisher(scope, key)
+        self.publisher: Optional[Callable[[str, Optional[str]], None]] = None
+
+    def version(self, kind: str) -> int:
+        with self._lock:
+            return self._versions.get(kind, 0)
+
+    def get(self, kind: str, loader: Callable[[], List[Any]], build_keyboard: Callable[[List[Any]], Any],
+            keys: Callable[[Any], List[str]], search_keys: Callable[[Any], List[str]] = None) -> ReferenceMenu:
+        """Актуальный снимок справочника (при промахе - чтение из базы и сборка клавиатуры)"""
+        with self._lock:
+            menu = self._menus.get(kind)
+            version = self._versions.get(kind, 0)
+            if menu is not None and menu.version == version and menu.expires_at > time.monotonic():
+                self.hits += 1
+                return menu
+            self.misses += 1
+
+        items = loader()
+        by_text: Dict[str, Any] = {}
+        for item in items:
+            for key in keys(item):
+                # Первая запись выигрывает: как при прежнем поиске по порядку номеров
+                by_text.setdefault(key, item)
+        # Индекс (ключ, порядок, запись): порядок сохраняет сортировку справочника при равных ключах
+        index = sorted(
+            [(normalize_search(key), order, item)
+             for order, item in enumerate(items)
+             for key in (search_keys(item) if search_keys else [])],
+            key=lambda entry: entry[:2]
+        )
+        menu = ReferenceMenu(version, items, build_keyboard(items) if items else None, by_text,
+                             index, time.monotonic() + self.ttl_seconds)
+
+        with self._lock:
+            if self._versions.get(kind, 0) == version:
+                self._menus[kind] = menu
+        return menu
+
+    def invalidate(self, kind: str, publish: bool = True):
+        """Справочник изменился - следующий запрос перечитает его"""
+        with self._lock:
+            self._versions[kind] = self._versions.get(kind, 0) + 1
+            self._menus.pop(kind, None)
+        if publish and self.publisher is not None:
+            self.publisher('reference', kind)
+
+    def clear(self, publish: bool = True):
+        with self._lock:
+            for kind in list(self._menus):
+                self._versions[kind] = self._versions.get(kind, 0) + 1
+            self._menus.clear()
+        if publish and self.publisher is not None:
+            self.publisher('references', None)
+
+    def apply(self, scope: str, key: Optional[str]) -> bool:
+        """Сброс, пришедший из другого процесса (без повторной публикации); False - чужая область"""
+        if scope == 'reference':
+            self.invalidate(key, publish=False)
+        elif scope == 'references':
+            self.clear(publish=False)
+        else:
+            return False
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'versions': dict(self._versions),
+                'cached': {kind: len(menu.items) for kind, menu in self._menus.items()},
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+# Глобальный кэш процесса
+reference_cache = ReferenceCache()
@@ -29,3 +29,16 @@ function formatCurrency(amount) {
 function formatDate(dateString) {
     return new Date(dateString).toLocaleDateString('ru-RU');
 }
+
+// Подписка на события рейсов в реальном времени (Server-Sent Events)
+function subscribeTripEvents(onEvent) {
+    if (!window.EventSource) {
+        return null;
+    }
+    
+    const source = new EventSource('/api/events/trips');
+    ['created', 'started', 'completed', 'cancelled', 'deleted'].forEach(type => {
+        source.addEventListener(type, (e) => onEvent(JSON.parse(e.data)));
+    });
+    return source;
+}
@@ -2,24 +2,53 @@
 
 import asyncio
 import logging
-from typing import Dict, Any, Optional
-from datetime import datetime, date, timedelta
+import concurrent.futures
+from typing import Dict, Any, Optional, List, Tuple
+from datetime import datetime, date, timedelta, timezone
 import os
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from aiogram.types import (
+    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
+    InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+)
+from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 
 from database import DatabaseManager, User
+from fsm_storage import SQLiteStorage
+from update_workers import OrderedUpdateMiddleware
+from message_queue import OutgoingMessageQueue, OutgoingRateLimitMiddleware, PRIORITY_BROADCAST
+from reference_cache import reference_cache, ReferenceMenu
+from live_status import TripStatusBoard
+from login_throttle import login_throttle
+from trip_events import trip_events
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Справочник длиннее страницы выбирается постраничной inline-клавиатурой и поиском
+PICKER_PAGE_SIZE = 8
+INLINE_RESULTS_LIMIT = 20
+
+class PickerCallback(CallbackData, prefix='pick'):
+    """Кнопка постраничного выбора: kind - vehicles/routes, action - page/select"""
+    kind: str
+    action: str
+    value: int
+
+class TripCallback(CallbackData, prefix='trip'):
+    """Кнопка сообщения со статусом рейса: action - start/complete"""
+    action: str
+    trip_id: int
+
 # Состояния FSM для диалога
 class TripStates(StatesGroup):
     waiting_for_login = State()
@@ -31,11 +60,46 @@ class TripStates(StatesGroup):
     confirming_trip = State()
 
 class ExpeditionBot:
-    def __init__(self, token: str, db_manager: DatabaseManager):
-        self.bot = Bot(token=token)
-        self.dp = Dispatcher(storage=MemoryStorage())
+    def __init__(self, token: str, db_manager: DatabaseManager, api_url: str = None, rate_share: float = 1.0):
+        # api_url - альтернативный сервер Bot API (локальный telegram-bot-api или заглушка для тестов)
+        # rate_share - доля общего лимита отправки у этого процесса (бот из нескольких процессов)
+        api_url = api_url or os.getenv("TELEGRAM_API_URL")
+        if api_url:
+            session = AiohttpSession(api=TelegramAPIServer.from_base(api_url.rstrip('/')))
+            self.bot = Bot(token=token, session=session)
+        else:
+            self.bot = Bot(token=token)
+        # Все отправки в чаты идут через очередь с лимитами Telegram (30 сообщений/с, ~1/с в чат)
+        self.outbox = OutgoingMessageQueue(
+            global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")) * rate_share,
+            chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+            chat_burst=float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+        )
+        self.bot.session.middleware(OutgoingRateLimitMiddleware(self.outbox))
+        # Состояния диалогов в SQLite: незаконченное создание рейса переживает перезапуск
+        self.dp = Dispatcher(storage=SQLiteStorage(db_manager))
         self.db = db_manager
-        self.user_sessions: Dict[int, Dict[str, Any]] = {}
+        
+        # Режим «живого» статуса: одно закрепленное сообщение о рейсе водителя редактируется на месте
+        self.live_status: Optional[TripStatusBoard] = None
+        if os.getenv("TELEGRAM_LIVE_STATUS", "false").lower() == "true":
+            self.live_status = TripStatusBoard(
+                self.bot, db_manager, self.outbox, self.render_trip_status,
+                debounce=float(os.getenv("TELEGRAM_LIVE_STATUS_DEBOUNCE", "1.0"))
+            )
+        
+        # Обновления разных водителей - параллельно, одного водителя - по порядку
+        self.update_workers = OrderedUpdateMiddleware(int(os.getenv("TELEGRAM_UPDATE_WORKERS", "32")))
+        self.dp.update.outer_middleware(self.update_workers)
+        # Не больше стольких обновлений в работе: дальше прием ждет (backpressure)
+        self.max_pending_updates = int(os.getenv("TELEGRAM_MAX_PENDING_UPDATES", "1000"))
+        
+        # Режим webhook: цикл бота, секрет и обновления в обработке
+        self.webhook_secret: Optional[str] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._webhook_stopped: Optional[asyncio.Event] = None
+        self._webhook_slots: Optional[asyncio.Semaphore] = None
+        self._webhook_tasks = set()
         
         self.setup_handlers()
     
@@ -50,13 +114,6 @@ class ExpeditionBot:
             # Проверяем, есть ли уже авторизованный пользователь
             user = self.db.get_user_by_telegram_id(user_id)
             if user:
-                # Инициализируем сессию если её нет
-                if user_id not in self.user_sessions:
-                    self.user_sessions[user_id] = {
-                        'user': user,
-                        'current_trip': {}
-                    }
-                
                 # Проверяем активный рейс
                 active_trip = self.db.get_user_active_trip(user.id)
                 menu = self.get_main_menu(active_trip)
@@ -100,24 +157,37 @@ class ExpeditionBot:
             password = message.text.strip()
             data = await state.get_data()
             surname = data.get('surname')
+            source = f"tg:{message.from_user.id}"
+            
+            # Заблокированные попытки отклоняются до обращения к базе и хеширования пароля
+            retry_after = login_throttle.check(surname, source)
+            if retry_after:
+                await message.answer(
+                    "🔒 Слишком много неудачных попыток входа.\n"
+                    f"Попробуйте снова через {max(1, round(retry_after / 60))} мин.: /start"
+                )
+                await state.clear()
+                return
             
             # Аутентификация пользователя
-            user = self.db.authenticate_user(surname, password)
+            user = await self.db.authenticate_user_async(surname, password)
             
             if user and user.role == 'driver':
+                login_throttle.record_success(surname, source)
+                
                 # Привязываем Telegram ID к пользователю
                 self.db.link_telegram_user(user.id, message.from_user.id)
                 
-                # Инициализируем сессию пользователя
-                self.user_sessions[message.from_user.id] = {
-                    'user': user,
-                    'current_trip': {}
-                }
-                
                 # Проверяем активный рейс
                 active_trip = self.db.get_user_active_trip(user.id)
                 menu = self.get_main_menu(active_trip)
                 
+                if self.live_status:
+                    # Сообщение со статусом - в новом чате водителя
+                    self.live_status.forget(user.id)
+                    if active_trip:
+                        self.live_status.schedule(self.db.get_trip_for_report(active_trip['id']))
+                
                 welcome_msg = f"✅ Авторизация успешна!\nДобро пожаловать, {user.first_name} {user.surname}!"
                 
                 if active_trip:
@@ -132,6 +202,7 @@ class ExpeditionBot:
                 await message.answer(welcome_msg, reply_markup=menu)
                 await state.clear()
             else:
+                login_throttle.record_failure(surname, source)
                 await message.answer(
                     "❌ Неверная фамилия или пароль!\n"
                     "Попробуйте еще раз.\n\n"
@@ -146,17 +217,14 @@ class ExpeditionBot:
         
         async def start_trip_creation(message: types.Message, state: FSMContext):
             """Функция для начала создания рейса"""
-            user_id = message.from_user.id
-            
-            if user_id not in self.user_sessions:
+            user = self.get_session_user(message.from_user.id)
+            if not user:
                 await message.answer(
                     "❌ Вы не авторизованы в системе.\n"
                     "Используйте команду /start для входа."
                 )
                 return
             
-            user = self.user_sessions[user_id]['user']
-            
             # Проверяем, нет ли уже активного рейса
             active_trip = self.db.get_user_active_trip(user.id)
             if active_trip:
@@ -167,22 +235,22 @@ class ExpeditionBot:
                 )
                 return
             
-            # Получаем активные ТС
-            vehicles = self.db.get_active_vehicles()
-            if not vehicles:
+            # Получаем активные ТС (из кэша справочников)
+            vehicles_menu = self.get_vehicles_menu()
+            if not vehicles_menu.items:
                 await message.answer(
                     "❌ В системе нет доступных транспортных средств.\n"
                     "Обратитесь к администратору."
                 )
                 return
             
-            # Инициализируем новый рейс
-            self.user_sessions[user_id]['current_trip'] = {}
+            # Инициализируем новый рейс (данные рейса копятся в данных диалога)
+            await state.set_data({})
             
             await message.answer(
                 "🚛 Создание нового рейса\n\n"
                 "Выберите ваше транспортное средство:",
-                reply_markup=self.get_vehicles_keyboard(vehicles)
+                reply_markup=self.get_picker_markup('vehicles', vehicles_menu)
             )
             await state.set_state(TripStates.waiting_for_vehicle)
         
@@ -194,35 +262,23 @@ class ExpeditionBot:
             
             logger.info(f"Пользователь {user_id} выбрал ТС: '{vehicle_text}'")
             
-            # Находим ТС по номеру - улучшенный поиск
-            vehicles = self.db.get_active_vehicles()
-            selected_vehicle = None
-            
-            # Извлекаем номер из текста кнопки
-            for vehicle in vehicles:
-                # Проверяем точное соответствие с форматом кнопки
-                expected_text = f"🚛 {vehicle.number} ({vehicle.model})"
-                if vehicle_text == expected_text:
-                    selected_vehicle = vehicle
-                    logger.info(f"Найдено точное соответствие ТС: {vehicle.number}")
-                    break
-                # Альтернативная проверка по номеру
-                elif vehicle.number in vehicle_text:
-                    selected_vehicle = vehicle
-                    logger.info(f"Найдено соответствие по номеру ТС: {vehicle.number}")
-                    break
+            # Находим ТС по тексту кнопки или номеру
+            vehicles_menu = self.get_vehicles_menu()
+            selected_vehicle = vehicles_menu.find(vehicle_text)
             
             if not selected_vehicle:
                 logger.warning(f"ТС не найдено для текста: '{vehicle_text}'")
                 await message.answer(
                     "❌ Выберите транспортное средство из предложенных вариантов:",
-                    reply_markup=self.get_vehicles_keyboard(vehicles)
+                    reply_markup=self.get_picker_markup('vehicles', vehicles_menu)
                 )
                 return
             
-            # Сохраняем выбранное ТС
-            self.user_sessions[user_id]['current_trip']['vehicle_id'] = selected_vehicle.id
-            self.user_sessions[user_id]['current_trip']['vehicle_number'] = selected_vehicle.number
+            await vehicle_chosen(message, state, selected_vehicle)
+        
+        async def vehicle_chosen(message: types.Message, state: FSMContext, selected_vehicle):
+            """Сохранение выбранного ТС (кнопкой, текстом или через поиск) и переход к путевому листу"""
+            await state.update_data(vehicle_id=selected_vehicle.id, vehicle_number=selected_vehicle.number)
             
             await message.answer(
                 f"✅ Выбрано ТС: {selected_vehicle.number} ({selected_vehicle.model})\n\n"
@@ -234,7 +290,6 @@ class ExpeditionBot:
         @self.dp.message(StateFilter(TripStates.waiting_for_waybill))
         async def process_waybill(message: types.Message, state: FSMContext):
             """Обработка ввода номера путевого листа"""
-            user_id = message.from_user.id
             waybill_number = message.text.strip()
             
             # Простая валидация номера путевого листа
@@ -246,11 +301,11 @@ class ExpeditionBot:
                 return
             
             # Сохраняем номер путевого листа
-            self.user_sessions[user_id]['current_trip']['waybill_number'] = waybill_number
+            await state.update_data(waybill_number=waybill_number)
             
-            # Получаем активные маршруты
-            routes = self.db.get_active_routes(include_price=False)  # Цену водителям не показываем
-            if not routes:
+            # Получаем активные маршруты (из кэша справочников)
+            routes_menu = self.get_routes_menu()
+            if not routes_menu.items:
                 await message.answer(
                     "❌ В системе нет доступных маршрутов.\n"
                     "Обратитесь к администратору."
@@ -260,7 +315,7 @@ class ExpeditionBot:
             await message.answer(
                 f"✅ Путевой лист: {waybill_number}\n\n"
                 f"Выберите маршрут:",
-                reply_markup=self.get_routes_keyboard(routes)
+                reply_markup=self.get_picker_markup('routes', routes_menu)
             )
             await state.set_state(TripStates.waiting_for_route)
         
@@ -272,36 +327,27 @@ class ExpeditionBot:
             
             logger.info(f"Пользователь {user_id} выбрал маршрут: '{route_text}'")
             
-            # Находим маршрут по номеру - улучшенный поиск
-            routes = self.db.get_active_routes()
-            selected_route = None
-            
-            for route in routes:
-                # Проверяем точное соответствие с форматом кнопки
-                expected_text = f"🗺 Маршрут №{route.number} - {route.name}"
-                if route_text == expected_text:
-                    selected_route = route
-                    logger.info(f"Найдено точное соответствие маршрута: {route.number}")
-                    break
-                # Альтернативная проверка по номеру
-                elif f"№{route.number}" in route_text:
-                    selected_route = route
-                    logger.info(f"Найдено соответствие по номеру маршрута: {route.number}")
-                    break
+            # Находим маршрут по тексту кнопки или номеру
+            routes_menu = self.get_routes_menu()
+            selected_route = routes_menu.find(route_text)
             
             if not selected_route:
                 logger.warning(f"Маршрут не найден для текста: '{route_text}'")
-                routes_display = self.db.get_active_routes(include_price=False)
                 await message.answer(
                     "❌ Выберите маршрут из предложенных вариантов:",
-                    reply_markup=self.get_routes_keyboard(routes_display)
+                    reply_markup=self.get_picker_markup('routes', routes_menu)
                 )
                 return
             
-            # Сохраняем выбранный маршрут
-            self.user_sessions[user_id]['current_trip']['route_id'] = selected_route.id
-            self.user_sessions[user_id]['current_trip']['route_number'] = selected_route.number
-            self.user_sessions[user_id]['current_trip']['route_name'] = selected_route.name
+            await route_chosen(message, state, selected_route)
+        
+        async def route_chosen(message: types.Message, state: FSMContext, selected_route):
+            """Сохранение выбранного маршрута (кнопкой, текстом или через поиск) и переход к количеству"""
+            await state.update_data(
+                route_id=selected_route.id,
+                route_number=selected_route.number,
+                route_name=selected_route.name
+            )
             
             await message.answer(
                 f"✅ Выбран маршрут: №{selected_route.number} - {selected_route.name}\n\n"
@@ -310,10 +356,100 @@ class ExpeditionBot:
             )
             await state.set_state(TripStates.waiting_for_quantity)
         
+        @self.dp.callback_query(PickerCallback.filter())
+        async def process_picker(callback: types.CallbackQuery, callback_data: PickerCallback, state: FSMContext):
+            """Листание и выбор в постраничной inline-клавиатуре ТС/маршрутов"""
+            expected_state = TripStates.waiting_for_vehicle if callback_data.kind == 'vehicles' else TripStates.waiting_for_route
+            if await state.get_state() != expected_state.state:
+                await callback.answer("Этот выбор уже неактуален")
+                await self._edit_picker(callback, None)
+                return
+            
+            menu = self.get_vehicles_menu() if callback_data.kind == 'vehicles' else self.get_routes_menu()
+            if callback_data.action == 'page':
+                await callback.answer()
+                await self._edit_picker(callback, self.get_picker_keyboard(callback_data.kind, menu, callback_data.value))
+                return
+            
+            selected = menu.by_id.get(callback_data.value)
+            if not selected:
+                # Запись деактивировали, пока водитель листал список
+                await callback.answer("❌ Этот вариант больше недоступен", show_alert=True)
+                await self._edit_picker(callback, self.get_picker_keyboard(callback_data.kind, menu, 0))
+                return
+            
+            await callback.answer()
+            await self._edit_picker(callback, None)
+            if callback_data.kind == 'vehicles':
+                await vehicle_chosen(callback.message, state, selected)
+            else:
+                await route_chosen(callback.message, state, selected)
+        
+        @self.dp.callback_query(TripCallback.filter())
+        async def process_trip_action(callback: types.CallbackQuery, callback_data: TripCallback):
+            """Начать/завершить поездку кнопкой сообщения со статусом рейса (ответ - правка этого сообщения)"""
+            user = self.get_session_user(callback.from_user.id)
+            if not user:
+                await callback.answer("❌ Вы не авторизованы. Используйте /start для входа.", show_alert=True)
+                return
+            
+            expected_status, next_status = {'start': ('created', 'started'), 'complete': ('started', 'completed')}[callback_data.action]
+            active_trip = self.db.get_user_active_trip(user.id)
+            if not active_trip or active_trip['id'] != callback_data.trip_id or active_trip['status'] != expected_status:
+                await callback.answer("❌ Рейс уже начат или завершен", show_alert=True)
+                # Сообщение могло устареть - показываем актуальное состояние
+                trip = self.db.get_trip_for_report(callback_data.trip_id)
+                if trip and self.live_status:
+                    self.live_status.schedule(trip)
+                return
+            
+            try:
+                if next_status == 'started':
+                    success = self.db.start_trip(active_trip['id'])
+                else:
+                    success = self.db.complete_trip(active_trip['id'])
+            except Exception as e:
+                logger.error(f"Ошибка смены статуса рейса {active_trip['id']}: {e}")
+                success = False
+            
+            if not success:
+                await callback.answer("❌ Не удалось изменить статус рейса. Попробуйте еще раз.", show_alert=True)
+                return
+            # Событие рейса обновит сообщение со статусом
+            self.publish_trip_event(next_status, active_trip['id'])
+            await callback.answer("🚀 Поездка начата" if next_status == 'started' else "🏁 Поездка завершена")
+        
+        @self.dp.inline_query()
+        async def process_inline_search(inline_query: types.InlineQuery, state: FSMContext):
+            """Поиск ТС/маршрута по префиксу номера или названия (inline-режим, шаг выбора в диалоге)"""
+            current_state = await state.get_state()
+            if current_state == TripStates.waiting_for_vehicle.state:
+                kind, menu, label = 'vehicles', self.get_vehicles_menu(), self.vehicle_label
+            elif current_state == TripStates.waiting_for_route.state:
+                kind, menu, label = 'routes', self.get_routes_menu(), self.route_label
+            else:
+                await inline_query.answer([], cache_time=0, is_personal=True)
+                return
+            
+            offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+            items, has_more = menu.search(inline_query.query, INLINE_RESULTS_LIMIT, offset)
+            # Выбранный результат приходит в чат текстом кнопки и обрабатывается шагом диалога
+            results = [
+                InlineQueryResultArticle(
+                    id=f"{kind}:{item.id}",
+                    title=label(item),
+                    input_message_content=InputTextMessageContent(message_text=label(item))
+                )
+                for item in items
+            ]
+            await inline_query.answer(
+                results, cache_time=0, is_personal=True,
+                next_offset=str(offset + INLINE_RESULTS_LIMIT) if has_more else ''
+            )
+        
         @self.dp.message(StateFilter(TripStates.waiting_for_quantity))
         async def process_quantity(message: types.Message, state: FSMContext):
             """Обработка ввода количества товара"""
-            user_id = message.from_user.id
             quantity_text = message.text.strip()
             
             try:
@@ -327,11 +463,14 @@ class ExpeditionBot:
                 return
             
             # Сохраняем количество
-            self.user_sessions[user_id]['current_trip']['quantity_delivered'] = quantity
+            trip_data = await state.update_data(quantity_delivered=quantity)
             
             # Формируем сводку для подтверждения
-            trip_data = self.user_sessions[user_id]['current_trip']
-            user = self.user_sessions[user_id]['user']
+            user = self.get_session_user(message.from_user.id)
+            if not user:
+                await message.answer("❌ Вы не авторизованы в системе.\nИспользуйте команду /start для входа.")
+                await state.clear()
+                return
             
             summary = (
                 f"📋 Подтверждение рейса\n\n"
@@ -355,13 +494,12 @@ class ExpeditionBot:
         @self.dp.message(StateFilter(TripStates.confirming_trip))
         async def process_confirmation(message: types.Message, state: FSMContext):
             """Обработка подтверждения рейса"""
-            user_id = message.from_user.id
             confirmation = message.text.strip()
             
             if confirmation == "✅ Подтвердить":
                 # Создаем рейс в базе данных
-                trip_data = self.user_sessions[user_id]['current_trip']
-                user = self.user_sessions[user_id]['user']
+                trip_data = await state.get_data()
+                user = self.get_session_user(message.from_user.id)
                 
                 try:
                     trip_id = self.db.create_trip(
@@ -372,18 +510,27 @@ class ExpeditionBot:
                         quantity_delivered=trip_data['quantity_delivered']
                     )
                     
+                    self.publish_trip_event('created', trip_id)
+                    
                     # Получаем созданный рейс
                     active_trip = self.db.get_user_active_trip(user.id)
                     
-                    await message.answer(
-                        f"✅ Рейс #{trip_id} создан успешно!\n\n"
-                        f"📍 Статус: Ожидает начала поездки\n"
-                        f"⏰ Нажмите 'Начать поездку' когда отправляетесь по маршруту.",
-                        reply_markup=self.get_main_menu(active_trip)
-                    )
+                    if self.live_status:
+                        # Дальше рейс ведется в закрепленном сообщении со статусом
+                        await message.answer(
+                            f"✅ Рейс #{trip_id} создан успешно!\n"
+                            f"📌 Статус рейса и кнопки «Начать/Завершить поездку» - в закрепленном сообщении.",
+                            reply_markup=self.get_main_menu(active_trip)
+                        )
+                    else:
+                        await message.answer(
+                            f"✅ Рейс #{trip_id} создан успешно!\n\n"
+                            f"📍 Статус: Ожидает начала поездки\n"
+                            f"⏰ Нажмите 'Начать поездку' когда отправляетесь по маршруту.",
+                            reply_markup=self.get_main_menu(active_trip)
+                        )
                     
                     # Очищаем данные создания рейса
-                    self.user_sessions[user_id]['current_trip'] = {}
                     await state.clear()
                     
                 except Exception as e:
@@ -401,7 +548,6 @@ class ExpeditionBot:
                     "Используйте кнопки меню для создания нового рейса.",
                     reply_markup=self.get_main_menu()
                 )
-                self.user_sessions[user_id]['current_trip'] = {}
                 await state.clear()
             else:
                 await message.answer(
@@ -420,6 +566,7 @@ class ExpeditionBot:
                 "/help - Показать эту справку\n\n"
                 "🔄 Процесс работы с рейсом:\n"
                 "1. Создайте рейс (выбор ТС, маршрута, количества)\n"
+                "   Длинный список можно листать или искать кнопкой «🔍 Поиск»\n"
                 "2. Нажмите 'Начать поездку' когда отправляетесь\n"
                 "3. Нажмите 'Завершить поездку' по прибытии\n"
                 "4. Данные автоматически добавляются в календарь\n\n"
@@ -444,15 +591,14 @@ class ExpeditionBot:
                 logger.warning(f"Получено сообщение '{text}' в состоянии {current_state}")
                 return
             
-            if user_id not in self.user_sessions:
+            user = self.get_session_user(user_id)
+            if not user:
                 await message.answer(
                     "❌ Вы не авторизованы в системе.\n"
                     "Используйте команду /start для входа."
                 )
                 return
             
-            user = self.user_sessions[user_id]['user']
-            
             if text == "➕ Создать рейс":
                 await start_trip_creation(message, state)
                 
@@ -495,13 +641,12 @@ class ExpeditionBot:
             return
         
         try:
-            # Создаем событие в календаре с начальным временем (1 минута для лучшего отображения)
-            calendar_event_id = await self.create_calendar_event(active_trip, user, duration_hours=0.017)
-            
-            # Начинаем поездку
-            success = self.db.start_trip(active_trip['id'], calendar_event_id)
+            # Начинаем поездку; событие календаря создаст обработчик очереди
+            success = self.db.start_trip(active_trip['id'])
             
             if success:
+                self.publish_trip_event('started', active_trip['id'])
+                
                 start_time = datetime.now().strftime('%H:%M')
                 await message.answer(
                     f"🚀 Поездка начата!\n\n"
@@ -509,7 +654,7 @@ class ExpeditionBot:
                     f"🕐 Время начала: {start_time}\n"
                     f"🗺 Маршрут: №{active_trip['route_number']} - {active_trip['route_name']}\n"
                     f"🚛 ТС: {active_trip['vehicle_number']}\n\n"
-                    f"📅 Событие добавлено в календарь.\n"
+                    f"📅 Событие будет добавлено в календарь.\n"
                     f"⏰ Нажмите 'Завершить поездку' по прибытии.",
                     reply_markup=self.get_main_menu(self.db.get_user_active_trip(user.id))
                 )
@@ -552,12 +697,7 @@ class ExpeditionBot:
                 logger.info(f"🎯 Рейс {active_trip['id']} успешно завершен в базе данных")
                 
                 # Получаем обновленные данные сразу после завершения
-                completed_trips = self.db.get_trips_for_report()
-                completed_trip = None
-                for trip in completed_trips:
-                    if trip['id'] == active_trip['id']:
-                        completed_trip = trip
-                        break
+                completed_trip = self.publish_trip_event('completed', active_trip['id'])
                 
                 duration_text = ""
                 if completed_trip and completed_trip.get('duration_hours'):
@@ -568,9 +708,6 @@ class ExpeditionBot:
                 else:
                     logger.warning(f"❌ Не удалось найти завершенный рейс {active_trip['id']} в базе")
                 
-                # Обновляем событие в календаре с реальным временем
-                await self.update_calendar_event(active_trip, user)
-                
                 end_time = datetime.now().strftime('%H:%M')
                 await message.answer(
                     f"🏁 Поездка завершена!\n\n"
@@ -579,7 +716,7 @@ class ExpeditionBot:
                     f"🗺 Маршрут: №{active_trip['route_number']} - {active_trip['route_name']}\n"
                     f"🚛 ТС: {active_trip['vehicle_number']}\n"
                     f"📦 Доставлено: {active_trip['quantity_delivered']} шт.\n\n"
-                    f"📅 Событие в календаре обновлено с реальным временем.\n"
+                    f"📅 Событие в календаре будет обновлено с реальным временем.\n"
                     f"✅ Данные переданы в систему отчетности.",
                     reply_markup=self.get_main_menu()
                 )
@@ -671,11 +808,72 @@ class ExpeditionBot:
                 reply_markup=self.get_main_menu()
             )
     
+    def get_session_user(self, telegram_id: int) -> Optional[User]:
+        """Авторизованный водитель чата (из кэша водителей, блокировка учитывается сразу)"""
+        return self.db.get_user_by_telegram_id(telegram_id)
+    
+    def publish_trip_event(self, event_type: str, trip_id: int) -> Optional[Dict[str, Any]]:
+        """Публикация события рейса для веб-интерфейса; возвращает рейс в формате отчета"""
+        try:
+            trip = self.db.get_trip_for_report(trip_id)
+            trip_events.publish(event_type, trip_id, trip)
+            return trip
+        except Exception as e:
+            logger.error(f"Ошибка публикации события '{event_type}' для рейса {trip_id}: {e}")
+            return None
+    
+    @staticmethod
+    def _local_time(value: Optional[str]) -> str:
+        """Время ЧЧ:ММ из отметки базы (CURRENT_TIMESTAMP в UTC)"""
+        if not value:
+            return '-'
+        try:
+            return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).astimezone().strftime('%H:%M')
+        except ValueError:
+            return str(value)
+    
+    def render_trip_status(self, trip: Dict[str, Any]) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+        """Текст и кнопки закрепленного сообщения со статусом рейса"""
+        status = trip['status']
+        status_line = {
+            'created': "⏳ Ожидает начала поездки",
+            'started': f"🚀 В пути с {self._local_time(trip.get('started_at'))}",
+            'completed': f"🏁 Завершен в {self._local_time(trip.get('completed_at'))}",
+            'cancelled': "❌ Рейс отменен",
+            'deleted': "🗑 Рейс удален администратором"
+        }.get(status, status)
+        if status == 'completed' and trip.get('duration_hours'):
+            hours = int(trip['duration_hours'])
+            minutes = int((trip['duration_hours'] - hours) * 60)
+            status_line += f" (в пути {hours}ч {minutes}мин)"
+        
+        text = (
+            f"📌 Текущий рейс #{trip['id']}\n\n"
+            f"🗺 Маршрут: {trip.get('route_name', '-')}\n"
+            f"🚛 ТС: {trip.get('vehicle_number', '-')}\n"
+            f"📄 Путевой лист: {trip.get('waybill_number', '-')}\n"
+            f"📦 Количество: {trip.get('quantity', '-')} шт.\n\n"
+            f"📍 Статус: {status_line}"
+        )
+        
+        builder = InlineKeyboardBuilder()
+        if status == 'created':
+            builder.button(text="🚀 Начать поездку", callback_data=TripCallback(action='start', trip_id=trip['id']))
+        elif status == 'started':
+            builder.button(text="🏁 Завершить поездку", callback_data=TripCallback(action='complete', trip_id=trip['id']))
+        else:
+            text += "\n\n➕ Новый рейс - кнопкой меню «Создать рейс»."
+            return text, None
+        return text, builder.as_markup()
+    
     def get_main_menu(self, active_trip: Dict[str, Any] = None) -> ReplyKeyboardMarkup:
         """Создание главного меню в зависимости от состояния рейса"""
         builder = ReplyKeyboardBuilder()
         
-        if active_trip:
+        if self.live_status:
+            # Кнопки рейса - в сообщении со статусом, меню не меняется и не устаревает
+            builder.row(KeyboardButton(text="➕ Создать рейс"))
+        elif active_trip:
             if active_trip['status'] == 'created':
                 # Рейс создан, можно начать поездку
                 builder.row(KeyboardButton(text="🚀 Начать поездку"))
@@ -691,22 +889,91 @@ class ExpeditionBot:
         
         return builder.as_markup(resize_keyboard=True, persistent=True)
     
-    def get_vehicles_keyboard(self, vehicles) -> ReplyKeyboardMarkup:
-        """Создание клавиатуры для выбора ТС"""
+    @staticmethod
+    def vehicle_label(vehicle) -> str:
+        return f"🚛 {vehicle.number} ({vehicle.model})"
+    
+    @staticmethod
+    def route_label(route) -> str:
+        return f"🗺 Маршрут №{route.number} - {route.name}"
+    
+    def get_vehicles_menu(self) -> ReferenceMenu:
+        """Активные ТС с готовой клавиатурой, поиском по тексту кнопки и по префиксу номера"""
+        return reference_cache.get(
+            'vehicles', self.db.get_active_vehicles, self.get_vehicles_keyboard,
+            lambda vehicle: [self.vehicle_label(vehicle), vehicle.number],
+            lambda vehicle: [vehicle.number]
+        )
+    
+    def get_routes_menu(self) -> ReferenceMenu:
+        """Активные маршруты (без цены) с готовой клавиатурой, поиском по тексту кнопки и по префиксу номера/названия"""
+        return reference_cache.get(
+            'routes', lambda: self.db.get_active_routes(include_price=False), self.get_routes_keyboard,
+            lambda route: [self.route_label(route), f"№{route.number}", route.number],
+            lambda route: [route.number, f"№{route.number}", route.name, *route.name.split()]
+        )
+    
+    def get_vehicles_keyboard(self, vehicles) -> Optional[ReplyKeyboardMarkup]:
+        """Создание клавиатуры для выбора ТС (большой парк выбирается постранично)"""
+        if len(vehicles) > PICKER_PAGE_SIZE:
+            return None
         builder = ReplyKeyboardBuilder()
         for vehicle in vehicles:
-            button_text = f"🚛 {vehicle.number} ({vehicle.model})"
-            builder.row(KeyboardButton(text=button_text))
+            builder.row(KeyboardButton(text=self.vehicle_label(vehicle)))
         return builder.as_markup(resize_keyboard=True, one_time_keyboard=True)
     
-    def get_routes_keyboard(self, routes) -> ReplyKeyboardMarkup:
-        """Создание клавиатуры для выбора маршрута"""
+    def get_routes_keyboard(self, routes) -> Optional[ReplyKeyboardMarkup]:
+        """Создание клавиатуры для выбора маршрута (длинный список выбирается постранично)"""
+        if len(routes) > PICKER_PAGE_SIZE:
+            return None
         builder = ReplyKeyboardBuilder()
         for route in routes:
-            button_text = f"🗺 Маршрут №{route.number} - {route.name}"
-            builder.row(KeyboardButton(text=button_text))
+            builder.row(KeyboardButton(text=self.route_label(route)))
         return builder.as_markup(resize_keyboard=True, one_time_keyboard=True)
     
+    def get_picker_markup(self, kind: str, menu: ReferenceMenu):
+        """Клавиатура выбора: обычная для короткого списка, первая страница inline - для длинного"""
+        return menu.keyboard or self.get_picker_keyboard(kind, menu, 0)
+    
+    def get_picker_keyboard(self, kind: str, menu: ReferenceMenu, page: int) -> InlineKeyboardMarkup:
+        """Одна страница inline-клавиатуры выбора ТС/маршрута с листанием и поиском"""
+        items, page, pages = menu.page(page, PICKER_PAGE_SIZE)
+        label = self.vehicle_label if kind == 'vehicles' else self.route_label
+        
+        builder = InlineKeyboardBuilder()
+        for item in items:
+            builder.row(InlineKeyboardButton(
+                text=label(item),
+                callback_data=PickerCallback(kind=kind, action='select', value=item.id).pack()
+            ))
+        
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(
+                text="◀️", callback_data=PickerCallback(kind=kind, action='page', value=page - 1).pack()
+            ))
+        navigation.append(InlineKeyboardButton(
+            text=f"{page + 1}/{pages}", callback_data=PickerCallback(kind=kind, action='page', value=page).pack()
+        ))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton(
+                text="▶️", callback_data=PickerCallback(kind=kind, action='page', value=page + 1).pack()
+            ))
+        builder.row(*navigation)
+        # Поиск через inline-режим: водитель набирает начало номера или названия прямо в чате
+        builder.row(InlineKeyboardButton(text="🔍 Поиск", switch_inline_query_current_chat=""))
+        return builder.as_markup()
+    
+    async def _edit_picker(self, callback: types.CallbackQuery, markup: Optional[InlineKeyboardMarkup]):
+        """Замена страницы (или удаление) inline-клавиатуры выбора"""
+        if not callback.message:
+            return
+        try:
+            await callback.message.edit_reply_markup(reply_markup=markup)
+        except TelegramBadRequest as e:
+            # Та же страница («message is not modified») или сообщение слишком старое
+            logger.debug(f"Клавиатура выбора не изменена: {e}")
+    
     def get_confirmation_keyboard(self) -> ReplyKeyboardMarkup:
         """Создание клавиатуры для подтверждения"""
         builder = ReplyKeyboardBuilder()
@@ -714,141 +981,163 @@ class ExpeditionBot:
         builder.row(KeyboardButton(text="❌ Отменить"))
         return builder.as_markup(resize_keyboard=True, one_time_keyboard=True)
     
-    async def create_calendar_event(self, trip_data: Dict[str, Any], user: User, duration_hours: float = 2.0) -> Optional[str]:
-        """Создание события в Google Календаре с улучшенной продолжительностью"""
+    async def start_polling(self):
+        """Запуск бота в режиме long polling"""
         try:
-            from google_calendar import CalendarIntegration
-            
-            calendar_integration = CalendarIntegration(enabled=True)
-            
-            if not calendar_integration.enabled:
-                logger.warning("Google Calendar интеграция отключена")
-                return None
-            
-            # Подготавливаем данные для календаря
-            calendar_trip_data = {
-                'id': trip_data['id'],
-                'waybill_number': trip_data['waybill_number'],
-                'vehicle_number': trip_data['vehicle_number'],
-                'route_number': trip_data['route_number'],
-                'route_name': trip_data['route_name'],
-                'quantity_delivered': trip_data['quantity_delivered'],
-                'duration_hours': duration_hours,
-                'started_at': datetime.now().isoformat()
-            }
-            
-            calendar_user_data = {
-                'id': user.id,
-                'surname': user.surname,
-                'first_name': user.first_name,
-                'middle_name': user.middle_name
-            }
-            
-            # Создаем событие
-            event_id = calendar_integration.create_trip_event_sync(calendar_trip_data, calendar_user_data)
-            
-            if event_id:
-                logger.info(f"Создано событие в Google Calendar: {event_id}")
-                return event_id
-            else:
-                logger.error("Не удалось создать событие в Google Calendar")
-                return None
-                
-        except ImportError:
-            logger.warning("Модуль google_calendar не доступен")
-            return None
+            logger.info("🤖 Запуск Telegram бота...")
+            # Пока webhook установлен, getUpdates отвечает ошибкой 409
+            self._loop = asyncio.get_running_loop()
+            if self.live_status:
+                self.live_status.start()
+            await self.bot.delete_webhook(drop_pending_updates=False)
+            # Сигналы остановки обрабатывает main.py (плавная остановка через request_stop)
+            await self.dp.start_polling(self.bot, tasks_concurrency_limit=self.max_pending_updates, handle_signals=False)
         except Exception as e:
-            logger.error(f"Ошибка создания события в календаре: {e}")
-            return None
+            logger.error(f"❌ Ошибка запуска бота: {e}")
+        finally:
+            self._loop = None
+            await self.update_workers.close()
+            if self.live_status:
+                await self.live_status.close()
+            await self.outbox.close()
+            await self.dp.storage.close()
+            await self.bot.session.close()
     
-    async def update_calendar_event(self, trip_data: Dict[str, Any], user: User) -> bool:
-        """Обновление события в Google Календаре с реальным временем"""
+    @property
+    def webhook_ready(self) -> bool:
+        """Бот запущен в режиме webhook и принимает обновления"""
+        return self._webhook_stopped is not None and not self._webhook_stopped.is_set()
+    
+    def dispatch_webhook_update(self, update: Dict[str, Any]) -> concurrent.futures.Future:
+        """Передача обновления из webhook в цикл бота.
+        
+        Можно вызывать из любого потока (веб-сервер работает в своем потоке).
+        Возвращаемый future завершается, когда обновление принято в обработку:
+        если в работе уже max_pending_updates обновлений, прием ждет
+        освобождения места, и HTTP-ответ Telegram задерживается (backpressure).
+        Обработку само обновление не ждет.
+        """
+        if not self.webhook_ready:
+            raise RuntimeError("Бот не запущен в режиме webhook")
+        return asyncio.run_coroutine_threadsafe(self.admit_update(update), self._loop)
+    
+    async def admit_update(self, update: Dict[str, Any]):
+        """Прием обновления в обработку (в цикле бота); ждет свободного слота"""
+        await self._webhook_slots.acquire()
+        task = asyncio.create_task(self._process_webhook_update(update))
+        self._webhook_tasks.add(task)
+        task.add_done_callback(self._webhook_tasks.discard)
+    
+    async def _process_webhook_update(self, update: Dict[str, Any]):
         try:
-            from google_calendar import CalendarIntegration
-            
-            calendar_integration = CalendarIntegration(enabled=True)
-            
-            if not calendar_integration.enabled or not trip_data.get('calendar_event_id'):
-                logger.warning("Google Calendar интеграция отключена или нет ID события")
-                return False
-            
-            # Получаем актуальные данные рейса
-            logger.info(f"🔍 Ищем рейс ID: {trip_data['id']}")
-            updated_trips = self.db.get_trips_for_report()
-            
-            current_trip = None
-            for trip in updated_trips:
-                if trip['id'] == trip_data['id']:
-                    current_trip = trip
-                    logger.info(f"✅ Найден рейс: {trip}")
-                    break
-            
-            if not current_trip:
-                logger.warning(f"❌ Рейс с ID {trip_data['id']} не найден в базе")
-                return False
-            
-            # Проверяем наличие данных о продолжительности
-            if not current_trip.get('duration_hours'):
-                logger.warning(f"⚠️ У рейса {trip_data['id']} нет данных о продолжительности. Статус: {current_trip.get('status')}")
-                
-                # Если рейс завершен, но нет duration_hours, попробуем обновить без них
-                if current_trip.get('status') == 'completed':
-                    logger.info("🔄 Пытаемся обновить событие без данных о продолжительности")
-                else:
-                    return False
-            
-            # Подготавливаем данные для обновления
-            calendar_trip_data = {
-                'id': current_trip['id'],
-                'waybill_number': current_trip['waybill_number'],
-                'vehicle_number': current_trip['vehicle_number'],
-                'route_number': trip_data['route_number'],
-                'route_name': trip_data['route_name'],
-                'quantity_delivered': current_trip.get('quantity', 0),
-                'duration_hours': current_trip.get('duration_hours', 0),
-                'started_at': current_trip.get('started_at'),
-                'completed_at': current_trip.get('completed_at')
-            }
-            
-            calendar_user_data = {
-                'id': user.id,
-                'surname': user.surname,
-                'first_name': user.first_name,
-                'middle_name': user.middle_name
-            }
-            
-            logger.info(f"📅 Обновляем событие календаря с данными: {calendar_trip_data}")
-            
-            # Обновляем событие
-            success = calendar_integration.update_trip_event_sync(
-                trip_data['calendar_event_id'], 
-                calendar_trip_data, 
-                calendar_user_data
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self._webhook_slots.release()
+    
+    async def start_webhook(self, url: str, secret_token: str) -> bool:
+        """Запуск бота в режиме webhook.
+        
+        Регистрирует url в Telegram и ждет остановки (stop_webhook или отмена
+        задачи). Обновления приходят через dispatch_webhook_update. Возвращает
+        False, если Telegram не принял webhook (можно перейти на polling).
+        """
+        self._loop = asyncio.get_running_loop()
+        self.webhook_secret = secret_token
+        
+        try:
+            await self.bot.set_webhook(
+                url,
+                secret_token=secret_token,
+                allowed_updates=self.dp.resolve_used_update_types(),
+                drop_pending_updates=False
             )
-            
-            if success:
-                logger.info(f"✅ Обновлено событие в Google Calendar: {trip_data['calendar_event_id']}")
-                return True
-            else:
-                logger.error("❌ Не удалось обновить событие в Google Calendar")
-                return False
-                
-        except ImportError:
-            logger.warning("⚠️ Модуль google_calendar не доступен")
-            return False
         except Exception as e:
-            logger.error(f"❌ Ошибка обновления события в календаре: {e}")
+            logger.error(f"❌ Не удалось установить webhook {url}: {e}")
             return False
+        
+        logger.info(f"🌐 Telegram бот работает через webhook: {url}")
+        await self.serve_updates()
+        return True
     
-    async def start_polling(self):
-        """Запуск бота в режиме long polling"""
+    async def serve_updates(self):
+        """Прием обновлений, которые передаются боту извне (admit_update), до stop_webhook.
+        
+        Используется режимом webhook и процессами бота, которым обновления
+        пересылает диспетчер (bot_cluster).
+        """
+        self._loop = asyncio.get_running_loop()
+        self._webhook_slots = asyncio.Semaphore(self.max_pending_updates)
+        self._webhook_stopped = asyncio.Event()
+        if self.live_status:
+            self.live_status.start()
         try:
-            logger.info("🤖 Запуск Telegram бота...")
-            await self.dp.start_polling(self.bot)
-        except Exception as e:
-            logger.error(f"❌ Ошибка запуска бота: {e}")
+            await self._webhook_stopped.wait()
         finally:
+            self._webhook_stopped.set()
+            # Дожидаемся обновлений, которые уже в обработке
+            if self._webhook_tasks:
+                await asyncio.wait(list(self._webhook_tasks), timeout=10)
+            self._loop = None
+            await self.update_workers.close()
+            if self.live_status:
+                await self.live_status.close()
+            await self.outbox.close()
+            await self.dp.storage.close()
             await self.bot.session.close()
+    
+    async def broadcast(self, text: str, telegram_ids: List[int], priority: int = PRIORITY_BROADCAST) -> Dict[str, int]:
+        """Рассылка водителям через очередь (после ответов водителям, в пределах лимитов Telegram)"""
+        futures = [
+            self.outbox.submit_nowait(chat_id, lambda chat_id=chat_id: self.bot.send_message(chat_id, text), priority)
+            for chat_id in telegram_ids
+        ]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, BaseException))
+        summary = {'sent': len(results) - failed, 'failed': failed}
+        logger.info(f"📣 Рассылка завершена: доставлено {summary['sent']}, ошибок {summary['failed']}")
+        return summary
+    
+    def schedule_broadcast(self, text: str, telegram_ids: List[int]) -> bool:
+        """Запуск рассылки из другого потока (веб-приложения); False - бот не запущен"""
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            return False
+        asyncio.run_coroutine_threadsafe(self.broadcast(text, telegram_ids), loop)
+        return True
+    
+    def get_outbox_stats(self) -> Dict[str, Any]:
+        """Состояние очереди исходящих сообщений (и сообщений со статусом рейса)"""
+        stats = self.outbox.get_stats()
+        if self.live_status:
+            stats['live_status'] = self.live_status.get_stats()
+        return stats
+    
+    def get_update_stats(self) -> Dict[str, Any]:
+        """Обработка входящих обновлений: глубина очередей воркеров и задержки"""
+        return {**self.update_workers.get_stats(), 'max_pending_updates': self.max_pending_updates}
+    
+    def get_login_stats(self) -> Dict[str, Any]:
+        """Ограничение неудачных входов водителей (окна этого процесса)"""
+        return login_throttle.get_stats()
+    
+    def stop_webhook(self):
+        """Остановка режима webhook (webhook в Telegram остается - обновления дождутся перезапуска)"""
+        if self._loop and self._webhook_stopped:
+            self._loop.call_soon_threadsafe(self._webhook_stopped.set)
+    
+    async def request_stop(self):
+        """Прекращение приема обновлений (в цикле бота): start_polling или start_webhook завершаются,
+        дорабатывая уже принятые обновления"""
+        if self._webhook_stopped is not None and not self._webhook_stopped.is_set():
+            self._webhook_stopped.set()
+            return
+        try:
+            await self.dp.stop_polling()
+        except RuntimeError:
+            # Polling не запущен
+            pass
 
 # Функция для запуска бота
 async def main():
@@ -0,0 +1,84 @@
+# trip_events.py - Внутрипроцессная шина событий жизненного цикла рейсов
+
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Типы событий жизненного цикла рейса
+TRIP_EVENT_TYPES = ('created', 'started', 'completed', 'cancelled', 'deleted')
+
+class TripEventBus:
+    """Pub/sub для событий рейсов.
+
+    Публиковать можно из любого потока и любого event loop (бот и веб-сервер
+    работают в разных потоках): событие доставляется в очередь подписчика
+    через call_soon_threadsafe его собственного цикла. Если задан forwarder,
+    событие передается и в другие процессы (бот, запущенный отдельными
+    процессами, публикует события для SSE веб-интерфейса).
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self._lock = threading.Lock()
+        # Передача событий в другие процессы: forwarder(event_type, trip_id)
+        self.forwarder: Optional[Callable[[str, int], None]] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        """Подписка на события; вызывается из корутины подписчика"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.append((loop, queue))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Отписка от событий"""
+        with self._lock:
+            self._subscribers = [(loop, q) for loop, q in self._subscribers if q is not queue]
+
+    def publish(self, event_type: str, trip_id: int, trip: Optional[Dict[str, Any]] = None, forward: bool = True):
+        """Публикация события рейса всем подписчикам"""
+        if event_type not in TRIP_EVENT_TYPES:
+            raise ValueError(f"Неизвестный тип события: {event_type}")
+        if forward and self.forwarder is not None:
+            self.forwarder(event_type, trip_id)
+
+        event = {
+            'type': event_type,
+            'trip_id': trip_id,
+            'trip': trip,
+            'timestamp': datetime.now().isoformat()
+        }
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event)
+            except RuntimeError:
+                # Цикл подписчика уже закрыт
+                self.unsubscribe(queue)
+
+    @staticmethod
+    def _deliver(queue: asyncio.Queue, event: Dict[str, Any]):
+        """Помещение события в очередь подписчика (выполняется в его цикле)"""
+        if queue.full():
+            # Медленный клиент: отбрасываем самое старое событие
+            queue.get_nowait()
+            logger.warning("⚠️ Очередь подписчика событий переполнена, старое событие отброшено")
+        queue.put_nowait(event)
+
+    @property
+    def subscribers_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+# Глобальная шина событий процесса
+trip_events = TripEventBus()
@@ -0,0 +1,117 @@
+# update_workers.py - Параллельная обработка обновлений бота с сохранением порядка для каждого водителя
+
+import time
+import asyncio
+import logging
+from typing import Dict, Any, List, Callable, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class OrderedUpdateMiddleware(BaseMiddleware):
+    """Внешний middleware обновлений: разбор по водителям на пул воркеров.
+
+    Обновление ставится в очередь воркера user_id % workers и обрабатывается
+    им по порядку поступления. Обновления разных водителей идут параллельно
+    (на разных воркерах), а одного водителя - строго друг за другом, поэтому
+    состояние диалога и двойные нажатия «Начать/Завершить поездку» не
+    перемешиваются. Обновления без пользователя обрабатываются сразу.
+    Ограничение числа обновлений в работе (backpressure) задается при приеме:
+    tasks_concurrency_limit у polling и слоты webhook в ExpeditionBot.
+    """
+
+    def __init__(self, workers: int = 32):
+        self.workers = max(1, workers)
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._busy = 0
+        self.stats = {'processed': 0, 'errors': 0, 'max_depth': 0, 'max_wait_ms': 0.0}
+
+    def _ensure_workers(self):
+        if not self._tasks:
+            self._queues = [asyncio.Queue() for _ in range(self.workers)]
+            self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+            return
+        for i, task in enumerate(self._tasks):
+            if task.done():
+                # Перезапускается только остановившийся воркер - на своей очереди,
+                # чтобы ожидающие в ней обновления водителей не потерялись
+                error = None if task.cancelled() else task.exception()
+                logger.warning(f"⚠️ Воркер обновлений №{i} остановлен ({error or 'отменен'}), перезапуск")
+                self._tasks[i] = asyncio.create_task(self._worker(self._queues[i]))
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        self._ensure_workers()
+        future = asyncio.get_running_loop().create_future()
+        # Постановка в очередь синхронная - порядок совпадает с порядком поступления обновлений
+        self._queues[user.id % self.workers].put_nowait((handler, event, data, future, time.monotonic()))
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth())
+        return await future
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            handler, event, data, future, queued_at = await queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                wait_ms = (time.monotonic() - queued_at) * 1000
+                self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], round(wait_ms, 1))
+                self._busy += 1
+                try:
+                    # FSM middleware прочитал состояние при поступлении обновления;
+                    # предыдущие обновления водителя могли его изменить - читаем заново
+                    state = data.get('state')
+                    if state is not None:
+                        data['raw_state'] = await state.get_state()
+                    result = await handler(event, data)
+                except asyncio.CancelledError:
+                    # Воркер отменен посреди обработки - ожидающий обработчик не должен зависнуть
+                    if not future.done():
+                        future.cancel()
+                    raise
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    self._busy -= 1
+                    self.stats['processed'] += 1
+            finally:
+                queue.task_done()
+
+    def depth(self) -> int:
+        """Обновлений в очередях воркеров и в обработке"""
+        return sum(queue.qsize() for queue in self._queues) + self._busy
+
+    async def close(self, timeout: float = 10.0):
+        """Дождаться обработки очередей (не дольше timeout) и остановить воркеры"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ При остановке бота не обработано обновлений: {self.depth()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues = []
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'workers': self.workers,
+            'queue_depth': self.depth(),
+            'in_progress': self._busy
+        }
@@ -4,10 +4,12 @@
 import os
 import sys
 import json
+import asyncio
+import hmac
 import tempfile
 import logging
 from datetime import datetime, date, timedelta
-from typing import Optional
+from typing import Optional, Tuple, Dict, Any
 
 # Импорты сторонних библиотек
 import openpyxl
@@ -15,13 +17,21 @@ from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 from openpyxl.utils import get_column_letter
 
 from fastapi import FastAPI, Request, HTTPException, Depends, Form
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 # Импорты локальных модулей
 from database import DatabaseManager, User
+from trip_events import trip_events
+from fast_json import FastJSONResponse, dumps as json_dumps
+from calendar_outbox import calendar_outbox_metrics
+from driver_cache import driver_cache
+from reference_cache import reference_cache
+from password_hashing import password_hasher
+from login_throttle import admin_login_throttle
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -71,7 +81,19 @@ except ImportError as e:
         return CalendarIntegration(enabled=False)
 
 # Создание приложения FastAPI
-app = FastAPI(title="Система экспедирования", description="Веб-интерфейс для управления автопарком и рейсами")
+app = FastAPI(
+    title="Система экспедирования",
+    description="Веб-интерфейс для управления автопарком и рейсами",
+    default_response_class=FastJSONResponse
+)
+
+# Сжатие крупных ответов (отчеты, выгрузки рейсов): brotli при наличии brotli-asgi, иначе gzip
+COMPRESSION_MINIMUM_SIZE = 1024
+try:
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE, gzip_fallback=True)
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
 
 # Настройка безопасности
 security = HTTPBasic()
@@ -207,15 +229,27 @@ function formatDate(dateString) {
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-def get_current_admin_user(credentials: HTTPBasicCredentials = Depends(security)):
-    """Проверка авторизации администратора"""
-    user = db.authenticate_user(credentials.username, credentials.password)
+async def get_current_admin_user(request: Request, credentials: HTTPBasicCredentials = Depends(security)):
+    """Проверка авторизации администратора (PBKDF2 - в пуле password_hasher, цикл событий не блокируется)"""
+    source = f"ip:{request.client.host if request.client else 'unknown'}"
+    # Заблокированные попытки отклоняются до обращения к базе и хеширования пароля;
+    # фамилия блокируется только для этого адреса - верный пароль с другого адреса проходит
+    retry_after = admin_login_throttle.check(credentials.username, source)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Слишком много неудачных попыток входа, попробуйте позже",
+            headers={"Retry-After": str(int(retry_after) + 1)},
+        )
+    user = await db.authenticate_user_async(credentials.username, credentials.password)
     if not user or user.role != 'admin':
+        admin_login_throttle.record_failure(credentials.username, source)
         raise HTTPException(
             status_code=401,
             detail="Неверные учетные данные или недостаточно прав",
             headers={"WWW-Authenticate": "Basic"},
         )
+    admin_login_throttle.record_success(credentials.username, source)
     return user
 
 # ===== ГЛАВНАЯ СТРАНИЦА =====
@@ -229,8 +263,8 @@ async def dashboard(request: Request, current_user: User = Depends(get_current_a
     month_ago = today - timedelta(days=30)
     
     trips_today = db.get_trips_for_report(start_date=today, end_date=today)
-    trips_week = db.get_trips_for_report(start_date=week_ago, end_date=today)
-    trips_month = db.get_trips_for_report(start_date=month_ago, end_date=today)
+    trips_week = db.get_trips_for_report(start_date=week_ago, end_date=today, fields=['total_amount'])
+    trips_month = db.get_trips_for_report(start_date=month_ago, end_date=today, fields=['total_amount'])
     
     total_revenue_today = sum(trip['total_amount'] for trip in trips_today)
     total_revenue_week = sum(trip['total_amount'] for trip in trips_week)
@@ -276,7 +310,7 @@ async def create_driver(
     """Создание нового водителя"""
     try:
         password = db.generate_password()
-        driver_id = db.create_user(surname, first_name, middle_name, "driver", password)
+        driver_id = await asyncio.to_thread(db.create_user, surname, first_name, middle_name, "driver", password)
         return JSONResponse({
             "success": True,
             "driver_id": driver_id,
@@ -297,6 +331,7 @@ async def deactivate_driver(
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_active = 0 WHERE id = ? AND role = 'driver'", (driver_id,))
             conn.commit()
+            driver_cache.invalidate_user(driver_id)
             
             if cursor.rowcount > 0:
                 return JSONResponse({"success": True, "message": "Водитель деактивирован"})
@@ -316,6 +351,7 @@ async def activate_driver(
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_active = 1 WHERE id = ? AND role = 'driver'", (driver_id,))
             conn.commit()
+            driver_cache.invalidate_user(driver_id)
             
             if cursor.rowcount > 0:
                 return JSONResponse({"success": True, "message": "Водитель активирован"})
@@ -381,6 +417,7 @@ async def deactivate_vehicle(
             cursor = conn.cursor()
             cursor.execute("UPDATE vehicles SET is_active = 0 WHERE id = ?", (vehicle_id,))
             conn.commit()
+            reference_cache.invalidate('vehicles')
             
             if cursor.rowcount > 0:
                 return JSONResponse({"success": True, "message": "ТС деактивировано"})
@@ -400,6 +437,7 @@ async def activate_vehicle(
             cursor = conn.cursor()
             cursor.execute("UPDATE vehicles SET is_active = 1 WHERE id = ?", (vehicle_id,))
             conn.commit()
+            reference_cache.invalidate('vehicles')
             
             if cursor.rowcount > 0:
                 return JSONResponse({"success": True, "message": "ТС активировано"})
@@ -486,6 +524,7 @@ async def deactivate_route(
             cursor = conn.cursor()
             cursor.execute("UPDATE routes SET is_active = 0 WHERE id = ?", (route_id,))
             conn.commit()
+            reference_cache.invalidate('routes')
             
             if cursor.rowcount > 0:
                 return JSONResponse({"success": True, "message": "Маршрут деактивирован"})
@@ -505,6 +544,7 @@ async def activate_route(
             cursor = conn.cursor()
             cursor.execute("UPDATE routes SET is_active = 1 WHERE id = ?", (route_id,))
             conn.commit()
+            reference_cache.invalidate('routes')
             
             if cursor.rowcount > 0:
                 return JSONResponse({"success": True, "message": "Маршрут активирован"})
@@ -522,18 +562,8 @@ async def reports_page(request: Request, current_user: User = Depends(get_curren
         "user": current_user
     })
 
-@app.get("/reports/excel")
-async def generate_excel_report(
-    start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    current_user: User = Depends(get_current_admin_user)
-):
-    """Генерация Excel отчета"""
-    
-    # Парсинг дат
-    start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
-    end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
-    
+def build_excel_report(start_dt: Optional[date], end_dt: Optional[date]) -> str:
+    """Excel отчет о рейсах во временном файле (синхронно - выполняется в потоке)"""
     # Получение данных
     trips = db.get_trips_for_report(start_dt, end_dt)
     
@@ -621,6 +651,23 @@ async def generate_excel_report(
         wb.save(tmp_file.name)
         tmp_path = tmp_file.name
     
+    return tmp_path
+
+@app.get("/reports/excel")
+async def generate_excel_report(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Генерация Excel отчета"""
+    
+    # Парсинг дат
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+    end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
+    
+    # Выборка и сборка книги openpyxl - в потоке: цикл событий общий с ботом
+    tmp_path = await asyncio.to_thread(build_excel_report, start_dt, end_dt)
+    
     # Формирование имени файла
     period_str = ""
     if start_date and end_date:
@@ -638,18 +685,29 @@ async def generate_excel_report(
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
+def parse_fields(fields: Optional[str]) -> Optional[list]:
+    """Разбор параметра fields=a,b,c (None - все поля)"""
+    if not fields:
+        return None
+    return [f.strip() for f in fields.split(',') if f.strip()]
+
 @app.get("/api/trips")
 async def get_trips_api(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    fields: Optional[str] = None,
     current_user: User = Depends(get_current_admin_user)
 ):
     """API для получения списка рейсов"""
     start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
     end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
     
-    trips = db.get_trips_for_report(start_dt, end_dt)
-    return {"trips": trips}
+    try:
+        trips = await asyncio.to_thread(db.get_trips_for_report, start_dt, end_dt, fields=parse_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Явный ответ: для возвращенного словаря FastAPI сначала обходит все рейсы jsonable_encoder в цикле событий
+    return FastJSONResponse({"trips": trips})
 
 # ===== СТРАНИЦА НАСТРОЕК =====
 @app.get("/settings", response_class=HTMLResponse)
@@ -665,7 +723,9 @@ async def get_calendar_status(current_user: User = Depends(get_current_admin_use
     """Получение статуса Google Calendar"""
     try:
         calendar_integration = get_calendar_integration()
-        status = calendar_integration.get_connection_status()
+        # Запросы к Google синхронные - в потоке, чтобы не останавливать общий с ботом цикл событий
+        status = await asyncio.to_thread(calendar_integration.get_connection_status)
+        status['outbox'] = {**db.get_calendar_outbox_stats(), **calendar_outbox_metrics.as_dict()}
         return JSONResponse(status)
     except Exception as e:
         logger.error(f"Ошибка получения статуса календаря: {e}")
@@ -678,12 +738,26 @@ async def get_calendar_status(current_user: User = Depends(get_current_admin_use
             'error': f'Ошибка получения статуса: {str(e)}'
         })
 
+@app.post("/api/calendar/reconcile")
+async def reconcile_calendar(current_user: User = Depends(get_current_admin_user)):
+    """Запуск сверки событий календаря с рейсами"""
+    try:
+        if not get_calendar_integration().enabled:
+            return JSONResponse({"success": False, "message": "Google Calendar интеграция отключена"})
+        
+        from google_calendar import CalendarReconciler
+        stats = await asyncio.to_thread(CalendarReconciler(db).run_once)
+        return JSONResponse({"success": True, "data": stats})
+    except Exception as e:
+        logger.error(f"Ошибка сверки календаря: {e}")
+        return JSONResponse({"success": False, "message": str(e)})
+
 @app.get("/api/calendar/test")
 async def test_calendar_connection(current_user: User = Depends(get_current_admin_user)):
     """Тестирование подключения к Google Calendar"""
     try:
         calendar_integration = get_calendar_integration()
-        result = calendar_integration.test_connection()
+        result = await asyncio.to_thread(calendar_integration.test_connection)
         return JSONResponse(result)
     except Exception as e:
         logger.error(f"Ошибка тестирования календаря: {e}")
@@ -712,7 +786,7 @@ async def setup_calendar(current_user: User = Depends(get_current_admin_user)):
         calendar_integration = get_calendar_integration()
         
         # Проверяем текущий статус
-        status = calendar_integration.get_connection_status()
+        status = await asyncio.to_thread(calendar_integration.get_connection_status)
         
         if status['is_configured']:
             return JSONResponse({
@@ -722,7 +796,7 @@ async def setup_calendar(current_user: User = Depends(get_current_admin_user)):
             })
         
         # Попытка аутентификации
-        test_result = calendar_integration.test_connection()
+        test_result = await asyncio.to_thread(calendar_integration.test_connection)
         
         if test_result['success']:
             return JSONResponse({
@@ -747,6 +821,12 @@ async def setup_calendar(current_user: User = Depends(get_current_admin_user)):
 async def disconnect_calendar(current_user: User = Depends(get_current_admin_user)):
     """Отключение Google Calendar"""
     try:
+        # Сначала сбрасываем общий менеджер: иначе он продолжит работать с учетными
+        # данными из памяти, а фоновое обновление токена снова запишет token.json
+        calendar_integration = get_calendar_integration()
+        if calendar_integration.enabled:
+            calendar_integration.calendar_manager.reset()
+        
         # Удаляем файл токенов
         if os.path.exists('token.json'):
             os.remove('token.json')
@@ -795,7 +875,7 @@ async def create_test_event(current_user: User = Depends(get_current_admin_user)
             'middle_name': getattr(current_user, 'middle_name', '')
         }
         
-        event_id = calendar_integration.create_trip_event_sync(trip_data, user_data)
+        event_id = await asyncio.to_thread(calendar_integration.create_trip_event_sync, trip_data, user_data)
         
         if event_id:
             return JSONResponse({
@@ -816,7 +896,133 @@ async def create_test_event(current_user: User = Depends(get_current_admin_user)
             'message': f'Ошибка создания события: {str(e)}'
         })
 
+# ===== ГОТОВНОСТЬ СИСТЕМЫ =====
+# Состояние запуска (выставляется из main.py): ready - все компоненты запущены, draining - идет плавная остановка
+system_status = {'ready': False, 'draining': False}
+
+def set_system_status(**status):
+    """Обновление состояния запуска системы (ready, draining)"""
+    system_status.update(status)
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    """Проверка, что веб-сервер жив"""
+    return JSONResponse({"status": "ok"})
+
+@app.get("/ready", include_in_schema=False)
+async def readiness():
+    """Готовность принимать запросы: 503 до запуска всех компонентов и во время остановки"""
+    if system_status['ready'] and not system_status['draining']:
+        return JSONResponse({"ready": True})
+    return JSONResponse({"ready": False, "draining": system_status['draining']}, status_code=503)
+
 # ===== API ДЛЯ TELEGRAM BOT =====
+# Путь webhook Telegram и бот, принимающий обновления (регистрируется из main.py в режиме webhook)
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+telegram_webhook_bot = None
+# Сколько webhook ждет приема обновления перегруженным ботом до ответа 503
+TELEGRAM_WEBHOOK_ADMIT_TIMEOUT = 10.0
+# Запущенный бот для рассылок (в любом режиме)
+telegram_bot = None
+
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def register_telegram_webhook(bot):
+    """Подключение бота (ExpeditionBot) к webhook-эндпоинту"""
+    global telegram_webhook_bot
+    telegram_webhook_bot = bot
+
+def register_telegram_bot(bot):
+    """Подключение бота (ExpeditionBot) для рассылок из панели администратора"""
+    global telegram_bot
+    telegram_bot = bot
+
+@app.post(TELEGRAM_WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """Прием обновлений Telegram в режиме webhook"""
+    bot = telegram_webhook_bot
+    if bot is None or not bot.webhook_ready:
+        # Telegram повторит доставку позже
+        raise HTTPException(status_code=503, detail="Бот не принимает обновления")
+    
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), (bot.webhook_secret or "").encode()):
+        logger.warning(f"⚠️ Webhook Telegram: неверный секрет, запрос с {request.client.host if request.client else '?'}")
+        raise HTTPException(status_code=401, detail="Неверный секрет")
+    
+    try:
+        update = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректное обновление")
+    
+    try:
+        # Ждем только приема в обработку: при перегрузке бота Telegram повторит доставку
+        admitted = bot.dispatch_webhook_update(update)
+        await asyncio.wait_for(asyncio.wrap_future(admitted), TELEGRAM_WEBHOOK_ADMIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ Webhook Telegram: бот перегружен, обновление {update.get('update_id')} отклонено")
+        raise HTTPException(status_code=503, detail="Бот перегружен")
+    except RuntimeError:
+        raise HTTPException(status_code=503, detail="Бот не принимает обновления")
+    return JSONResponse({"ok": True})
+
+@app.post("/api/telegram/broadcast")
+async def telegram_broadcast(
+    request: Request,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Рассылка сообщения водителям через очередь бота: {"text", "driver_ids" (необязательно)}"""
+    try:
+        data = await request.json()
+        text = (data.get('text') or '').strip()
+        driver_ids = data.get('driver_ids')
+        
+        if not text:
+            return JSONResponse({"success": False, "message": "Текст сообщения не может быть пустым"})
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            return JSONResponse({"success": False, "message": f"Сообщение длиннее {TELEGRAM_MESSAGE_LIMIT} символов"})
+        if driver_ids is not None and not isinstance(driver_ids, list):
+            return JSONResponse({"success": False, "message": "driver_ids должен быть списком"})
+        
+        bot = telegram_bot
+        if bot is None:
+            return JSONResponse({"success": False, "message": "Telegram бот не запущен"})
+        
+        telegram_ids = db.get_driver_telegram_ids([int(i) for i in driver_ids] if driver_ids is not None else None)
+        if not telegram_ids:
+            return JSONResponse({"success": False, "message": "Нет водителей, подключивших бота"})
+        
+        if not bot.schedule_broadcast(text, telegram_ids):
+            return JSONResponse({"success": False, "message": "Telegram бот не запущен"})
+        
+        logger.info(f"📣 {current_user.surname} запустил рассылку {len(telegram_ids)} водителям")
+        return JSONResponse({
+            "success": True,
+            "message": f"Сообщение поставлено в очередь для {len(telegram_ids)} водителей",
+            "recipients": len(telegram_ids)
+        })
+        
+    except Exception as e:
+        logger.error(f"Ошибка рассылки: {e}")
+        return JSONResponse({"success": False, "message": str(e)})
+
+@app.get("/api/telegram/outbox")
+async def telegram_outbox_stats(current_user: User = Depends(get_current_admin_user)):
+    """Состояние очереди исходящих сообщений бота"""
+    bot = telegram_bot
+    if bot is None:
+        return JSONResponse({"success": False, "message": "Telegram бот не запущен"})
+    return JSONResponse({"success": True, "data": bot.get_outbox_stats()})
+
+@app.get("/api/telegram/updates")
+async def telegram_update_stats(current_user: User = Depends(get_current_admin_user)):
+    """Обработка входящих обновлений бота: глубина очередей воркеров и задержки"""
+    bot = telegram_bot
+    if bot is None:
+        return JSONResponse({"success": False, "message": "Telegram бот не запущен"})
+    return JSONResponse({"success": True, "data": bot.get_update_stats()})
+
 @app.post("/api/telegram/save-token")
 async def save_telegram_token(
     request: Request,
@@ -869,7 +1075,7 @@ async def get_system_info(current_user: User = Depends(get_current_admin_user)):
     """Получение системной информации"""
     try:
         # Подсчитываем количество рейсов
-        trips = db.get_trips_for_report()
+        trips = db.get_trips_for_report(fields=['id'])
         trips_count = len(trips)
         
         # Подсчитываем количество активных водителей
@@ -904,6 +1110,8 @@ async def analytics_page(request: Request, current_user: User = Depends(get_curr
         "user": current_user
     })
 
+# Явно созданный ответ обходит default_response_class; отчеты отдают самые крупные
+# списки, поэтому они возвращают FastJSONResponse (orjson) напрямую
 @app.get("/api/reports/drivers")
 async def get_driver_reports(
     start_date: Optional[str] = None,
@@ -915,12 +1123,12 @@ async def get_driver_reports(
         start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
         end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
         
-        stats = db.get_driver_statistics(start_dt, end_dt)
-        return JSONResponse({"success": True, "data": stats})
+        stats = await asyncio.to_thread(db.get_driver_statistics, start_dt, end_dt)
+        return FastJSONResponse({"success": True, "data": stats})
         
     except Exception as e:
         logger.error(f"Ошибка получения отчета по водителям: {e}")
-        return JSONResponse({"success": False, "error": str(e)})
+        return FastJSONResponse({"success": False, "error": str(e)})
 
 @app.get("/api/reports/vehicles")
 async def get_vehicle_reports(
@@ -933,12 +1141,12 @@ async def get_vehicle_reports(
         start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
         end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
         
-        stats = db.get_vehicle_statistics(start_dt, end_dt)
-        return JSONResponse({"success": True, "data": stats})
+        stats = await asyncio.to_thread(db.get_vehicle_statistics, start_dt, end_dt)
+        return FastJSONResponse({"success": True, "data": stats})
         
     except Exception as e:
         logger.error(f"Ошибка получения отчета по ТС: {e}")
-        return JSONResponse({"success": False, "error": str(e)})
+        return FastJSONResponse({"success": False, "error": str(e)})
 
 @app.get("/api/reports/routes")
 async def get_route_reports(
@@ -951,12 +1159,12 @@ async def get_route_reports(
         start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
         end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
         
-        stats = db.get_route_statistics(start_dt, end_dt)
-        return JSONResponse({"success": True, "data": stats})
+        stats = await asyncio.to_thread(db.get_route_statistics, start_dt, end_dt)
+        return FastJSONResponse({"success": True, "data": stats})
         
     except Exception as e:
         logger.error(f"Ошибка получения отчета по маршрутам: {e}")
-        return JSONResponse({"success": False, "error": str(e)})
+        return FastJSONResponse({"success": False, "error": str(e)})
 
 @app.get("/api/reports/trips")
 async def get_trips_report(
@@ -966,6 +1174,7 @@ async def get_trips_report(
     driver_id: Optional[int] = None,
     vehicle_id: Optional[int] = None,
     route_id: Optional[int] = None,
+    fields: Optional[str] = None,
     current_user: User = Depends(get_current_admin_user)
 ):
     """API для получения детального отчета по рейсам"""
@@ -973,78 +1182,352 @@ async def get_trips_report(
         start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
         end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
         
-        trips = db.get_trips_for_report(
+        trips = await asyncio.to_thread(
+            db.get_trips_for_report,
             start_date=start_dt,
             end_date=end_dt,
             status=status,
             user_id=driver_id,
             vehicle_id=vehicle_id,
-            route_id=route_id
+            route_id=route_id,
+            fields=parse_fields(fields)
         )
         
-        return JSONResponse({"success": True, "data": trips})
+        return FastJSONResponse({"success": True, "data": trips})
         
     except Exception as e:
         logger.error(f"Ошибка получения отчета по рейсам: {e}")
-        return JSONResponse({"success": False, "error": str(e)})
+        return FastJSONResponse({"success": False, "error": str(e)})
+
+@app.get("/api/reports/timeseries")
+async def get_timeseries_report(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    bucket: str = "day",
+    group_by: Optional[str] = None,
+    status: Optional[str] = None,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """API временных рядов для графиков: рейсы, доход, количество и среднее время по периодам"""
+    try:
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
+
+        points = await asyncio.to_thread(
+            db.get_trips_timeseries,
+            start_date=start_dt,
+            end_date=end_dt,
+            bucket=bucket,
+            group_by=group_by,
+            status=status
+        )
+
+        # Сворачиваем строки в компактные столбцы: общая ось периодов и по массиву значений на серию
+        periods = sorted({p['period'] for p in points})
+        period_index = {period: i for i, period in enumerate(periods)}
+        metrics = ('trips', 'completed_trips', 'revenue', 'quantity', 'avg_duration_hours')
+
+        series = {}
+        for point in points:
+            key = point['group_key']
+            if key not in series:
+                series[key] = {'key': key, 'label': point['group_label']}
+                for metric in metrics:
+                    series[key][metric] = [0] * len(periods)
+            i = period_index[point['period']]
+            for metric in metrics:
+                series[key][metric][i] = point[metric]
+
+        return FastJSONResponse({
+            "success": True,
+            "bucket": bucket,
+            "group_by": group_by,
+            "periods": periods,
+            "series": list(series.values())
+        })
+
+    except ValueError as e:
+        return FastJSONResponse({"success": False, "error": str(e)})
+    except Exception as e:
+        logger.error(f"Ошибка получения временных рядов: {e}")
+        return FastJSONResponse({"success": False, "error": str(e)})
+
+# Поля рейсов, нужные для сводки дашборда
+DASHBOARD_TRIP_FIELDS = ['status', 'total_amount', 'duration_hours']
+
+def build_dashboard_data() -> Dict[str, Any]:
+    """Сводка дашборда за сегодня, неделю и месяц (синхронно - выполняется в потоке)"""
+    today = date.today()
+    week_ago = today - timedelta(days=7)
+    month_ago = today - timedelta(days=30)
+    
+    # Статистика за сегодня
+    trips_today = db.get_trips_for_report(start_date=today, end_date=today, fields=DASHBOARD_TRIP_FIELDS)
+    completed_today = [t for t in trips_today if t['status'] == 'completed']
+    
+    # Статистика за неделю
+    trips_week = db.get_trips_for_report(start_date=week_ago, end_date=today, fields=DASHBOARD_TRIP_FIELDS)
+    completed_week = [t for t in trips_week if t['status'] == 'completed']
+    
+    # Статистика за месяц
+    trips_month = db.get_trips_for_report(start_date=month_ago, end_date=today, fields=DASHBOARD_TRIP_FIELDS)
+    completed_month = [t for t in trips_month if t['status'] == 'completed']
+    
+    # Активные рейсы
+    active_trips = db.get_trips_for_report(status='started', fields=['id'])
+    
+    # Средняя продолжительность поездок
+    avg_duration_month = 0
+    duration_trips = [t for t in completed_month if t.get('duration_hours')]
+    if duration_trips:
+        avg_duration_month = sum(t['duration_hours'] for t in duration_trips) / len(duration_trips)
+    
+    dashboard_data = {
+        'trips_today': len(trips_today),
+        'completed_today': len(completed_today),
+        'revenue_today': sum(t['total_amount'] for t in completed_today),
+        
+        'trips_week': len(trips_week),
+        'completed_week': len(completed_week),
+        'revenue_week': sum(t['total_amount'] for t in completed_week),
+        
+        'trips_month': len(trips_month),
+        'completed_month': len(completed_month),
+        'revenue_month': sum(t['total_amount'] for t in completed_month),
+        
+        'active_trips': len(active_trips),
+        'avg_duration_hours': round(avg_duration_month, 2),
+        
+        'active_drivers': len([u for u in db.get_all_users() if u.role == 'driver' and u.is_active]),
+        'active_vehicles': len(db.get_active_vehicles()),
+        'active_routes': len(db.get_active_routes()),
+        
+        'completion_rate': round(len(completed_month) / max(len(trips_month), 1) * 100, 1)
+    }
+    return dashboard_data
 
 @app.get("/api/reports/dashboard")
 async def get_dashboard_data(current_user: User = Depends(get_current_admin_user)):
     """API для получения данных дашборда"""
     try:
-        today = date.today()
-        week_ago = today - timedelta(days=7)
-        month_ago = today - timedelta(days=30)
-        
-        # Статистика за сегодня
-        trips_today = db.get_trips_for_report(start_date=today, end_date=today)
-        completed_today = [t for t in trips_today if t['status'] == 'completed']
-        
-        # Статистика за неделю
-        trips_week = db.get_trips_for_report(start_date=week_ago, end_date=today)
-        completed_week = [t for t in trips_week if t['status'] == 'completed']
-        
-        # Статистика за месяц
-        trips_month = db.get_trips_for_report(start_date=month_ago, end_date=today)
-        completed_month = [t for t in trips_month if t['status'] == 'completed']
-        
-        # Активные рейсы
-        active_trips = db.get_trips_for_report(status='started')
-        
-        # Средняя продолжительность поездок
-        avg_duration_month = 0
-        duration_trips = [t for t in completed_month if t.get('duration_hours')]
-        if duration_trips:
-            avg_duration_month = sum(t['duration_hours'] for t in duration_trips) / len(duration_trips)
-        
-        dashboard_data = {
-            'trips_today': len(trips_today),
-            'completed_today': len(completed_today),
-            'revenue_today': sum(t['total_amount'] for t in completed_today),
-            
-            'trips_week': len(trips_week),
-            'completed_week': len(completed_week),
-            'revenue_week': sum(t['total_amount'] for t in completed_week),
+        # Семь запросов к базе - в потоке, чтобы не задерживать общий с ботом цикл событий
+        dashboard_data = await asyncio.to_thread(build_dashboard_data)
+        
+        return FastJSONResponse({"success": True, "data": dashboard_data})
+        
+    except Exception as e:
+        logger.error(f"Ошибка получения данных дашборда: {e}")
+        return FastJSONResponse({"success": False, "error": str(e)})
+
+def build_advanced_excel_report(report_type: str, start_dt: Optional[date], end_dt: Optional[date],
+                                driver_id: Optional[int], vehicle_id: Optional[int],
+                                route_id: Optional[int]) -> Tuple[str, str]:
+    """Расширенный Excel отчет во временном файле (синхронно - выполняется в потоке).
+    
+    Возвращает путь к файлу и основу имени файла для скачивания.
+    """
+    # Создание Excel файла
+    wb = openpyxl.Workbook()
+    
+    # Настройка стилей
+    header_font = Font(bold=True, size=12, color="FFFFFF")
+    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+    subheader_font = Font(bold=True, size=11)
+    border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    
+    if report_type == "drivers":
+        # Отчет по водителям
+        ws = wb.active
+        ws.title = "Отчет по водителям"
+        
+        headers = [
+            "№", "ФИО водителя", "Всего рейсов", "Завершено", "Отменено", 
+            "Общий доход (₽)", "Общее количество", "Ср. время поездки (ч)", "% завершения"
+        ]
+        
+        # Заголовки
+        for col, header in enumerate(headers, 1):
+            cell = ws.cell(row=1, column=col)
+            cell.value = header
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.border = border
+            cell.alignment = Alignment(horizontal='center', vertical='center')
+        
+        # Данные
+        stats = db.get_driver_statistics(start_dt, end_dt)
+        for row_num, stat in enumerate(stats, 2):
+            ws.cell(row=row_num, column=1, value=row_num - 1).border = border
+            ws.cell(row=row_num, column=2, value=stat['driver_name']).border = border
+            ws.cell(row=row_num, column=3, value=stat['total_trips']).border = border
+            ws.cell(row=row_num, column=4, value=stat['completed_trips']).border = border
+            ws.cell(row=row_num, column=5, value=stat['cancelled_trips']).border = border
+            ws.cell(row=row_num, column=6, value=stat['total_revenue']).border = border
+            ws.cell(row=row_num, column=7, value=stat['total_quantity']).border = border
+            ws.cell(row=row_num, column=8, value=stat['avg_duration_hours']).border = border
+            ws.cell(row=row_num, column=9, value=f"{stat['completion_rate']}%").border = border
+        
+        filename = f"отчет_по_водителям"
+        
+    elif report_type == "vehicles":
+        # Отчет по ТС
+        ws = wb.active
+        ws.title = "Отчет по ТС"
+        
+        headers = [
+            "№", "Номер ТС", "Модель", "Всего рейсов", "Завершено", 
+            "Общий доход (₽)", "Общее количество", "Ср. время поездки (ч)"
+        ]
+        
+        # Заголовки
+        for col, header in enumerate(headers, 1):
+            cell = ws.cell(row=1, column=col)
+            cell.value = header
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.border = border
+            cell.alignment = Alignment(horizontal='center', vertical='center')
+        
+        # Данные
+        stats = db.get_vehicle_statistics(start_dt, end_dt)
+        for row_num, stat in enumerate(stats, 2):
+            ws.cell(row=row_num, column=1, value=row_num - 1).border = border
+            ws.cell(row=row_num, column=2, value=stat['vehicle_number']).border = border
+            ws.cell(row=row_num, column=3, value=stat['vehicle_model']).border = border
+            ws.cell(row=row_num, column=4, value=stat['total_trips']).border = border
+            ws.cell(row=row_num, column=5, value=stat['completed_trips']).border = border
+            ws.cell(row=row_num, column=6, value=stat['total_revenue']).border = border
+            ws.cell(row=row_num, column=7, value=stat['total_quantity']).border = border
+            ws.cell(row=row_num, column=8, value=stat['avg_duration_hours']).border = border
+        
+        filename = f"отчет_по_тс"
+        
+    elif report_type == "routes":
+        # Отчет по маршрутам
+        ws = wb.active
+        ws.title = "Отчет по маршрутам"
+        
+        headers = [
+            "№", "Номер маршрута", "Название", "Цена за рейс (₽)", "Всего рейсов", 
+            "Завершено", "Общий доход (₽)", "Общее количество", "Ср. время поездки (ч)"
+        ]
+        
+        # Заголовки
+        for col, header in enumerate(headers, 1):
+            cell = ws.cell(row=1, column=col)
+            cell.value = header
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.border = border
+            cell.alignment = Alignment(horizontal='center', vertical='center')
+        
+        # Данные
+        stats = db.get_route_statistics(start_dt, end_dt)
+        for row_num, stat in enumerate(stats, 2):
+            ws.cell(row=row_num, column=1, value=row_num - 1).border = border
+            ws.cell(row=row_num, column=2, value=stat['route_number']).border = border
+            ws.cell(row=row_num, column=3, value=stat['route_name']).border = border
+            ws.cell(row=row_num, column=4, value=stat['route_price']).border = border
+            ws.cell(row=row_num, column=5, value=stat['total_trips']).border = border
+            ws.cell(row=row_num, column=6, value=stat['completed_trips']).border = border
+            ws.cell(row=row_num, column=7, value=stat['total_revenue']).border = border
+            ws.cell(row=row_num, column=8, value=stat['total_quantity']).border = border
+            ws.cell(row=row_num, column=9, value=stat['avg_duration_hours']).border = border
+        
+        filename = f"отчет_по_маршрутам"
+        
+    else:
+        # Детальный отчет по рейсам
+        ws = wb.active
+        ws.title = "Детальный отчет по рейсам"
+        
+        headers = [
+            "№", "Дата", "Номер путевого листа", "Водитель", "ТС", "Маршрут",
+            "Количество", "Статус", "Время начала", "Время окончания", "Продолжительность", "Сумма (₽)"
+        ]
+        
+        # Заголовки
+        for col, header in enumerate(headers, 1):
+            cell = ws.cell(row=1, column=col)
+            cell.value = header
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.border = border
+            cell.alignment = Alignment(horizontal='center', vertical='center')
+        
+        # Данные
+        trips = db.get_trips_for_report(
+            start_date=start_dt,
+            end_date=end_dt,
+            user_id=driver_id,
+            vehicle_id=vehicle_id,
+            route_id=route_id
+        )
+        
+        for row_num, trip in enumerate(trips, 2):
+            ws.cell(row=row_num, column=1, value=row_num - 1).border = border
+            ws.cell(row=row_num, column=2, value=trip['date']).border = border
+            ws.cell(row=row_num, column=3, value=trip['waybill_number']).border = border
+            ws.cell(row=row_num, column=4, value=trip['driver_name']).border = border
+            ws.cell(row=row_num, column=5, value=trip['vehicle_number']).border = border
+            ws.cell(row=row_num, column=6, value=f"№{trip['route_name'][:20]}").border = border
+            ws.cell(row=row_num, column=7, value=trip['quantity']).border = border
             
-            'trips_month': len(trips_month),
-            'completed_month': len(completed_month),
-            'revenue_month': sum(t['total_amount'] for t in completed_month),
+            # Статус с цветовым кодированием
+            status_cell = ws.cell(row=row_num, column=8, value=trip['status'])
+            status_cell.border = border
+            if trip['status'] == 'completed':
+                status_cell.fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
+            elif trip['status'] == 'started':
+                status_cell.fill = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")
+            elif trip['status'] == 'cancelled':
+                status_cell.fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
             
-            'active_trips': len(active_trips),
-            'avg_duration_hours': round(avg_duration_month, 2),
+            # Время
+            start_time = ""
+            end_time = ""
+            duration = ""
             
-            'active_drivers': len([u for u in db.get_all_users() if u.role == 'driver' and u.is_active]),
-            'active_vehicles': len(db.get_active_vehicles()),
-            'active_routes': len(db.get_active_routes()),
+            if trip.get('started_at'):
+                start_time = datetime.fromisoformat(trip['started_at']).strftime('%H:%M')
+            if trip.get('completed_at'):
+                end_time = datetime.fromisoformat(trip['completed_at']).strftime('%H:%M')
+            if trip.get('duration_hours'):
+                hours = int(trip['duration_hours'])
+                minutes = int((trip['duration_hours'] - hours) * 60)
+                duration = f"{hours}ч {minutes}мин"
             
-            'completion_rate': round(len(completed_month) / max(len(trips_month), 1) * 100, 1)
-        }
-        
-        return JSONResponse({"success": True, "data": dashboard_data})
+            ws.cell(row=row_num, column=9, value=start_time).border = border
+            ws.cell(row=row_num, column=10, value=end_time).border = border
+            ws.cell(row=row_num, column=11, value=duration).border = border
+            ws.cell(row=row_num, column=12, value=trip['total_amount']).border = border
         
-    except Exception as e:
-        logger.error(f"Ошибка получения данных дашборда: {e}")
-        return JSONResponse({"success": False, "error": str(e)})
+        filename = f"детальный_отчет_по_рейсам"
+    
+    # Автоподбор ширины колонок
+    for column in ws.columns:
+        max_length = 0
+        column_letter = get_column_letter(column[0].column)
+        for cell in column:
+            try:
+                if len(str(cell.value)) > max_length:
+                    max_length = len(str(cell.value))
+            except:
+                pass
+        adjusted_width = min(max_length + 2, 50)
+        ws.column_dimensions[column_letter].width = adjusted_width
+    
+    # Сохранение во временный файл
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_file:
+        wb.save(tmp_file.name)
+        tmp_path = tmp_file.name
+    
+    return tmp_path, filename
 
 @app.get("/reports/excel/advanced")
 async def generate_advanced_excel_report(
@@ -1063,202 +1546,11 @@ async def generate_advanced_excel_report(
         start_dt = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
         end_dt = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
         
-        # Создание Excel файла
-        wb = openpyxl.Workbook()
-        
-        # Настройка стилей
-        header_font = Font(bold=True, size=12, color="FFFFFF")
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-        subheader_font = Font(bold=True, size=11)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
+        # Выборка и сборка книги openpyxl - в потоке: цикл событий общий с ботом
+        tmp_path, filename = await asyncio.to_thread(
+            build_advanced_excel_report, report_type, start_dt, end_dt, driver_id, vehicle_id, route_id
         )
         
-        if report_type == "drivers":
-            # Отчет по водителям
-            ws = wb.active
-            ws.title = "Отчет по водителям"
-            
-            headers = [
-                "№", "ФИО водителя", "Всего рейсов", "Завершено", "Отменено", 
-                "Общий доход (₽)", "Общее количество", "Ср. время поездки (ч)", "% завершения"
-            ]
-            
-            # Заголовки
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col)
-                cell.value = header
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.border = border
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            # Данные
-            stats = db.get_driver_statistics(start_dt, end_dt)
-            for row_num, stat in enumerate(stats, 2):
-                ws.cell(row=row_num, column=1, value=row_num - 1).border = border
-                ws.cell(row=row_num, column=2, value=stat['driver_name']).border = border
-                ws.cell(row=row_num, column=3, value=stat['total_trips']).border = border
-                ws.cell(row=row_num, column=4, value=stat['completed_trips']).border = border
-                ws.cell(row=row_num, column=5, value=stat['cancelled_trips']).border = border
-                ws.cell(row=row_num, column=6, value=stat['total_revenue']).border = border
-                ws.cell(row=row_num, column=7, value=stat['total_quantity']).border = border
-                ws.cell(row=row_num, column=8, value=stat['avg_duration_hours']).border = border
-                ws.cell(row=row_num, column=9, value=f"{stat['completion_rate']}%").border = border
-            
-            filename = f"отчет_по_водителям"
-            
-        elif report_type == "vehicles":
-            # Отчет по ТС
-            ws = wb.active
-            ws.title = "Отчет по ТС"
-            
-            headers = [
-                "№", "Номер ТС", "Модель", "Всего рейсов", "Завершено", 
-                "Общий доход (₽)", "Общее количество", "Ср. время поездки (ч)"
-            ]
-            
-            # Заголовки
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col)
-                cell.value = header
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.border = border
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            # Данные
-            stats = db.get_vehicle_statistics(start_dt, end_dt)
-            for row_num, stat in enumerate(stats, 2):
-                ws.cell(row=row_num, column=1, value=row_num - 1).border = border
-                ws.cell(row=row_num, column=2, value=stat['vehicle_number']).border = border
-                ws.cell(row=row_num, column=3, value=stat['vehicle_model']).border = border
-                ws.cell(row=row_num, column=4, value=stat['total_trips']).border = border
-                ws.cell(row=row_num, column=5, value=stat['completed_trips']).border = border
-                ws.cell(row=row_num, column=6, value=stat['total_revenue']).border = border
-                ws.cell(row=row_num, column=7, value=stat['total_quantity']).border = border
-                ws.cell(row=row_num, column=8, value=stat['avg_duration_hours']).border = border
-            
-            filename = f"отчет_по_тс"
-            
-        elif report_type == "routes":
-            # Отчет по маршрутам
-            ws = wb.active
-            ws.title = "Отчет по маршрутам"
-            
-            headers = [
-                "№", "Номер маршрута", "Название", "Цена за рейс (₽)", "Всего рейсов", 
-                "Завершено", "Общий доход (₽)", "Общее количество", "Ср. время поездки (ч)"
-            ]
-            
-            # Заголовки
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col)
-                cell.value = header
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.border = border
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            # Данные
-            stats = db.get_route_statistics(start_dt, end_dt)
-            for row_num, stat in enumerate(stats, 2):
-                ws.cell(row=row_num, column=1, value=row_num - 1).border = border
-                ws.cell(row=row_num, column=2, value=stat['route_number']).border = border
-                ws.cell(row=row_num, column=3, value=stat['route_name']).border = border
-                ws.cell(row=row_num, column=4, value=stat['route_price']).border = border
-                ws.cell(row=row_num, column=5, value=stat['total_trips']).border = border
-                ws.cell(row=row_num, column=6, value=stat['completed_trips']).border = border
-                ws.cell(row=row_num, column=7, value=stat['total_revenue']).border = border
-                ws.cell(row=row_num, column=8, value=stat['total_quantity']).border = border
-                ws.cell(row=row_num, column=9, value=stat['avg_duration_hours']).border = border
-            
-            filename = f"отчет_по_маршрутам"
-            
-        else:
-            # Детальный отчет по рейсам
-            ws = wb.active
-            ws.title = "Детальный отчет по рейсам"
-            
-            headers = [
-                "№", "Дата", "Номер путевого листа", "Водитель", "ТС", "Маршрут",
-                "Количество", "Статус", "Время начала", "Время окончания", "Продолжительность", "Сумма (₽)"
-            ]
-            
-            # Заголовки
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col)
-                cell.value = header
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.border = border
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            
-            # Данные
-            trips = db.get_trips_for_report(
-                start_date=start_dt,
-                end_date=end_dt,
-                user_id=driver_id,
-                vehicle_id=vehicle_id,
-                route_id=route_id
-            )
-            
-            for row_num, trip in enumerate(trips, 2):
-                ws.cell(row=row_num, column=1, value=row_num - 1).border = border
-                ws.cell(row=row_num, column=2, value=trip['date']).border = border
-                ws.cell(row=row_num, column=3, value=trip['waybill_number']).border = border
-                ws.cell(row=row_num, column=4, value=trip['driver_name']).border = border
-                ws.cell(row=row_num, column=5, value=trip['vehicle_number']).border = border
-                ws.cell(row=row_num, column=6, value=f"№{trip['route_name'][:20]}").border = border
-                ws.cell(row=row_num, column=7, value=trip['quantity']).border = border
-                
-                # Статус с цветовым кодированием
-                status_cell = ws.cell(row=row_num, column=8, value=trip['status'])
-                status_cell.border = border
-                if trip['status'] == 'completed':
-                    status_cell.fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
-                elif trip['status'] == 'started':
-                    status_cell.fill = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")
-                elif trip['status'] == 'cancelled':
-                    status_cell.fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-                
-                # Время
-                start_time = ""
-                end_time = ""
-                duration = ""
-                
-                if trip.get('started_at'):
-                    start_time = datetime.fromisoformat(trip['started_at']).strftime('%H:%M')
-                if trip.get('completed_at'):
-                    end_time = datetime.fromisoformat(trip['completed_at']).strftime('%H:%M')
-                if trip.get('duration_hours'):
-                    hours = int(trip['duration_hours'])
-                    minutes = int((trip['duration_hours'] - hours) * 60)
-                    duration = f"{hours}ч {minutes}мин"
-                
-                ws.cell(row=row_num, column=9, value=start_time).border = border
-                ws.cell(row=row_num, column=10, value=end_time).border = border
-                ws.cell(row=row_num, column=11, value=duration).border = border
-                ws.cell(row=row_num, column=12, value=trip['total_amount']).border = border
-            
-            filename = f"детальный_отчет_по_рейсам"
-        
-        # Автоподбор ширины колонок
-        for column in ws.columns:
-            max_length = 0
-            column_letter = get_column_letter(column[0].column)
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column_letter].width = adjusted_width
-        
         # Формирование имени файла
         period_str = ""
         if start_date and end_date:
@@ -1270,11 +1562,6 @@ async def generate_advanced_excel_report(
         
         full_filename = f"{filename}{period_str}.xlsx"
         
-        # Сохранение во временный файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_file:
-            wb.save(tmp_file.name)
-            tmp_path = tmp_file.name
-        
         return FileResponse(
             path=tmp_path,
             filename=full_filename,
@@ -1842,7 +2129,7 @@ async def reset_driver_password(
 ):
     """Сброс пароля водителя на новый случайный"""
     try:
-        new_password = db.reset_user_password(driver_id)
+        new_password = await asyncio.to_thread(db.reset_user_password, driver_id)
         
         if new_password:
             return JSONResponse({
@@ -1875,7 +2162,7 @@ async def change_driver_password(
                 "message": "Пароль должен содержать минимум 6 символов"
             })
         
-        success = db.change_user_password(driver_id, new_password.strip())
+        success = await asyncio.to_thread(db.change_user_password, driver_id, new_password.strip())
         
         if success:
             return JSONResponse({
@@ -1910,8 +2197,30 @@ async def get_driver_info(
         logger.error(f"Ошибка получения информации о водителе {driver_id}: {e}")
         return JSONResponse({"success": False, "message": str(e)})
 
+@app.get("/api/drivers/stats")
+async def get_drivers_stats(
+    ids: Optional[str] = None,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Статистика рейсов по всем водителям (или по списку ID через запятую) одним запросом"""
+    try:
+        user_ids = [int(i) for i in ids.split(',') if i.strip()] if ids else None
+        stats = await asyncio.to_thread(db.get_drivers_trip_stats, user_ids)
+        return JSONResponse({"success": True, "data": stats})
+        
+    except ValueError:
+        return JSONResponse({"success": False, "message": "Некорректный список ID"})
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики водителей: {e}")
+        return JSONResponse({"success": False, "message": str(e)})
+
 # ===== УДАЛЕНИЕ ЗАПИСЕЙ =====
 
+def publish_trips_deleted(trips: list):
+    """Публикация событий удаления рейсов (при принудительном удалении связанных записей)"""
+    for trip in trips:
+        trip_events.publish('deleted', trip['id'], trip)
+
 @app.delete("/drivers/{driver_id}")
 async def delete_driver(
     driver_id: int,
@@ -1920,7 +2229,10 @@ async def delete_driver(
 ):
     """Удаление водителя"""
     try:
+        trips = db.get_trips_for_report(user_id=driver_id) if force else []
         success, message = db.delete_user(driver_id, force)
+        if success:
+            publish_trips_deleted(trips)
         
         return JSONResponse({
             "success": success,
@@ -1939,7 +2251,10 @@ async def delete_vehicle(
 ):
     """Удаление транспортного средства"""
     try:
+        trips = db.get_trips_for_report(vehicle_id=vehicle_id) if force else []
         success, message = db.delete_vehicle(vehicle_id, force)
+        if success:
+            publish_trips_deleted(trips)
         
         return JSONResponse({
             "success": success,
@@ -1958,7 +2273,10 @@ async def delete_route(
 ):
     """Удаление маршрута"""
     try:
+        trips = db.get_trips_for_report(route_id=route_id) if force else []
         success, message = db.delete_route(route_id, force)
+        if success:
+            publish_trips_deleted(trips)
         
         return JSONResponse({
             "success": success,
@@ -1977,7 +2295,10 @@ async def delete_trip(
 ):
     """Удаление рейса"""
     try:
+        trip = db.get_trip_for_report(trip_id)
         success, message = db.delete_trip(trip_id, cancel_calendar_event)
+        if success:
+            trip_events.publish('deleted', trip_id, trip)
         
         return JSONResponse({
             "success": success,
@@ -2012,6 +2333,8 @@ async def bulk_driver_action(
                 for driver_id in driver_ids:
                     cursor.execute("UPDATE users SET is_active = 1 WHERE id = ? AND role = 'driver'", (driver_id,))
                 conn.commit()
+            for driver_id in driver_ids:
+                driver_cache.invalidate_user(driver_id)
             results.append(f"Активировано {len(driver_ids)} водителей")
             
         elif action == 'deactivate':
@@ -2020,16 +2343,18 @@ async def bulk_driver_action(
                 for driver_id in driver_ids:
                     cursor.execute("UPDATE users SET is_active = 0 WHERE id = ? AND role = 'driver'", (driver_id,))
                 conn.commit()
+            for driver_id in driver_ids:
+                driver_cache.invalidate_user(driver_id)
             results.append(f"Деактивировано {len(driver_ids)} водителей")
             
         elif action == 'reset_passwords':
-            for driver_id in driver_ids:
-                new_password = db.reset_user_password(driver_id)
-                if new_password:
-                    # Получаем информацию о водителе
-                    driver_info = db.get_user_info(driver_id)
-                    if driver_info:
-                        results.append(f"{driver_info['full_name']}: {new_password}")
+            # Хеши новых паролей считаются параллельно в пуле password_hasher
+            new_passwords = await asyncio.to_thread(db.reset_user_passwords, driver_ids)
+            for driver_id, new_password in new_passwords.items():
+                # Получаем информацию о водителе
+                driver_info = db.get_user_info(driver_id)
+                if driver_info:
+                    results.append(f"{driver_info['full_name']}: {new_password}")
             
         elif action == 'delete':
             force = data.get('force', False)
@@ -2208,7 +2533,10 @@ async def get_security_stats(current_user: User = Depends(get_current_admin_user
                     "active_trips": active_trips,
                     "overdue_trips": overdue_trips,
                     "security_score": max(0, 100 - (drivers_without_telegram * 5) - (overdue_trips * 10))
-                }
+                },
+                "password_hashing": password_hasher.get_stats(),
+                "login_throttle": admin_login_throttle.get_stats(),
+                "bot_login_throttle": telegram_bot.get_login_stats() if telegram_bot is not None else None
             })
             
     except Exception as e:
@@ -2225,6 +2553,37 @@ async def trips_management_page(request: Request, current_user: User = Depends(g
         "user": current_user
     })
 
+# ===== ПОТОК СОБЫТИЙ РЕЙСОВ (SSE) =====
+
+@app.get("/api/events/trips")
+async def trip_events_stream(request: Request, current_user: User = Depends(get_current_admin_user)):
+    """Server-Sent Events: создание, начало, завершение, отмена и удаление рейсов в реальном времени"""
+    queue = trip_events.subscribe()
+    
+    async def event_generator():
+        try:
+            # Клиент переподключается через 5 секунд после обрыва
+            yield "retry: 5000\n\n"
+            while True:
+                # При остановке системы поток закрывается (не позже пинга), клиент переподключится к новому запуску
+                if system_status['draining'] or await request.is_disconnected():
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Комментарий-пинг, чтобы прокси не закрывали простаивающее соединение
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json_dumps(event)}\n\n"
+        finally:
+            trip_events.unsubscribe(queue)
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ===== API ДЛЯ УПРАВЛЕНИЯ РЕЙСАМИ =====
 
 @app.get("/api/drivers")
@@ -2428,5 +2787,8 @@ if __name__ == "__main__":
     print("🔗 Откройте http://localhost:8000 в браузере")
     print("👤 Логин: admin, Пароль: admin123")
     
+    # Без бота и фоновых задач веб-приложение готово сразу после запуска сервера
+    set_system_status(ready=True)
+    
     # Запуск сервера
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file